@@ -0,0 +1,91 @@
+import json
+import hashlib
+from datetime import datetime, time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import timezone
+
+from arpwatch.models import ArpLog, ACTIVITY_SNAPSHOT_KEY
+from nadine.models.membership import Membership
+from nadine.models.usage import CoworkingDay
+from nadine.templatetags import imagetags
+
+# Snapshots are dropped whenever presence or memberships change, this only catches profile edits
+ACTIVITY_SNAPSHOT_TIMEOUT = 10 * 60
+
+
+def build_payload():
+    """Computes today's activity in the space as served by the ActivityResource."""
+    now = timezone.localtime(timezone.now())
+    midnight = timezone.make_aware(datetime.combine(now.date(), time.min), timezone.get_current_timezone())
+    member_count = User.helper.active_members().count()
+    full_time_count = Membership.objects.active_memberships().filter(has_desk=True).count()
+    return {
+        'member_count': member_count,
+        'full_time_count': full_time_count,
+        'part_time_count': member_count - full_time_count,
+        'device_count': len(ArpLog.objects.for_range(midnight, now)),
+        'dropin_count': CoworkingDay.objects.filter(visit_date=now.date()).count(),
+        'here_today': here_today(),
+    }
+
+
+def here_today():
+    domain = Site.objects.get_current().domain
+    users = User.helper.here_today().select_related('profile', 'profile__industry').prefetch_related('profile__tags').order_by('first_name')
+    plans = dict(Membership.objects.active_memberships().filter(user__in=users).values_list('user', 'membership_plan__name'))
+    results = []
+    for u in users:
+        member_dict = {"username": u.username, "name": u.get_full_name()}
+        if u.profile.photo:
+            member_dict["photo"] = "http://%s%s%s" % (domain, settings.MEDIA_URL, u.profile.photo)
+            member_dict["thumbnail"] = "http://%s%s" % (domain, imagetags.fit_image(u.profile.photo.url, '170x170'))
+        member_dict["industry"] = u.profile.industry.name if u.profile.industry else None
+        if u.id in plans:
+            member_dict["membership"] = plans[u.id]
+        else:
+            member_dict["membership"] = str(u.profile.membership_type())
+        member_dict["tags"] = [t.name for t in u.profile.tags.all()]
+        results.append(member_dict)
+    return results
+
+
+def snapshot():
+    """Returns today's payload serialized along with its ETag, building it only when the cached one is gone or stale."""
+    today = timezone.localtime(timezone.now()).date()
+    cached = cache.get(ACTIVITY_SNAPSHOT_KEY)
+    if cached and cached['date'] == today:
+        return cached
+    body = json.dumps(build_payload(), cls=DjangoJSONEncoder, sort_keys=True)
+    cached = {
+        'date': today,
+        'body': body,
+        'etag': '"%s"' % hashlib.sha1(body.encode('utf-8')).hexdigest(),
+    }
+    cache.set(ACTIVITY_SNAPSHOT_KEY, cached, ACTIVITY_SNAPSHOT_TIMEOUT)
+    return cached
+
+
+def etag_matches(request, etag):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+
+def snapshot_response(request):
+    cached = snapshot()
+    if etag_matches(request, cached['etag']):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(cached['body'], content_type='application/json')
+    response['ETag'] = cached['etag']
+    return response
+
+# Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
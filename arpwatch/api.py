@@ -1,3 +1,4 @@
+import json
 import traceback
 
 from tastypie import fields
@@ -19,11 +20,7 @@ from django.contrib.admin.views.decorators import staff_member_required
 from django.http import HttpResponse, Http404, HttpResponseServerError, HttpResponseRedirect, HttpResponsePermanentRedirect
 from django.utils import timezone
 
-import arp
-from arpwatch.models import UserDevice, ArpLog
-from nadine.models.membership import Membership
-from nadine.models.usage import CoworkingDay
-from staff.templatetags import imagetags
+from arpwatch.activity import snapshot, snapshot_response
 
 
 class ActivityModel(object):
@@ -33,34 +30,14 @@ class ActivityModel(object):
     '''
 
     def __init__(self):
-        now = timezone.localtime(timezone.now())
-        midnight = now - timedelta(seconds=now.hour * 60 * 60 + now.minute * 60 + now.second) - timedelta(minutes=1)
-        # These are the values which are directly exposed via the ActivityModel
-        active_members = User.helper.active_members()
-        self.member_count = len(active_members)
-        self.full_time_count = Membership.objects.active_memberships().filter(has_desk=True).count()
-        self.part_time_count = self.member_count - self.full_time_count
-        self.device_count = len(ArpLog.objects.for_range(midnight, now))
-        self.dropin_count = CoworkingDay.objects.filter(visit_date__gt=midnight).count()
-
-    @property
-    def here_today(self):
-        '''This property is exposed in the ActivityModel'''
-        results = []
-        for u in User.helper.here_today()
-            member_dict = {"username": u.username, "name": u.get_full_name()}
-            if(u.profile.photo):
-                member_dict["photo"] = "http://%s%s%s" % (Site.objects.get_current().domain, settings.MEDIA_URL, u.profile.photo)
-                member_dict["thumbnail"] = "http://%s%s" % (Site.objects.get_current().domain, imagetags.fit_image(u.profile.photo.url, '170x170'))
-            member_dict["industry"] = u.profile.industry
-            membership = u.profile.membership_type()
-            member_dict["membership"] = membership
-            tags = []
-            for t in u.profile.tags.all():
-                tags.append(t)
-            member_dict["tags"] = tags
-            results.append(member_dict)
-        return results
+        # The values are built once per change in who is here and shared by every request
+        payload = json.loads(snapshot()['body'])
+        self.member_count = payload['member_count']
+        self.full_time_count = payload['full_time_count']
+        self.part_time_count = payload['part_time_count']
+        self.device_count = payload['device_count']
+        self.dropin_count = payload['dropin_count']
+        self.here_today = payload['here_today']
 
 
 class ActivityResource(Resource):
@@ -90,3 +67,7 @@ class ActivityResource(Resource):
     def obj_get_list(self, request=None, **kwargs): return self.get_object_list(request)
 
     def obj_get(self, request=None, **kwargs): return ActivityModel()
+
+    def get_detail(self, request, **kwargs):
+        # Serve the cached body directly, answering If-None-Match with a 304
+        return snapshot_response(request)
@@ -1,17 +1,25 @@
+import io
 import os
+import re
 import time
 import logging
+import threading
 from datetime import datetime, time, date, timedelta
-
-from pysnmp.entity.rfc3413.oneliner import cmdgen
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-from django.db import transaction
+from django.core.cache import cache
+from django.db import transaction, connection, IntegrityError
+from django.db.models import Case, When, Value, IntegerField, Min, Max
+from django.utils import six
 from django.utils import timezone
 
 from arpwatch.models import *
+from arpwatch.snmp import collect_arp_tables
+from nadine.models.usage import Presence
 
 logger = logging.getLogger(__name__)
 
@@ -22,14 +30,54 @@ def register_user_ip(user, ip):
     ip_log = UserRemoteAddr.objects.create(logintime=logtime, user=user, ip_address=ip)
 
 
+# Cache keys for the IP to (device id, runtime) map refreshed after each import
+IP_MAP_KEY = 'arpwatch_ip_map'
+IP_MAP_VERSION_KEY = 'arpwatch_ip_map_version'
+IP_MAP_WINDOW = timedelta(minutes=30)
+
+
+def refresh_ip_map():
+    """Caches the last device seen on each IP in the past half hour as a new version of the map so all workers switch together."""
+    end_ts = timezone.now()
+    ip_map = {}
+    arp_logs = ArpLog.objects.filter(runtime__gte=end_ts - IP_MAP_WINDOW, runtime__lte=end_ts).order_by('runtime')
+    for ip, device_id, runtime in arp_logs.values_list('ip_address', 'device', 'runtime'):
+        ip_map[ip] = (device_id, runtime)
+    # Readers fall back to the database until the map for the new version is in place
+    version = next_ip_map_version()
+    cache.set(IP_MAP_KEY, ip_map, int(IP_MAP_WINDOW.total_seconds()), version=version)
+    return ip_map
+
+
+def next_ip_map_version():
+    # Bump the version atomically so refreshes running at the same time never share one
+    try:
+        return cache.incr(IP_MAP_VERSION_KEY)
+    except ValueError:
+        if cache.add(IP_MAP_VERSION_KEY, 1, None):
+            return 1
+        return cache.incr(IP_MAP_VERSION_KEY)
+
+
+def cached_ip_map():
+    version = cache.get(IP_MAP_VERSION_KEY)
+    if version is None:
+        return None
+    return cache.get(IP_MAP_KEY, version=version)
+
+
 def device_by_ip(ip):
     end_ts = timezone.localtime(timezone.now())
-    start_ts = end_ts - timedelta(minutes=30)
+    start_ts = end_ts - IP_MAP_WINDOW
+    ip_map = cached_ip_map()
+    if ip_map and ip in ip_map:
+        device_id, runtime = ip_map[ip]
+        if runtime >= start_ts:
+            return UserDevice.objects.filter(pk=device_id).first()
     logs = ArpLog.objects.filter(ip_address=ip, runtime__gte=start_ts, runtime__lte=end_ts).order_by('runtime').reverse()
-    if logs.count() > 0:
-        latest_log = logs[0]
-        if latest_log:
-            return latest_log.device
+    latest_log = logs.select_related('device').first()
+    if latest_log:
+        return latest_log.device
 
 
 def devices_by_user(user):
@@ -39,17 +87,52 @@ def devices_by_user(user):
 def map_ip_to_mac(hours):
     end_ts = timezone.localtime(timezone.now())
     start_ts = end_ts - timedelta(hours=hours)
+    window = timedelta(minutes=6)
     logger.debug("map_ip_to_mac: start=%s, end=%s" % (start_ts, end_ts))
-    ip_logs = UserRemoteAddr.objects.filter(logintime__gte=start_ts, logintime__lte=end_ts)
-    for i in ip_logs:
-        #print("ip_log: %s" % (i))
-        arp_logs = ArpLog.objects.filter(ip_address=i.ip_address, runtime__gte=i.logintime - timedelta(minutes=6), runtime__lte=i.logintime + timedelta(minutes=6))[:1]
-        for a in arp_logs:
-            #print("arp_log: %s" % (a))
-            if not a.device.ignore and not a.device.user:
-                logger.info("map_ip_to_mac: Associating %s with %s" % (a.device.mac_address, i.user))
-                a.device.user = i.user
-                a.device.save()
+
+    # Load the logins and the arp sightings around them, grouped by IP and sorted by time
+    logins = {}
+    for ip, logintime, user_id in UserRemoteAddr.objects.filter(logintime__gte=start_ts, logintime__lte=end_ts).values_list('ip_address', 'logintime', 'user'):
+        logins.setdefault(ip, []).append((logintime, user_id))
+    if not logins:
+        return {}
+    sightings = {}
+    arp_logs = ArpLog.objects.filter(ip_address__in=logins.keys(), runtime__gte=start_ts - window, runtime__lte=end_ts + window)
+    for ip, runtime, device_id, ignore, device_user_id in arp_logs.values_list('ip_address', 'runtime', 'device', 'device__ignore', 'device__user'):
+        sightings.setdefault(ip, []).append((runtime, device_id, ignore, device_user_id))
+
+    # Walk each IP's logins and sightings together, matching each login to the last sighting within the window
+    matches = []
+    for ip, ip_logins in logins.items():
+        ip_sightings = sorted(sightings.get(ip, []))
+        latest = None
+        i = 0
+        for logintime, user_id in sorted(ip_logins):
+            while i < len(ip_sightings) and ip_sightings[i][0] <= logintime + window:
+                latest = ip_sightings[i]
+                i += 1
+            if latest and latest[0] >= logintime - window:
+                runtime, device_id, ignore, device_user_id = latest
+                if not ignore and not device_user_id:
+                    matches.append((logintime, device_id, user_id))
+
+    # The most recent login claims the device
+    assignments = {}
+    for logintime, device_id, user_id in sorted(matches, reverse=True):
+        assignments.setdefault(device_id, user_id)
+    if not assignments:
+        return {}
+    for device_id, user_id in assignments.items():
+        logger.info("map_ip_to_mac: Associating device %s with user %s" % (device_id, user_id))
+    whens = [When(id=device_id, then=Value(user_id)) for device_id, user_id in assignments.items()]
+    UserDevice.objects.filter(id__in=assignments.keys(), user__isnull=True).update(user_id=Case(*whens, output_field=IntegerField()))
+
+    # A bulk update skips the post_save signal so count the time these devices have been seen today here
+    today_start = end_ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    seen_today = ArpLog.objects.filter(device__in=assignments.keys(), runtime__gte=today_start).order_by().values('device')
+    for seen in seen_today.annotate(first=Min('runtime'), last=Max('runtime')):
+        Presence.objects.record(assignments[seen['device']], end_ts.date(), Presence.ARP, seen['first'], seen['last'])
+    return assignments
 
 
 def get_arp_root():
@@ -66,21 +149,6 @@ def list_files():
     return file_list
 
 
-def import_dir_locked():
-    arp_root = get_arp_root()
-    return default_storage.exists(settings.ARP_IMPORT_LOCK)
-
-
-def lock_import_dir():
-    arp_root = get_arp_root()
-    msg = "locked: %s" % timezone.localtime(timezone.now())
-    default_storage.save(settings.ARP_IMPORT_LOCK, ContentFile(msg))
-
-
-def unlock_import_dir():
-    default_storage.delete(settings.ARP_IMPORT_LOCK)
-
-
 def log_message(msg):
     arp_root = get_arp_root()
     log = "%s: %s\r\n" % (timezone.localtime(timezone.now()), msg)
@@ -91,34 +159,130 @@ def log_message(msg):
     log_file.close()
 
 
-def import_all():
-    if import_dir_locked():
-        return
+# Key for the PostgreSQL advisory lock held while importing
+IMPORT_LOCK_KEY = 0x41525057
 
-    # Lock the import directory
-    lock_import_dir()
 
-    file_list = default_storage.listdir(settings.ARP_ROOT)[1]
-    for file_name in file_list:
-        # Expects filename like: arp-111101-0006.txt
-        if file_name.find("arp-") < 0:
-            continue
-        runtime_str = file_name.lstrip(settings.ARP_ROOT)
-        runtime_str = runtime_str.lstrip("arp-").rstrip(".txt")
-        # TODO - Test the following line for an AmbiguousTimeError.  Delete the file and move on if so.  It's daylight savings.
-        runtime = timezone.make_aware(datetime.strptime(runtime_str, "%y%m%d-%H%M"), timezone.get_current_timezone())
-        full_path = settings.ARP_ROOT + file_name
-        file = default_storage.open(full_path)
-        log_message("importing %s" % file_name)
-        ImportLog.objects.create(file_name=file_name, success=False)
-        import_file(file, runtime)
+# PostgreSQL hands a session its own advisory lock again so this keeps a second import in this process out
+process_import_lock = threading.Lock()
+
+
+@contextmanager
+def import_lock():
+    """Yields True if we got the lock and can import, using an advisory lock on PostgreSQL and an ImportLock row elsewhere."""
+    if not process_import_lock.acquire(False):
+        yield False
+        return
+    try:
+        with database_import_lock() as locked:
+            yield locked
+    finally:
+        process_import_lock.release()
+
+
+@contextmanager
+def database_import_lock():
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", [IMPORT_LOCK_KEY])
+            locked = cursor.fetchone()[0]
+        try:
+            yield locked
+        finally:
+            if locked:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", [IMPORT_LOCK_KEY])
+    else:
+        locked = ImportLock.objects.acquire('arp')
+        try:
+            yield locked
+        finally:
+            if locked:
+                ImportLock.objects.release('arp')
+
+
+def parse_runtime(file_name):
+    # Expects filename like: arp-111101-0006.txt
+    match = re.match(r'^arp-(\d{6}-\d{4})\.txt$', file_name)
+    if not match:
+        return None
+    # TODO - Test the following line for an AmbiguousTimeError.  Delete the file and move on if so.  It's daylight savings.
+    return timezone.make_aware(datetime.strptime(match.group(1), "%y%m%d-%H%M"), timezone.get_current_timezone())
+
+
+def pending_files():
+    """Returns a list of (runtime, file_name) waiting in the import directory, oldest first."""
+    pending = []
+    for file_name in default_storage.listdir(get_arp_root())[1]:
+        runtime = parse_runtime(file_name)
+        if runtime:
+            pending.append((runtime, file_name))
+    return sorted(pending)
+
+
+def import_all(workers=None):
+    if workers is None:
+        workers = settings.ARP_IMPORT_WORKERS
+    if connection.vendor == 'sqlite':
+        # SQLite only allows one writer at a time
+        workers = 1
+
+    with import_lock() as locked:
+        if not locked:
+            return []
+
+        pending = pending_files()
+        if workers > 1 and len(pending) > 1:
+            pool = ThreadPool(min(workers, len(pending)))
+            try:
+                import_logs = pool.map(import_pending_file_thread, pending)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            import_logs = [import_pending_file(p) for p in pending]
+
+        if import_logs:
+            after_import([l.runtime for l in import_logs if l.success])
+
+    if import_logs:
+        failed = len([l for l in import_logs if not l.success])
+        log_message("imported %d files, %d failed" % (len(import_logs) - failed, failed))
+    return import_logs
+
+
+def import_pending_file(pending):
+    runtime, file_name = pending
+    full_path = settings.ARP_ROOT + file_name
+    log = ImportLog.objects.create(file_name=file_name, runtime=runtime, success=False)
+    try:
+        started = timezone.now()
+        with default_storage.open(full_path) as file:
+            entries = parse_arp_file(file)
+        log.parse_time = (timezone.now() - started).total_seconds()
+
+        started = timezone.now()
+        with transaction.atomic():
+            arp_logs = bulk_log_data(runtime, entries)
+        record_presence(arp_logs)
+        log.insert_time = (timezone.now() - started).total_seconds()
+        log.entry_count = len(arp_logs)
+
         default_storage.delete(full_path)
-        log = ImportLog.objects.filter(file_name=file_name).order_by('created')[0]
         log.success = True
-        log.save()
+    except Exception as e:
+        logger.exception("Failed to import %s" % file_name)
+        log_message("failed to import %s: %s" % (file_name, e))
+    log.save()
+    return log
+
 
-    # Unlock the import directory
-    unlock_import_dir()
+def import_pending_file_thread(pending):
+    # Each worker thread has its own database connection which must be closed when done
+    try:
+        return import_pending_file(pending)
+    finally:
+        connection.close()
 
 
 def import_file(file):
@@ -126,38 +290,92 @@ def import_file(file):
 
 
 def import_file(file, runtime):
+    entries = parse_arp_file(file)
     with transaction.atomic():
-        for chunk in file.chunks():
-            for line in chunk.splitlines():
-                # Expect line like:
-                # ? (172.16.5.153) at 00:1b:21:4e:e7:2c on sk4 expires in 1169 seconds [ethernet]
-                ip = line.split("(")[1].split(") at ")[0]
-                mac = line.split(") at ")[1].split(" on ")[0]
-
-                # Stop me if you think that you've heard this one before
-                if ArpLog.objects.filter(runtime=runtime, ip_address=ip).count() > 0:
-                    log_message("Data For This Time Already Loaded: %s" % runtime)
-                    return
+        arp_logs = bulk_log_data(runtime, entries)
+    if len(arp_logs) < len(entries):
+        log_message("Data For This Time Already Loaded: %s (%d of %d entries)" % (runtime, len(entries) - len(arp_logs), len(entries)))
+    record_presence(arp_logs)
+    after_import([runtime])
+
+
+def after_import(runtimes):
+    # Bring the sessions around what we just imported up to date along with everything cached from them
+    windows = {}
+    for runtime in runtimes:
+        day = timezone.localtime(runtime).date()
+        first, last = windows.get(day, (runtime, runtime))
+        windows[day] = (min(first, runtime), max(last, runtime))
+    for first, last in windows.values():
+        DeviceSession.objects.rollup_window(first, last)
+    refresh_ip_map()
+    cache.delete(ACTIVITY_SNAPSHOT_KEY)
+
+
+def parse_arp_file(file):
+    """Returns a list of (ip, mac) from an arp dump, keeping the first entry for each IP."""
+    entries = OrderedDict()
+    for line in file:
+        # Expect line like:
+        # ? (172.16.5.153) at 00:1b:21:4e:e7:2c on sk4 expires in 1169 seconds [ethernet]
+        if "(" not in line or ") at " not in line:
+            continue
+        ip = line.split("(")[1].split(") at ")[0]
+        mac = line.split(") at ")[1].split(" on ")[0]
+        if ip not in entries:
+            entries[ip] = mac
+    return entries.items()
 
-                log_data(runtime, ip, mac)
 
-def import_snmp():
+def import_snmp(agents=None):
     runtime = timezone.now()
+    entries = [(ip, mac) for ip, mac in collect_arp_tables(agents) if ip.startswith(settings.ARPWATCH_NETWORK_PREFIX)]
+    with transaction.atomic():
+        arp_logs = bulk_log_data(runtime, entries)
+    record_presence(arp_logs)
+    after_import([runtime])
+
+
+def bulk_log_data(runtime, entries):
+    """Logs a list of (ip, mac) seen at runtime, creating any new devices, and skipping IPs already logged for this runtime."""
+    if not entries:
+        return []
+
+    # Resolve every MAC address at once and create the devices we have never seen
+    macs = set(mac for ip, mac in entries)
+    devices = dict((d.mac_address, d) for d in UserDevice.objects.filter(mac_address__in=macs))
+    new_macs = macs - set(devices.keys())
+    if new_macs:
+        create_devices(new_macs)
+        devices.update((d.mac_address, d) for d in UserDevice.objects.filter(mac_address__in=new_macs))
+
+    # Stop me if you think that you've heard this one before
+    logged = set(ArpLog.objects.filter(runtime=runtime, ip_address__in=[ip for ip, mac in entries]).values_list('ip_address', flat=True))
+    arp_logs = [ArpLog(runtime=runtime, ip_address=ip, device=devices[mac]) for ip, mac in entries if ip not in logged]
+    if connection.vendor == 'postgresql':
+        copy_arp_logs(arp_logs)
+    else:
+        ArpLog.objects.bulk_create(arp_logs)
+    return arp_logs
 
-    cmdGen = cmdgen.CommandGenerator()
-    errorIndication, errorStatus, errorIndex, varBinds = cmdGen.nextCmd(
-        cmdgen.CommunityData(settings.ARPWATCH_SNMP_COMMUNITY),
-        cmdgen.UdpTransportTarget((settings.ARPWATCH_SNMP_SERVER, 161)),
-        cmdgen.MibVariable('IP-MIB', 'ipNetToMediaPhysAddress'),
-        lookupNames=True, lookupValues=True
-    )
 
-    for row in varBinds:
-        for name, val in row:
-            ip = name.prettyPrint().split('\"')[3]
-            mac = val.prettyPrint()
-            if ip.startswith(settings.ARPWATCH_NETWORK_PREFIX):
-                log_data(runtime, ip, mac)
+def create_devices(macs):
+    """Creates a device for each MAC address, which another import running alongside us may be creating too."""
+    try:
+        with transaction.atomic():
+            UserDevice.objects.bulk_create([UserDevice(mac_address=mac) for mac in macs])
+    except IntegrityError:
+        # Someone beat us to at least one of them so go one at a time, picking up theirs
+        for mac in macs:
+            UserDevice.objects.get_or_create(mac_address=mac)
+
+
+def copy_arp_logs(arp_logs):
+    # COPY is the fastest way to get rows into PostgreSQL
+    columns = [ArpLog._meta.get_field(f).column for f in ('runtime', 'ip_address', 'device')]
+    rows = ["%s\t%s\t%s\n" % (a.runtime.isoformat(), a.ip_address, a.device_id) for a in arp_logs]
+    with connection.cursor() as cursor:
+        cursor.copy_from(io.StringIO(six.text_type("".join(rows))), ArpLog._meta.db_table, columns=columns)
 
 
 def log_data(runtime, ip, mac):
@@ -171,6 +389,11 @@ def log_data(runtime, ip, mac):
     return ArpLog.objects.create(runtime=runtime, ip_address=ip, device=device)
 
 
+def record_presence(arp_logs):
+    sightings = [(a.device.user_id, a.runtime) for a in arp_logs if a.device.user_id and not a.device.ignore]
+    Presence.objects.record_many(sightings, Presence.ARP)
+
+
 def day_is_complete(day_str):
     # Return true if there are evenly spaced logs throughout the day
     day_start = datetime.strptime(day_str + " 00:00", "%Y-%m-%d %H:%M")
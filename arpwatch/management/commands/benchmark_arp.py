@@ -0,0 +1,100 @@
+import time
+import logging
+from datetime import timedelta
+from collections import OrderedDict, namedtuple
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from arpwatch.models import ArpLog, DeviceSession, UserDevice, day_bounds
+
+
+def raw_for_range(day_start, day_end):
+    """ArpLog_Manager.for_range as it was before device sessions, reading every ArpLog in the range."""
+    device_logs = OrderedDict()
+    DeviceLog = namedtuple('DeviceLog', 'device, start, end, diff')
+    for arp_log in ArpLog.objects.filter(runtime__gte=day_start, runtime__lte=day_end, device__ignore=False).order_by('runtime'):
+        key = arp_log.device.mac_address
+        if key in device_logs:
+            start = device_logs[key].start
+            end = arp_log.runtime
+            device_logs[key] = DeviceLog(arp_log.device, start, end, end - start)
+        else:
+            start = end = arp_log.runtime
+            device_logs[key] = DeviceLog(arp_log.device, start, end, 0)
+    return device_logs.values()
+
+
+class QueryCounter(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class Command(BaseCommand):
+    help = "Times ArpLog.objects.for_range against a day of generated arp logs, which are rolled back afterwards."
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, dest='rows', default=1000000)
+        parser.add_argument('--devices', type=int, dest='devices', default=3500)
+        parser.add_argument('--skip-raw', action='store_true', dest='skip_raw', default=False, help="Do not time the old per-row algorithm")
+
+    def time_it(self, label, function, *args):
+        # connection.queries only holds the last 9000 so count them as they are logged
+        counter = QueryCounter()
+        db_logger = logging.getLogger('django.db.backends')
+        saved = (db_logger.level, db_logger.propagate, connection.force_debug_cursor)
+        db_logger.setLevel(logging.DEBUG)
+        db_logger.propagate = False
+        db_logger.addHandler(counter)
+        connection.force_debug_cursor = True
+        try:
+            started = time.time()
+            result = function(*args)
+            elapsed = time.time() - started
+        finally:
+            db_logger.removeHandler(counter)
+            db_logger.level, db_logger.propagate, connection.force_debug_cursor = saved
+        print("%-10s %8d queries %10.3f seconds" % (label, counter.count, elapsed))
+        return result
+
+    def handle(self, **options):
+        rows = options['rows']
+        device_count = options['devices']
+        day = timezone.localtime(timezone.now()).date() - timedelta(days=1)
+        day_start, day_end = day_bounds(day)
+
+        with transaction.atomic():
+            macs = ["02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff) for i in range(device_count)]
+            UserDevice.objects.bulk_create([UserDevice(mac_address=mac) for mac in macs])
+            device_ids = list(UserDevice.objects.filter(mac_address__in=macs).values_list('id', flat=True))
+
+            # Every device seen on each scan until we have enough rows
+            started = time.time()
+            arp_logs = []
+            runtime = day_start
+            while len(arp_logs) < rows:
+                for i, device_id in enumerate(device_ids):
+                    arp_logs.append(ArpLog(runtime=runtime, device_id=device_id, ip_address="10.%d.%d.%d" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)))
+                    if len(arp_logs) == rows:
+                        break
+                runtime = runtime + timedelta(seconds=max(1, 86400 * device_count // rows))
+            ArpLog.objects.bulk_create(arp_logs)
+            del arp_logs
+            print("%d arp logs for %d devices created in %.1f seconds" % (rows, device_count, time.time() - started))
+
+            self.time_it("Rollup", DeviceSession.objects.rollup, day)
+            if not options['skip_raw']:
+                self.time_it("Raw", lambda: len(raw_for_range(day_start, day_end)))
+            self.time_it("Sessions", lambda: len(ArpLog.objects.for_range(day_start, day_end)))
+
+            # Leave the database as we found it
+            transaction.set_rollback(True)
+
+# Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -14,8 +14,11 @@ class Command(BaseCommand):
 
     requires_system_checks = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, dest='workers', default=None, help="Number of files to import at the same time (default ARP_IMPORT_WORKERS)")
+
     def handle(self, **options):
-        arp.import_all()
+        arp.import_all(workers=options['workers'])
         arp.map_ip_to_mac(1)
 
 
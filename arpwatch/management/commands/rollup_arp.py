@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from arpwatch.models import ArpLog, DeviceSession
+
+
+class Command(BaseCommand):
+    help = "Rolls the arp logs up into device sessions and deletes the old raw logs."
+    requires_system_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', dest='rebuild', default=False, help="Rebuild the sessions for every day we have arp logs for")
+        parser.add_argument('--retention', type=int, dest='retention', default=None, help="Days of raw arp logs to keep (default ARP_RETENTION_DAYS)")
+
+    def handle(self, **options):
+        start = time.time()
+        today = timezone.localtime(timezone.now()).date()
+        if options['rebuild']:
+            days = [d.date() for d in ArpLog.objects.datetimes('runtime', 'day')]
+        else:
+            days = [today - timedelta(days=1), today]
+        session_count = 0
+        for day in days:
+            session_count += DeviceSession.objects.rollup(day)
+
+        retention = options['retention']
+        if retention is None:
+            retention = settings.ARP_RETENTION_DAYS
+        if retention < 0:
+            raise CommandError("Invalid retention: %d" % retention)
+        before_date = today - timedelta(days=retention)
+        deleted = DeviceSession.objects.purge(before_date)
+        print("Rolled up %d sessions and deleted %d arp logs in %.2f seconds" % (session_count, deleted, time.time() - start))
+
+# Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
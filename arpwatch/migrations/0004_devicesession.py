@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('arpwatch', '0003_import_timing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('first_seen', models.DateTimeField(db_index=True)),
+                ('last_seen', models.DateTimeField(db_index=True)),
+                ('ip_addresses', models.TextField(blank=True, default=b'')),
+                ('sample_count', models.IntegerField(default=0)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='arpwatch.UserDevice')),
+            ],
+            options={
+                'ordering': ['-first_seen'],
+            },
+        ),
+    ]
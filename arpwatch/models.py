@@ -8,11 +8,15 @@ from django.contrib import admin
 from django.core import urlresolvers
 from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_in
-from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
 from django.db.models import Min, Max
 from django.utils import timezone
+from django.conf import settings
 
 from nadine.models.membership import Membership
+from nadine.models.usage import Presence, presence_changed
 from nadine.utils import network
 
 logger = logging.getLogger(__name__)
@@ -36,6 +40,18 @@ class UserDevice(models.Model):
         return self.mac_address
 
 
+def device_presence_callback(sender, **kwargs):
+    # Claiming a device counts the time it has already been seen today
+    device = kwargs['instance']
+    if device.user_id and not device.ignore:
+        now = timezone.localtime(timezone.now())
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        seen = device.arplog_set.filter(runtime__gte=start).aggregate(first=Min('runtime'), last=Max('runtime'))
+        if seen['first']:
+            Presence.objects.record(device.user_id, now.date(), Presence.ARP, seen['first'], seen['last'])
+post_save.connect(device_presence_callback, sender=UserDevice)
+
+
 class UserRemoteAddr(models.Model):
     logintime = models.DateTimeField(blank=False)
     user = models.ForeignKey(User, blank=False, null=False, unique=False)
@@ -62,48 +78,34 @@ user_logged_in.connect(register_user_ip)
 class ArpLog_Manager(models.Manager):
 
     def for_range(self, day_start, day_end):
-        device_logs = OrderedDict()
         DeviceLog = namedtuple('DeviceLog', 'device, start, end, diff')
-        for arp_log in ArpLog.objects.filter(runtime__gte=day_start, runtime__lte=day_end, device__ignore=False).order_by('runtime'):
-            key = arp_log.device.mac_address
-            if key in device_logs:
-                start = device_logs[key].start
-                end = arp_log.runtime
-                device_logs[key] = DeviceLog(arp_log.device, start, end, end - start)
-            else:
-                # Create a new device log
-                start = end = arp_log.runtime
-                device_logs[key] = DeviceLog(arp_log.device, start, end, 0)
-        return device_logs.values()
+        devices = UserDevice.objects.filter(ignore=False, devicesession__last_seen__gte=day_start, devicesession__first_seen__lte=day_end)
+        devices = devices.annotate(session_start=Min('devicesession__first_seen'), session_end=Max('devicesession__last_seen'))
+        device_logs = []
+        for device in devices.select_related('user').order_by('session_start'):
+            start = max(device.session_start, day_start)
+            end = min(device.session_end, day_end)
+            device_logs.append(DeviceLog(device, start, end, end - start if end > start else 0))
+        return device_logs
 
     def for_device(self, device_id):
         DeviceLog = namedtuple('DeviceLog', 'ip, day')
-        sql = "select ip_address, date_trunc('day', runtime) from arpwatch_arplog where device_id = %s group by 1, 2 order by 2 desc;"
-        sql = sql % (device_id)
-        cursor = connection.cursor()
-        cursor.execute(sql)
-        device_logs = []
-        for row in cursor.fetchall():
-            device_logs.append(DeviceLog(row[0], row[1]))
-        return device_logs
+        device_logs = OrderedDict()
+        for session in DeviceSession.objects.filter(device_id=device_id).order_by('-date', 'first_seen'):
+            for ip in session.ip_list:
+                device_logs[(ip, session.date)] = DeviceLog(ip, session.date)
+        return device_logs.values()
 
     def for_user(self, username, day_start, day_end):
         user = User.objects.get(username=username)
-        device_logs = OrderedDict()
         DeviceLog = namedtuple('DeviceLog', 'start, end, diff')
-        logs = ArpLog.objects.filter(device__user=user, runtime__range=(day_start, day_end)).order_by('runtime')
-        for arp_log in logs:
-            local_time = timezone.localtime(arp_log.runtime)
-            key = local_time.date()
-            if key in device_logs:
-                start = device_logs[key].start
-                end = arp_log.runtime
-                device_logs[key] = DeviceLog(start, end, end - start)
-            else:
-                # Create a new device log
-                start = end = arp_log.runtime
-                device_logs[key] = DeviceLog(start, end, 0)
-        return device_logs.values()
+        sessions = DeviceSession.objects.filter(device__user=user, last_seen__gte=day_start, first_seen__lte=day_end)
+        device_logs = []
+        for day in sessions.values('date').annotate(first_seen=Min('first_seen'), last_seen=Max('last_seen')).order_by('date'):
+            start = max(day['first_seen'], day_start)
+            end = min(day['last_seen'], day_end)
+            device_logs.append(DeviceLog(start, end, end - start if end > start else 0))
+        return device_logs
 
 
 class ArpLog(models.Model):
@@ -121,12 +123,157 @@ class ArpLog(models.Model):
         return '%s: %s = %s' % (self.runtime, self.ip_address, self.device.mac_address)
 
 
+def day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+    return (start, start + timedelta(days=1))
+
+
+class DeviceSessionManager(models.Manager):
+
+    def sessionize(self, sightings, gap):
+        """Turns (device_id, runtime, ip_address) sightings ordered by device and runtime into unsaved sessions,
+        starting a new session whenever a device goes unseen for longer than gap."""
+        sessions = []
+        session = None
+        for device_id, runtime, ip in sightings:
+            if session and session.device_id == device_id and runtime - session.last_seen <= gap:
+                session.last_seen = runtime
+                session.sample_count += 1
+                if ip not in session.ip_list:
+                    session.ip_list.append(ip)
+            else:
+                session = DeviceSession(device_id=device_id, date=timezone.localtime(runtime).date(), first_seen=runtime, last_seen=runtime, sample_count=1)
+                session.ip_list = [ip]
+                sessions.append(session)
+        for session in sessions:
+            session.ip_addresses = ",".join(session.ip_list)
+        return sessions
+
+    def rollup(self, day):
+        """Replaces the sessions for a day with ones built from that day's ArpLogs."""
+        start, end = day_bounds(day)
+        gap = timedelta(minutes=settings.ARP_SESSION_GAP)
+        arp_logs = ArpLog.objects.filter(runtime__gte=start, runtime__lt=end).order_by('device', 'runtime')
+        sessions = self.sessionize(arp_logs.values_list('device', 'runtime', 'ip_address'), gap)
+        with transaction.atomic():
+            self.filter(date=day).delete()
+            self.bulk_create(sessions)
+        return len(sessions)
+
+    def rollup_window(self, start_ts, end_ts):
+        """Rebuilds only the sessions on the day of start_ts that ArpLogs from start_ts through end_ts could have changed,
+        which are the ones within the session gap of that window.  Returns the number of sessions built."""
+        day_start, day_end = day_bounds(timezone.localtime(start_ts).date())
+        gap = timedelta(minutes=settings.ARP_SESSION_GAP)
+        window = (max(start_ts - gap, day_start), min(end_ts + gap, day_end - timedelta(microseconds=1)))
+
+        # Each device's logs are taken from the window stretched to cover the sessions it already has there
+        affected = list(self.filter(date=day_start.date(), last_seen__gte=window[0], first_seen__lte=window[1]))
+        bounds = {}
+        for session in affected:
+            first, last = bounds.get(session.device_id, window)
+            bounds[session.device_id] = (min(first, session.first_seen), max(last, session.last_seen))
+        first = min([window[0]] + [b[0] for b in bounds.values()])
+        last = max([window[1]] + [b[1] for b in bounds.values()])
+        arp_logs = ArpLog.objects.filter(runtime__gte=first, runtime__lte=last).order_by('device', 'runtime')
+        sightings = []
+        for device_id, runtime, ip in arp_logs.values_list('device', 'runtime', 'ip_address'):
+            device_first, device_last = bounds.get(device_id, window)
+            if device_first <= runtime <= device_last:
+                sightings.append((device_id, runtime, ip))
+        sessions = self.sessionize(sightings, gap)
+        with transaction.atomic():
+            self.filter(id__in=[s.id for s in affected]).delete()
+            self.bulk_create(sessions)
+        return len(sessions)
+
+    def purge(self, before_date):
+        """Deletes the ArpLogs from before the given date, rolling up any day which has not been already."""
+        cutoff = day_bounds(before_date)[0]
+        old_logs = ArpLog.objects.filter(runtime__lt=cutoff)
+        rolled_up = set(self.filter(date__lt=before_date).dates('date', 'day'))
+        for log_day in old_logs.datetimes('runtime', 'day'):
+            if log_day.date() not in rolled_up:
+                self.rollup(log_day.date())
+        return old_logs.delete()[0]
+
+
+class DeviceSession(models.Model):
+    """A stretch of time a device was continuously seen on the network, rolled up from the ArpLogs"""
+    objects = DeviceSessionManager()
+    device = models.ForeignKey(UserDevice, null=False)
+    date = models.DateField(db_index=True)
+    first_seen = models.DateTimeField(db_index=True)
+    last_seen = models.DateTimeField(db_index=True)
+    ip_addresses = models.TextField(blank=True, default="")
+    sample_count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['-first_seen']
+
+    @property
+    def ip_list(self):
+        if not hasattr(self, '_ip_list'):
+            self._ip_list = [ip for ip in self.ip_addresses.split(",") if ip]
+        return self._ip_list
+
+    @ip_list.setter
+    def ip_list(self, value):
+        self._ip_list = value
+
+    def __str__(self):
+        return '%s: %s - %s' % (self.device, self.first_seen, self.last_seen)
+
+
+# Cache key for the serialized activity snapshot served to the lobby displays
+ACTIVITY_SNAPSHOT_KEY = 'arpwatch_activity_snapshot'
+
+
+def activity_changed_callback(sender, **kwargs):
+    # The snapshot is rebuilt on the next request
+    cache.delete(ACTIVITY_SNAPSHOT_KEY)
+presence_changed.connect(activity_changed_callback)
+post_save.connect(activity_changed_callback, sender=Membership)
+post_delete.connect(activity_changed_callback, sender=Membership)
+
+
 class ImportLog(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     file_name = models.CharField(max_length=32, blank=False, null=False, db_index=True)
     success = models.BooleanField(default=False)
+    runtime = models.DateTimeField(blank=True, null=True)
+    entry_count = models.IntegerField(default=0)
+    parse_time = models.FloatField(blank=True, null=True)
+    insert_time = models.FloatField(blank=True, null=True)
 
     def __str__(self):
         return '%s: %s = %s' % (self.created, self.file_name, self.success)
 
+
+class ImportLockManager(models.Manager):
+
+    def acquire(self, name):
+        # Clear out a lock left behind by an import which died
+        stale = timezone.now() - timedelta(hours=1)
+        self.filter(name=name, locked_ts__lt=stale).delete()
+        try:
+            with transaction.atomic():
+                self.create(name=name)
+            return True
+        except IntegrityError:
+            return False
+
+    def release(self, name):
+        self.filter(name=name).delete()
+
+
+class ImportLock(models.Model):
+    """Held while an import runs on databases without advisory locks"""
+    objects = ImportLockManager()
+    name = models.CharField(max_length=32, unique=True)
+    locked_ts = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.name, self.locked_ts)
+
 # Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
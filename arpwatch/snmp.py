@@ -0,0 +1,87 @@
+import logging
+from multiprocessing.pool import ThreadPool
+
+from pysnmp.entity.rfc3413.oneliner import cmdgen
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# IP-MIB::ipNetToMediaPhysAddress, indexed by ifIndex and then the IP address
+IP_NET_TO_MEDIA_PHYS_ADDRESS = (1, 3, 6, 1, 2, 1, 4, 22, 1, 2)
+
+
+class SNMPAgent(object):
+    """A switch or router we can read the ARP table from"""
+
+    def __init__(self, host, community=None, port=161, timeout=None, retries=1, max_repetitions=None):
+        self.host = host
+        self.community = community or settings.ARPWATCH_SNMP_COMMUNITY
+        self.port = port
+        self.timeout = timeout or settings.ARPWATCH_SNMP_TIMEOUT
+        self.retries = retries
+        self.max_repetitions = max_repetitions or settings.ARPWATCH_SNMP_MAX_REPETITIONS
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def arp_table(self):
+        """Returns a list of (ip, mac) using GETBULK requests, or an empty list if the agent could not be read."""
+        generator = cmdgen.CommandGenerator()
+        errorIndication, errorStatus, errorIndex, varBindTable = generator.bulkCmd(
+            cmdgen.CommunityData(self.community),
+            cmdgen.UdpTransportTarget((self.host, self.port), timeout=self.timeout, retries=self.retries),
+            0, self.max_repetitions,
+            IP_NET_TO_MEDIA_PHYS_ADDRESS,
+        )
+        if errorIndication or errorStatus:
+            logger.warning("arp_table: Could not read %s: %s" % (self, errorIndication or errorStatus.prettyPrint()))
+            return []
+
+        entries = []
+        for row in varBindTable:
+            for name, val in row:
+                oid = tuple(name)
+                if oid[:len(IP_NET_TO_MEDIA_PHYS_ADDRESS)] != IP_NET_TO_MEDIA_PHYS_ADDRESS:
+                    continue
+                ip = ".".join(str(i) for i in oid[-4:])
+                mac = ":".join("%02x" % ord(c) for c in val.asOctets())
+                entries.append((ip, mac))
+        return entries
+
+
+def configured_agents():
+    agents = getattr(settings, 'ARPWATCH_SNMP_AGENTS', None)
+    if not agents:
+        agents = [{'host': settings.ARPWATCH_SNMP_SERVER}]
+    return [SNMPAgent(**a) for a in agents]
+
+
+def agent_arp_table(agent):
+    return agent.arp_table()
+
+
+def collect_arp_tables(agents=None):
+    """Polls the agents at the same time and returns their combined ARP table as a list of (ip, mac)."""
+    if agents is None:
+        agents = configured_agents()
+    if not agents:
+        return []
+    pool = ThreadPool(len(agents))
+    try:
+        tables = pool.map(agent_arp_table, agents)
+    finally:
+        pool.close()
+        pool.join()
+
+    # An address seen by more than one agent is kept from the first one listed
+    seen = set()
+    entries = []
+    for table in tables:
+        for ip, mac in table:
+            if ip not in seen:
+                seen.add(ip)
+                entries.append((ip, mac))
+    return entries
+
+# Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
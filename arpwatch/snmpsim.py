@@ -0,0 +1,133 @@
+import bisect
+import socket
+import logging
+import threading
+
+from pyasn1.codec.ber import decoder, encoder
+from pysnmp.proto import api, rfc1905
+
+logger = logging.getLogger(__name__)
+
+
+def read_snmprec(path):
+    """Reads an snmpsim style data file of OID|TAG|VALUE lines into a sorted list of (oid, tag, value)."""
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            oid, tag, value = line.split('|', 2)
+            records.append((tuple(int(i) for i in oid.split('.')), tag, value))
+    return sorted(records)
+
+
+class FixtureAgent(threading.Thread):
+    """A local SNMP v1/v2c agent answering GET, GETNEXT and GETBULK from an snmprec file, for testing without a switch."""
+
+    def __init__(self, snmprec_path, community='public', host='127.0.0.1', port=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.records = read_snmprec(snmprec_path)
+        self.oids = [r[0] for r in self.records]
+        self.community = community
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.5)
+        self.host, self.port = self.socket.getsockname()
+        self.request_count = 0
+        self.running = True
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.socket.close()
+
+    def run(self):
+        while self.running:
+            try:
+                message, address = self.socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            try:
+                response = self.respond(message)
+            except Exception:
+                logger.exception("FixtureAgent: Could not answer request")
+                continue
+            if response:
+                self.request_count += 1
+                self.socket.sendto(response, address)
+
+    def value(self, pMod, tag, value):
+        if tag == '2':
+            return pMod.Integer(int(value))
+        if tag == '4x':
+            return pMod.OctetString(hexValue=value)
+        if tag == '64':
+            return pMod.IpAddress(value)
+        return pMod.OctetString(value)
+
+    def get(self, oid):
+        i = bisect.bisect_left(self.oids, oid)
+        if i < len(self.records) and self.oids[i] == oid:
+            return self.records[i]
+        return None
+
+    def get_next(self, oid):
+        i = bisect.bisect_right(self.oids, oid)
+        if i < len(self.records):
+            return self.records[i]
+        return None
+
+    def respond(self, message):
+        pMod = api.protoModules[int(api.decodeMessageVersion(message))]
+        request, message = decoder.decode(message, asn1Spec=pMod.Message())
+        if str(pMod.apiMessage.getCommunity(request)) != self.community:
+            # Agents ignore the wrong community rather than answering
+            return None
+        response = pMod.apiMessage.getResponse(request)
+        request_pdu = pMod.apiMessage.getPDU(request)
+        response_pdu = pMod.apiMessage.getPDU(response)
+
+        var_binds = []
+        if request_pdu.isSameTypeWith(pMod.GetRequestPDU()):
+            for oid, val in pMod.apiPDU.getVarBinds(request_pdu):
+                var_binds.append(self.var_bind(pMod, oid, self.get(tuple(oid)), rfc1905.noSuchInstance))
+        elif request_pdu.isSameTypeWith(pMod.GetNextRequestPDU()):
+            for oid, val in pMod.apiPDU.getVarBinds(request_pdu):
+                var_binds.append(self.var_bind(pMod, oid, self.get_next(tuple(oid)), rfc1905.endOfMibView))
+        elif hasattr(pMod, 'GetBulkRequestPDU') and request_pdu.isSameTypeWith(pMod.GetBulkRequestPDU()):
+            non_repeaters = int(pMod.apiBulkPDU.getNonRepeaters(request_pdu))
+            max_repetitions = int(pMod.apiBulkPDU.getMaxRepetitions(request_pdu))
+            requested = [tuple(oid) for oid, val in pMod.apiBulkPDU.getVarBinds(request_pdu)]
+            for oid in requested[:non_repeaters]:
+                var_binds.append(self.var_bind(pMod, oid, self.get_next(oid), rfc1905.endOfMibView))
+            repeaters = requested[non_repeaters:]
+            for r in range(max_repetitions):
+                for i, oid in enumerate(repeaters):
+                    record = self.get_next(oid)
+                    var_binds.append(self.var_bind(pMod, oid, record, rfc1905.endOfMibView))
+                    if record:
+                        repeaters[i] = record[0]
+                if not any(self.get_next(oid) for oid in repeaters):
+                    break
+        else:
+            pMod.apiPDU.setErrorStatus(response_pdu, 'genErr')
+
+        if var_binds and pMod is api.protoModules[api.protoVersion1]:
+            # SNMPv1 has no exception values, so running off the end is an error
+            for i, (oid, val) in enumerate(var_binds):
+                if val is rfc1905.endOfMibView or val is rfc1905.noSuchInstance:
+                    pMod.apiPDU.setErrorStatus(response_pdu, 'noSuchName')
+                    pMod.apiPDU.setErrorIndex(response_pdu, i + 1)
+                    var_binds = pMod.apiPDU.getVarBinds(request_pdu)
+                    break
+        pMod.apiPDU.setVarBinds(response_pdu, var_binds)
+        return encoder.encode(response)
+
+    def var_bind(self, pMod, oid, record, missing):
+        if record:
+            return (pMod.ObjectIdentifier(record[0]), self.value(pMod, record[1], record[2]))
+        return (pMod.ObjectIdentifier(oid), missing)
+
+# Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
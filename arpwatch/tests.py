@@ -1,3 +1,4 @@
+import os
 import json
 import traceback
 from datetime import datetime, timedelta, date
@@ -6,11 +7,18 @@ from django.test import TestCase
 from django.core import management
 from django.contrib.auth.models import User
 from django.conf import settings
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.utils import timezone
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
 
 import arp
 from arpwatch.models import *
+from arpwatch.snmp import SNMPAgent, collect_arp_tables
+from arpwatch.snmpsim import FixtureAgent
+from nadine.models.usage import Presence
 
 
 class ArpWatchTest(TestCase):
@@ -21,16 +29,8 @@ class ArpWatchTest(TestCase):
         with self.assertRaises(IntegrityError):
             device2 = UserDevice.objects.create(mac_address=MAC)
 
-    def test_dir_lock(self):
-        self.assertFalse(arp.import_dir_locked())
-        arp.lock_import_dir()
-        self.assertTrue(arp.import_dir_locked())
-        arp.unlock_import_dir()
-        self.assertFalse(arp.import_dir_locked())
-
     def test_log_message(self):
         arp.log_message("testing")
-        # self.assertFalse(arp.import_dir_locked())
 
     # def test_arpwatch(self):
         #mac1 = MACAddress.objects.create(value="90:A2:DA:00:EE:5D")
@@ -64,4 +64,237 @@ class ArpWatchTest(TestCase):
             ArpLog.objects.create(runtime=s, device=device1, ip_address=ip1)
             s = s + timedelta(minutes=5)
 
+        DeviceSession.objects.rollup(start.date())
         logs = ArpLog.objects.for_user(user1, start, end)
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0].start, start)
+        self.assertEqual(logs[0].end, end - timedelta(minutes=5))
+
+    def test_device_sessions(self):
+        device1 = UserDevice.objects.create(mac_address="90:A2:DA:00:EE:5D")
+        device2 = UserDevice.objects.create(mac_address="90:A2:DA:00:EE:5E")
+        tz = timezone.get_current_timezone()
+        start = timezone.make_aware(datetime(2015, 5, 3, 9, 0, 0), tz)
+        # Device one leaves for lunch and comes back on a new IP, device two is seen once
+        for minutes in [0, 5, 10, 15, 90, 95]:
+            ip = "172.16.5.1" if minutes < 60 else "172.16.5.2"
+            ArpLog.objects.create(runtime=start + timedelta(minutes=minutes), device=device1, ip_address=ip)
+        ArpLog.objects.create(runtime=start + timedelta(minutes=30), device=device2, ip_address="172.16.5.3")
+
+        self.assertEqual(DeviceSession.objects.rollup(start.date()), 3)
+        sessions = DeviceSession.objects.filter(device=device1).order_by('first_seen')
+        self.assertEqual([s.sample_count for s in sessions], [4, 2])
+        self.assertEqual(sessions[0].last_seen, start + timedelta(minutes=15))
+        self.assertEqual(sessions[1].ip_list, ["172.16.5.2"])
+
+        with self.assertNumQueries(1):
+            device_logs = ArpLog.objects.for_range(start, start + timedelta(days=1))
+            [str(l.device) for l in device_logs]
+        self.assertEqual([(l.device, l.start, l.end) for l in device_logs], [
+            (device1, start, start + timedelta(minutes=95)),
+            (device2, start + timedelta(minutes=30), start + timedelta(minutes=30)),
+        ])
+        self.assertEqual([l.ip for l in ArpLog.objects.for_device(device1.id)], ["172.16.5.1", "172.16.5.2"])
+
+        # Purging keeps the sessions and rolls up any day which had not been
+        ArpLog.objects.create(runtime=start + timedelta(days=1), device=device2, ip_address="172.16.5.3")
+        self.assertEqual(DeviceSession.objects.purge(start.date() + timedelta(days=2)), 8)
+        self.assertEqual(ArpLog.objects.count(), 0)
+        self.assertEqual(DeviceSession.objects.count(), 4)
+
+    def test_rollup_window(self):
+        device1 = UserDevice.objects.create(mac_address="90:A2:DA:00:EE:5D")
+        device2 = UserDevice.objects.create(mac_address="90:A2:DA:00:EE:5E")
+        device3 = UserDevice.objects.create(mac_address="90:A2:DA:00:EE:5F")
+        tz = timezone.get_current_timezone()
+        start = timezone.make_aware(datetime(2015, 5, 3, 9, 0, 0), tz)
+        for minutes in [0, 5, 10, 60, 65]:
+            ArpLog.objects.create(runtime=start + timedelta(minutes=minutes), device=device1, ip_address="172.16.5.1")
+        for minutes in [0, 5]:
+            ArpLog.objects.create(runtime=start + timedelta(minutes=minutes), device=device2, ip_address="172.16.5.2")
+        DeviceSession.objects.rollup(start.date())
+        untouched = DeviceSession.objects.get(device=device1, first_seen=start)
+
+        # The next file only rebuilds the sessions it is close enough to change
+        runtime = start + timedelta(minutes=70)
+        ArpLog.objects.create(runtime=runtime, device=device1, ip_address="172.16.5.1")
+        ArpLog.objects.create(runtime=runtime, device=device3, ip_address="172.16.5.3")
+        self.assertEqual(DeviceSession.objects.rollup_window(runtime, runtime), 2)
+        self.assertTrue(DeviceSession.objects.filter(id=untouched.id).exists())
+        sessions = lambda: sorted((s.device_id, s.first_seen, s.last_seen, s.sample_count) for s in DeviceSession.objects.all())
+        incremental = sessions()
+        DeviceSession.objects.rollup(start.date())
+        self.assertEqual(incremental, sessions())
+
+    def test_import_file(self):
+        user1 = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        UserDevice.objects.create(user=user1, mac_address="00:1b:21:4e:e7:2c")
+        runtime = timezone.now()
+        dump = "\n".join([
+            "? (172.16.5.153) at 00:1b:21:4e:e7:2c on sk4 expires in 1169 seconds [ethernet]",
+            "? (172.16.5.154) at 00:1b:21:4e:e7:2d on sk4 expires in 1169 seconds [ethernet]",
+            "? (172.16.5.155) at 00:1b:21:4e:e7:2e on sk4 expires in 1169 seconds [ethernet]",
+            "? (172.16.5.155) at 00:1b:21:4e:e7:2e on sk4 expires in 1169 seconds [ethernet]",
+            "",
+        ])
+        # New devices are inserted in a savepoint and the COPY used on PostgreSQL doesn't go through the query log
+        with self.assertNumQueries(6 if connection.vendor == 'postgresql' else 7):
+            arp_logs = arp.bulk_log_data(runtime, arp.parse_arp_file(ContentFile(dump)))
+        arp.record_presence(arp_logs)
+        self.assertTrue(Presence.objects.filter(user=user1, sources=Presence.ARP).exists())
+        self.assertEqual(UserDevice.objects.count(), 3)
+        self.assertEqual(ArpLog.objects.filter(runtime=runtime).count(), 3)
+        self.assertEqual(ArpLog.objects.get(ip_address="172.16.5.153").device.user, user1)
+
+        # Loading the same data again is a no-op
+        arp.import_file(ContentFile(dump), runtime)
+        self.assertEqual(ArpLog.objects.filter(runtime=runtime).count(), 3)
+
+        # A device another import created while we weren't looking is picked up rather than failing
+        arp.create_devices(set(["00:1b:21:4e:e7:2e", "00:1b:21:4e:e7:2f"]))
+        self.assertEqual(UserDevice.objects.filter(mac_address__in=["00:1b:21:4e:e7:2e", "00:1b:21:4e:e7:2f"]).count(), 2)
+
+    def test_import_all(self):
+        arp_root = arp.get_arp_root()
+        for file_name, ip in [("arp-170102-0905.txt", "172.16.5.2"), ("arp-170102-0900.txt", "172.16.5.1"), ("notes.txt", None)]:
+            line = "? (%s) at 00:1b:21:4e:e7:2c on sk4 expires in 1169 seconds [ethernet]\n" % ip
+            default_storage.save(arp_root + file_name, ContentFile(line))
+        self.assertEqual([f for r, f in arp.pending_files()], ["arp-170102-0900.txt", "arp-170102-0905.txt"])
+
+        # Nothing happens while someone else holds the lock
+        with arp.import_lock() as locked:
+            self.assertTrue(locked)
+            self.assertEqual(arp.import_all(workers=1), [])
+
+        import_logs = arp.import_all(workers=1)
+        self.assertEqual([l.file_name for l in import_logs], ["arp-170102-0900.txt", "arp-170102-0905.txt"])
+        for log in ImportLog.objects.all():
+            self.assertTrue(log.success)
+            self.assertEqual(log.entry_count, 1)
+            self.assertTrue(log.parse_time is not None and log.insert_time is not None)
+        self.assertEqual(ArpLog.objects.count(), 2)
+        self.assertEqual(arp.pending_files(), [])
+        self.assertFalse(ImportLock.objects.exists())
+        default_storage.delete(arp_root + "notes.txt")
+
+    def test_snmp_collector(self):
+        snmprec_dir = os.path.join(os.path.dirname(__file__), 'snmprec')
+        fixture_agents = [FixtureAgent(os.path.join(snmprec_dir, f)) for f in ['switch-one.snmprec', 'router-two.snmprec']]
+        for fixture_agent in fixture_agents:
+            fixture_agent.start()
+        try:
+            agents = [SNMPAgent('127.0.0.1', 'public', a.port, timeout=1, retries=0, max_repetitions=10) for a in fixture_agents]
+            arp_table = collect_arp_tables(agents)
+            # The two overlap on 172.16.5.20-30 and the router also knows about another network
+            self.assertEqual(len(arp_table), 43)
+            self.assertEqual(dict(arp_table)['172.16.5.20'], "00:1b:21:4e:01:14")
+            self.assertEqual(dict(arp_table)['10.0.0.3'], "00:1b:21:4e:03:03")
+            self.assertTrue(fixture_agents[0].request_count >= 3)
+
+            # An agent which does not answer is skipped
+            silent = SNMPAgent('127.0.0.1', 'wrong', fixture_agents[0].port, timeout=0.2, retries=0)
+            self.assertEqual(len(collect_arp_tables([silent] + agents[1:])), 24)
+
+            with self.settings(ARPWATCH_NETWORK_PREFIX='172.16.5.'):
+                arp.import_snmp(agents)
+            self.assertEqual(ArpLog.objects.count(), 40)
+        finally:
+            for fixture_agent in fixture_agents:
+                fixture_agent.stop()
+
+    def test_map_ip_to_mac(self):
+        user1 = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        user2 = User.objects.create(username='member_two', first_name='Member', last_name='Two')
+        laptop = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:01")
+        late = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:02")
+        shared = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:03")
+        printer = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:04", ignore=True)
+        now = timezone.now()
+
+        def seen(device, ip, minutes_ago):
+            ArpLog.objects.create(runtime=now - timedelta(minutes=minutes_ago), device=device, ip_address=ip)
+
+        def login(user, ip, minutes_ago):
+            UserRemoteAddr.objects.create(logintime=now - timedelta(minutes=minutes_ago), user=user, ip_address=ip)
+
+        # Seen within six minutes of the login
+        seen(laptop, "172.16.5.1", 12)
+        login(user1, "172.16.5.1", 10)
+        # Seen too long before the login
+        seen(late, "172.16.5.2", 45)
+        login(user2, "172.16.5.2", 30)
+        # Two people logged in from the same device, the most recent wins
+        seen(shared, "172.16.5.3", 40)
+        seen(shared, "172.16.5.3", 20)
+        login(user1, "172.16.5.3", 40)
+        login(user2, "172.16.5.3", 20)
+        # Ignored devices are never claimed
+        seen(printer, "172.16.5.4", 5)
+        login(user1, "172.16.5.4", 5)
+
+        self.assertEqual(arp.map_ip_to_mac(1), {laptop.id: user1.id, shared.id: user2.id})
+        self.assertEqual(UserDevice.objects.get(id=laptop.id).user, user1)
+        self.assertEqual(UserDevice.objects.get(id=late.id).user, None)
+        self.assertEqual(UserDevice.objects.get(id=shared.id).user, user2)
+        self.assertEqual(UserDevice.objects.get(id=printer.id).user, None)
+        self.assertTrue(Presence.objects.filter(user=user2, sources=Presence.ARP).exists())
+
+        # Claimed devices are left alone the next time around
+        login(user2, "172.16.5.1", 11)
+        self.assertEqual(arp.map_ip_to_mac(1), {})
+
+    def test_device_by_ip(self):
+        cache.delete(arp.IP_MAP_VERSION_KEY)
+        device1 = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:01")
+        device2 = UserDevice.objects.create(mac_address="AA:AA:AA:AA:AA:02")
+        now = timezone.now()
+        ArpLog.objects.create(runtime=now - timedelta(minutes=10), device=device1, ip_address="172.16.5.1")
+        ArpLog.objects.create(runtime=now - timedelta(minutes=5), device=device2, ip_address="172.16.5.1")
+        ArpLog.objects.create(runtime=now - timedelta(minutes=45), device=device1, ip_address="172.16.5.2")
+
+        # Without a map we go to the database
+        self.assertEqual(arp.device_by_ip("172.16.5.1"), device2)
+
+        ip_map = arp.refresh_ip_map()
+        self.assertEqual(ip_map, {"172.16.5.1": (device2.id, now - timedelta(minutes=5))})
+        self.assertEqual(cache.get(arp.IP_MAP_VERSION_KEY), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(arp.device_by_ip("172.16.5.1"), device2)
+        # Misses fall back to the database
+        with self.assertNumQueries(1):
+            self.assertEqual(arp.device_by_ip("172.16.5.2"), None)
+        arp.refresh_ip_map()
+        self.assertEqual(cache.get(arp.IP_MAP_VERSION_KEY), 2)
+        self.assertEqual([arp.next_ip_map_version(), arp.next_ip_map_version()], [3, 4])
+
+    def test_activity_snapshot(self):
+        cache.delete(ACTIVITY_SNAPSHOT_KEY)
+        user = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        url = reverse('arp:activity')
+
+        # Who is here is only for those logged in
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.client.force_login(user)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(json.loads(response.content)['here_today'], [])
+
+        # The cached body is served with no more than the session lookups
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response['ETag'], etag)
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH='W/%s' % etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Someone showing up drops the snapshot
+        Presence.objects.record(user.id, timezone.localtime(timezone.now()).date(), Presence.ARP)
+        self.assertEqual(cache.get(ACTIVITY_SNAPSHOT_KEY), None)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        here_today = json.loads(response.content)['here_today']
+        self.assertEqual([m['username'] for m in here_today], ['member_one'])
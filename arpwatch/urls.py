@@ -10,6 +10,7 @@ urlpatterns = [
    url(r'^device/$', views.device_logs_today, name='devices_today'),
    url(r'^device/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d+)/$', views.device_logs_by_day, name='device_logs'),
    url(r'^user/$', views.logins_today, name='user'),
+   url(r'^activity/$', views.activity, name='activity'),
    url(r'^user/(?P<year>\d+)/(?P<month>\d+)/(?P<day>\d+)/$', views.logins_by_day, name='user_logs'),
 ]
 
@@ -7,11 +7,13 @@ from django.template import Context, loader
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponse, Http404, HttpResponseServerError, HttpResponseRedirect, HttpResponsePermanentRedirect
 from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 
 from arpwatch.forms import *
 from arpwatch.models import *
 from arpwatch import arp
+from arpwatch.activity import snapshot_response
 
 
 @staff_member_required
@@ -94,4 +96,10 @@ def logins_by_day(request, year, month, day):
     return render(request, 'arpwatch/user_logins.html', context)
 
 
+@login_required
+def activity(request):
+    # Polled by the lobby displays so this is served from the cached snapshot
+    return snapshot_response(request)
+
+
 # Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -1,12 +1,18 @@
 import os
 import abc
 import json
+import zlib
 import base64
+import timeit
 import logging
+import sqlite3
 import requests
-import traceback
 import threading
+import requests.adapters
+import traceback
 from datetime import datetime, time, date, timedelta
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 
 from cryptography.fernet import Fernet
 
@@ -19,7 +25,9 @@ class Messages(object):
     GET_TIME = "get_time"
     PULL_CONFIGURATION = "pull_configuration"
     CHECK_IN = "check_in"
+    HEARTBEAT = "heartbeat"
     PULL_DOOR_CODES = "pull_door_codes"
+    PULL_CODE_CHANGES = "pull_code_changes"
     PUSH_EVENT_LOGS = "push_event_logs"
     NEW_DATA = "new_data"
     NO_NEW_DATA = "no_new_data"
@@ -59,8 +67,35 @@ class DoorEventTypes(object):
     )
 
 
+class KeymasterError(Exception):
+    """The keymaster got our message but answered with an error"""
+
+
+class KeymasterTransport(object):
+    """Keeps a pool of keep-alive connections to the keymaster so each message doesn't pay for a new TCP and TLS handshake"""
+
+    def __init__(self, keymaster_url, pool_size=4, timeout=30):
+        self.keymaster_url = keymaster_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        # Block rather than open extra connections when every pooled one is busy
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, request_package):
+        return self.session.post(self.keymaster_url, data=request_package, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
 class EncryptedConnection(object):
-    def __init__(self, encryption_key, keymaster_url=None, ttl=600):
+    # Payloads at least this big are compressed before they are encrypted
+    COMPRESS_MIN_SIZE = 1024
+    ZLIB = "zlib"
+
+    def __init__(self, encryption_key, keymaster_url=None, ttl=600, pool_size=4, timeout=30):
         if not encryption_key:
             raise Exception("Missing Encryption Key")
         self.encryption_key = encryption_key
@@ -69,7 +104,10 @@ class EncryptedConnection(object):
         self.keymaster_url = keymaster_url
         self.message = None
         self.data = None
-        self.lock = threading.Lock()
+        self.accepts_zlib = False
+        self.transport = None
+        if keymaster_url:
+            self.transport = KeymasterTransport(keymaster_url, pool_size, timeout)
 
     def decrypt_message(self, message):
         # If you are getting a blank exception when this runs it might be because the encrypted message
@@ -79,24 +117,37 @@ class EncryptedConnection(object):
     def encrypt_message(self, message):
         return self.farnet.encrypt(bytes(message))
 
+    def encode_payload(self, payload):
+        # Returns the encrypted payload and how it was encoded, compressing the big ones first
+        payload = bytes(payload)
+        if len(payload) >= self.COMPRESS_MIN_SIZE:
+            return (self.encrypt_message(zlib.compress(payload)), self.ZLIB)
+        return (self.encrypt_message(payload), None)
+
+    def decode_payload(self, encrypted_payload, encoding=None):
+        payload = self.decrypt_message(encrypted_payload)
+        if encoding == self.ZLIB:
+            payload = zlib.decompress(payload)
+        elif encoding:
+            raise Exception("Unknown encoding: %s" % encoding)
+        return payload
+
     def send_message(self, message, data=None, encrypt=True):
         # Encrypt the message
         if encrypt:
             encrypted_message = self.encrypt_message(message)
-            request_package = {'message':encrypted_message}
+            request_package = {'message':encrypted_message, 'accept_encoding':self.ZLIB}
             if data:
-                request_package['data'] = self.encrypt_message(data)
+                request_package['data'], encoding = self.encode_payload(data)
+                if encoding:
+                    request_package['data_encoding'] = encoding
         else:
             request_package = {'text_message': message}
             if data:
                 request_package['data'] = data
 
-        # Send the message
-        self.lock.acquire()
-        try:
-            response = requests.post(self.keymaster_url, data=request_package)
-        finally:
-            self.lock.release()
+        # Send the message.  The pool lets the heartbeat, event and sync traffic all be in flight at once
+        response = self.transport.post(request_package)
         if not response:
             logger.warn("Received blank response from Keymaster")
             return None
@@ -106,17 +157,25 @@ class EncryptedConnection(object):
         if 'error' in response_json:
             error = response_json['error']
             traceback.print_exc()
-            raise Exception(error)
+            raise KeymasterError(error)
 
         if 'text_message' in response_json:
             return response_json['text_message']
 
         if 'message' in response_json:
-            encrypted_return_message = response.json()['message']
-            return self.decrypt_message(encrypted_return_message)
+            return self.decode_payload(response_json['message'], response_json.get('encoding'))
 
         return None
 
+    def response_package(self, message):
+        # Only compress for gatekeepers which told us they can handle it
+        if self.accepts_zlib:
+            encrypted_message, encoding = self.encode_payload(message)
+            if encoding:
+                return {'message':encrypted_message, 'encoding':encoding}
+            return {'message':encrypted_message}
+        return {'message':self.encrypt_message(message)}
+
     def receive_message(self, request):
         # Encrypted message is in 'message' POST variable
         if not request.method == 'POST':
@@ -144,8 +203,9 @@ class EncryptedConnection(object):
         # Encrypted data is in 'data' POST variable
         if 'data' in request.POST:
             encrypted_data = request.POST['data']
-            decrypted_data = self.decrypt_message(encrypted_data)
+            decrypted_data = self.decode_payload(encrypted_data, request.POST.get('data_encoding'))
             self.data = json.loads(decrypted_data)
+        self.accepts_zlib = request.POST.get('accept_encoding') == self.ZLIB
 
         return self.message
 
@@ -186,7 +246,56 @@ class CardHolder(object):
             action_str = " (%s)" % self.action
         return "%s%s: %s%s" % (self.get_full_name(), id_str, self.code, action_str)
 
+class CardholderCache(object):
+    """Keeps the cardholders loaded from each door in a local sqlite file so a restart doesn't have to read them all again"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self):
+        # A new connection each time since doors are synced from several threads
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS doors (name TEXT PRIMARY KEY, ip_address TEXT, marker TEXT, saved_ts TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS cardholders (door TEXT, id TEXT, first_name TEXT, last_name TEXT, username TEXT, code TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS cardholders_door ON cardholders (door)")
+        return connection
+
+    def load(self, door_name, ip_address):
+        # Returns the marker and cardholders saved for this door, or None if we have nothing for it
+        connection = self.connect()
+        try:
+            row = connection.execute("SELECT marker FROM doors WHERE name = ? AND ip_address = ?", (door_name, ip_address)).fetchone()
+            if not row:
+                return None
+            rows = connection.execute("SELECT id, first_name, last_name, username, code FROM cardholders WHERE door = ?", (door_name, ))
+            return (row[0], [CardHolder(*r) for r in rows])
+        finally:
+            connection.close()
+
+    def save(self, door_name, ip_address, marker, cardholders):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM cardholders WHERE door = ?", (door_name, ))
+                connection.executemany("INSERT INTO cardholders VALUES (?, ?, ?, ?, ?, ?)",
+                    [(door_name, c.id, c.first_name, c.last_name, c.username, c.code) for c in cardholders])
+                connection.execute("INSERT OR REPLACE INTO doors VALUES (?, ?, ?, ?)", (door_name, ip_address, marker, datetime.now().isoformat()))
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM cardholders")
+                connection.execute("DELETE FROM doors")
+        finally:
+            connection.close()
+
+
 class DoorController(object):
+    # Requests made to the door, for controllers which talk to one over the network
+    round_trips = 0
 
     def __init__(self, name, ip_address, username, password):
         self.debug = False
@@ -213,6 +322,12 @@ class DoorController(object):
         if cardholder.code and not cardholder.code in self.cardholders_by_code:
             self.cardholders_by_code[cardholder.code] = cardholder
 
+    def remove_cardholder(self, cardholder):
+        if self.cardholders_by_id.get(cardholder.id) is cardholder:
+            del self.cardholders_by_id[cardholder.id]
+        if self.cardholders_by_code.get(cardholder.code) is cardholder:
+            del self.cardholders_by_code[cardholder.code]
+
     def get_cardholder_by_id(self, cardholderID):
         if cardholderID in self.cardholders_by_id:
             return self.cardholders_by_id[cardholderID]
@@ -259,13 +374,49 @@ class DoorController(object):
 
         return changes
 
+    def cardholder_marker(self):
+        # Controllers which can cheaply tell if their cardholders changed return a marker for what we have loaded
+        return None
+
+    def marker_is_current(self, marker):
+        return False
+
+    def process_code_changes(self, door_codes, deleted_codes):
+        # Unlike process_door_codes this only looks at the codes given and trusts
+        # the cardholders we already have loaded for everything else.
+        logging.info("DoorController[%s]: Processing code changes (%d changed, %d deleted)" % (self.door_name, len(door_codes), len(deleted_codes)))
+
+        changes = []
+        for code in deleted_codes:
+            cardholder = self.get_cardholder_by_code(code)
+            if cardholder:
+                cardholder.action = 'delete'
+                changes.append(cardholder)
+
+        for new_code in door_codes:
+            new_cardholder = CardHolder(None, new_code.get('first_name'), new_code.get('last_name'), new_code.get('username'), new_code.get('code'))
+            cardholder = self.get_cardholder_by_code(new_cardholder.code)
+            if cardholder and new_cardholder.is_same_person(cardholder):
+                continue
+            if cardholder:
+                cardholder.action = 'delete'
+                changes.append(cardholder)
+            new_cardholder.action = 'add'
+            changes.append(new_cardholder)
+
+        return changes
+
     def process_changes(self, change_list):
         for c in change_list:
             logging.debug("DoorController [%s]: %s - %s" % (self.door_name, c.action.title(), c.get_full_name()))
             if c.action == 'add':
                 self.add_cardholder(c)
+                self.save_cardholder(c)
             elif c.action == 'delete':
                 self.delete_cardholder(c)
+                self.remove_cardholder(c)
+            # Keep what we know about the door current so the next delta applies cleanly
+            del c.action
 
     ################################################################################
     # Abstract Methods
@@ -352,6 +503,35 @@ class TestDoorController(DoorController):
         pass
 
 
+class DoorReport(object):
+    """The results, errors and timings from running one task against every door"""
+
+    def __init__(self, description):
+        self.description = description
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        # Doors left alone because an earlier task on them has not finished
+        self.busy = []
+
+    def summary(self):
+        doors = []
+        for door_name in sorted(set(self.timings.keys()) | set(self.errors.keys()) | set(self.busy)):
+            if door_name in self.busy:
+                doors.append("%s: busy" % door_name)
+            elif door_name in self.errors:
+                doors.append("%s: %s" % (door_name, self.errors[door_name]))
+            else:
+                doors.append("%s: %.2fs" % (door_name, self.timings[door_name]))
+        return "%s (%s)" % (self.description, ", ".join(doors))
+
+
+def timed_door_task(task, door_name, door):
+    start = timeit.default_timer()
+    result = task(door_name, door)
+    return (result, timeit.default_timer() - start)
+
+
 class Gatekeeper(object):
     def __init__(self, config):
         if not 'KEYMASTER_URL' in config:
@@ -359,12 +539,25 @@ class Gatekeeper(object):
         if not 'KEYMASTER_SECRET' in config:
             raise Exception("No KEYMASTER_SECRETin configuration")
 
-        self.encrypted_connection = EncryptedConnection(config['KEYMASTER_SECRET'], config['KEYMASTER_URL'])
+        self.encrypted_connection = EncryptedConnection(config['KEYMASTER_SECRET'], config['KEYMASTER_URL'],
+            pool_size=config.get('KEYMASTER_POOL_SIZE', 4), timeout=config.get('KEYMASTER_TIMEOUT_SEC', 30))
         self.card_secret = config.get('CARD_SECRET', None)
         self.event_count = config.get('EVENT_SYNC_COUNT', 100)
         self.lock_key_code = config.get('LOCK_KEY', None)
         self.unlock_key_code = config.get('UNLOCK_KEY', None)
         self.debug = config.get('DEBUG', False)
+        self.code_version_file = config.get('CODE_VERSION_FILE', 'code_version.json')
+        self.code_version_lock = threading.Lock()
+        self.code_versions = self.load_code_versions()
+        self.door_workers = config.get('DOOR_SYNC_WORKERS', 4)
+        self.door_timeout = config.get('DOOR_TIMEOUT_SEC', 60)
+        self.door_errors = {}
+        # The last task started on each door, which may still be running after we gave up waiting on it
+        self.door_tasks = {}
+        self.door_tasks_lock = threading.Lock()
+        self.cardholder_cache = None
+        if config.get('CARDHOLDER_CACHE_FILE', 'cardholders.sqlite'):
+            self.cardholder_cache = CardholderCache(config.get('CARDHOLDER_CACHE_FILE', 'cardholders.sqlite'))
 
     def get_connection(self):
         return self.encrypted_connection
@@ -376,7 +569,8 @@ class Gatekeeper(object):
 
     def configure_doors(self):
         logging.info("Gatekeeper: Pulling door configuration...")
-        self.doors = {}
+        previous_doors = self.__dict__.get('doors', {})
+        doors = {}
         configuration = self.encrypted_connection.send_message(Messages.PULL_CONFIGURATION)
         config_json = json.loads(configuration)
 
@@ -399,11 +593,50 @@ class Gatekeeper(object):
                 raise NotImplementedError
             door_info['controller'] = controller
 
-            logging.debug("Gatekeeper: Loading credentials for '%s'" % name)
-            controller.load_credentials()
+            read_door = self.load_cardholders(door_info)
             logging.debug("Gatekeeper: Number of cardholders = %d" % len(controller.cardholders_by_id))
 
-            self.doors[name] = door_info
+            # Code changes only apply on top of what the door held when we last synced it.  A door that is new
+            # to us, or that we had to read again because it no longer matched the cache, needs every code.
+            previous = previous_doors.get(name)
+            known = previous is not None and previous.get('ip_address') == ip_address
+            if read_door and (not known or self.cardholder_cache):
+                self.forget_code_version(name)
+
+            doors[name] = door_info
+
+        # Swap them in all at once since the event proxy may be looking up doors while we do this
+        self.doors = doors
+
+    def load_cardholders(self, door_info):
+        # Use what we cached for this door unless the door tells us it has changed.  Returns True if we read the door.
+        name = door_info.get('name')
+        controller = door_info['controller']
+        if self.cardholder_cache:
+            cached = self.cardholder_cache.load(name, door_info.get('ip_address'))
+            if cached and controller.marker_is_current(cached[0]):
+                logging.debug("Gatekeeper: Using cached credentials for '%s'" % name)
+                controller.clear_data()
+                for cardholder in cached[1]:
+                    controller.save_cardholder(cardholder)
+                return False
+        logging.debug("Gatekeeper: Loading credentials for '%s'" % name)
+        controller.load_credentials()
+        self.save_cardholders(door_info)
+        return True
+
+    def save_cardholders(self, door_info):
+        controller = door_info['controller']
+        marker = controller.cardholder_marker()
+        if self.cardholder_cache and marker:
+            self.cardholder_cache.save(door_info.get('name'), door_info.get('ip_address'), marker, controller.cardholders_by_id.values())
+
+    def rebuild_cardholder_cache(self):
+        logging.info("Gatekeeper: Rebuilding the cardholder cache...")
+        if self.cardholder_cache:
+            self.cardholder_cache.clear()
+        # What we applied to the doors is only known through the cache so start over with the codes too
+        self.forget_code_version()
 
     def get_doors(self):
         if not 'doors' in self.__dict__:
@@ -447,33 +680,146 @@ class Gatekeeper(object):
             controller = door['controller']
             controller.clear_door_codes()
 
-    def pull_door_codes(self):
-        logging.info("Gatekeeper: Pulling door codes from the keymaster...")
-        response = self.encrypted_connection.send_message(Messages.PULL_DOOR_CODES)
-        door_codes = json.loads(response)
+    def run_on_doors(self, task, description, door_names=None):
+        # Each door is its own round trip so talk to them all at once, making sure one that
+        # has gone away can't hold up or take down the rest.
+        report = DoorReport(description)
+        doors = self.get_doors()
+        if door_names is not None:
+            doors = dict((name, door) for name, door in doors.items() if name in door_names)
+        if not doors:
+            return report
+        pool = ThreadPool(min(self.door_workers, len(doors)))
+        try:
+            # Never run two tasks on the same controller at once
+            pending = []
+            with self.door_tasks_lock:
+                for door_name, door in doors.items():
+                    in_flight = self.door_tasks.get(door_name)
+                    if in_flight and not in_flight.ready():
+                        report.busy.append(door_name)
+                        continue
+                    self.door_tasks[door_name] = pool.apply_async(timed_door_task, (task, door_name, door))
+                    pending.append((door_name, self.door_tasks[door_name]))
+            for door_name, async_result in pending:
+                try:
+                    report.results[door_name], report.timings[door_name] = async_result.get(self.door_timeout)
+                except TimeoutError:
+                    report.errors[door_name] = "timed out after %s seconds" % self.door_timeout
+                except Exception as e:
+                    report.errors[door_name] = str(e) or e.__class__.__name__
+        finally:
+            # A door which timed out still has a thread waiting on it so don't wait around
+            pool.close()
+        logging.info("Gatekeeper: %s" % report.summary())
+        self.report_door_errors(report)
+        return report
+
+    def report_door_errors(self, report):
+        # Only bother the keymaster when a door starts or stops failing
+        changed = False
+        for door_name in report.errors:
+            if self.door_errors.get(door_name) is None:
+                changed = True
+            self.door_errors[door_name] = report.errors[door_name]
+        for door_name in report.results:
+            if self.door_errors.pop(door_name, None) is not None:
+                changed = True
+        if changed:
+            try:
+                self.send_gatekeper_log(report.summary())
+            except Exception as e:
+                logging.warning("Gatekeeper: Unable to report door errors: %s" % e)
+
+    def load_code_versions(self):
+        # The last door code version applied to each door
+        try:
+            with open(self.code_version_file, 'r') as f:
+                return dict(json.load(f).get('doors', {}))
+        except (IOError, ValueError, AttributeError, TypeError):
+            return {}
+
+    def save_code_versions(self, versions):
+        with self.code_version_lock:
+            self.code_versions.update(versions)
+            with open(self.code_version_file, 'w') as f:
+                json.dump({'doors': self.code_versions}, f)
+
+    def forget_code_version(self, door_name=None):
+        # Without a version a door gets every code on the next sync
+        with self.code_version_lock:
+            if not self.code_versions:
+                return
+            if door_name is None:
+                self.code_versions.clear()
+            elif self.code_versions.pop(door_name, None) is None:
+                return
+            with open(self.code_version_file, 'w') as f:
+                json.dump({'doors': self.code_versions}, f)
+
+    @property
+    def code_version(self):
+        # The oldest door code version applied to our doors, None if any of them has never been synced
+        versions = [self.code_versions.get(name) for name in self.__dict__.get('doors', {})]
+        if not versions or None in versions:
+            return None
+        return min(versions)
 
-        # Inject our magic keys in to the list of door codes
-        if self.lock_key_code:
-            door_codes.append({'first_name':'Lock', 'last_name':'Key', 'username':'lockkey', 'code':self.lock_key_code})
-        if self.unlock_key_code:
-            door_codes.append({'first_name':'Unlock', 'last_name':'Key', 'username':'unlockkey', 'code':self.unlock_key_code})
+    def pull_door_codes(self, full=False):
+        # Only the codes changed since the door furthest behind was synced unless asked for everything
+        since = None if full else self.code_version
+        logging.info("Gatekeeper: Pulling door code changes since %s from the keymaster..." % since)
+        response = self.encrypted_connection.send_message(Messages.PULL_CODE_CHANGES, data=json.dumps({'since': since}))
+        code_changes = json.loads(response)
+        door_codes = code_changes['codes']
+        deleted_codes = code_changes['deleted']
 
         # Decode the doors coming from the keymaster if we have a card secret
         if self.card_secret:
             for c in door_codes:
                 c['code'] = self.decode_door_code(c['code'])
+            deleted_codes = [self.decode_door_code(c) for c in deleted_codes]
 
-        for door in self.get_doors().values():
+        if code_changes['full']:
+            # Inject our magic keys in to the list of door codes
+            if self.lock_key_code:
+                door_codes.append({'first_name':'Lock', 'last_name':'Key', 'username':'lockkey', 'code':self.lock_key_code})
+            if self.unlock_key_code:
+                door_codes.append({'first_name':'Unlock', 'last_name':'Key', 'username':'unlockkey', 'code':self.unlock_key_code})
+
+        def sync_door(door_name, door):
             controller = door['controller']
-            changes = controller.process_door_codes(door_codes)
+            start_count = controller.round_trips
+            door_version = self.code_versions.get(door_name)
+            if code_changes['full']:
+                # Only read the door again when asked to, otherwise what we loaded when configuring it will do
+                changes = controller.process_door_codes(door_codes, load_credentials=full)
+            elif door_version is None:
+                # Forgotten since we asked, it gets everything next time
+                return None
+            elif door_version == code_changes['version']:
+                changes = []
+            else:
+                # Changes since an older version than this door's are already on it and come out as no change
+                changes = controller.process_code_changes(door_codes, deleted_codes)
             controller.process_changes(changes)
-
-    def pull_event_logs(self, record_count=-1):
+            self.save_cardholders(door)
+            return (len(changes), controller.round_trips - start_count)
+        report = self.run_on_doors(sync_door, "Door code sync")
+        synced = dict((door_name, result) for door_name, result in report.results.items() if result is not None)
+        for door_name, (change_count, round_trips) in synced.items():
+            logging.info("Gatekeeper: '%s' took %d changes in %d round trips" % (door_name, change_count, round_trips))
+
+        # Remember the version for each door which has it, the others get these changes again next time
+        self.save_code_versions(dict((door_name, code_changes['version']) for door_name in synced))
+        return report
+
+    def pull_event_logs(self, record_count=-1, door_names=None):
         logging.debug("Gatekeeper: Pulling event logs from the doors...")
         if record_count <= 0:
             record_count = self.event_count
-        event_logs = {}
-        for door_name, door in self.get_doors().items():
+
+        def pull_events(door_name, door):
             logging.debug("Gatekeeper: Pulling %d logs from '%s'" % (record_count, door_name))
             controller = door['controller']
             door_events = controller.pull_events(record_count)
@@ -481,20 +827,31 @@ class Gatekeeper(object):
                 for e in door_events:
                     if 'cardNumber' in e:
                         e['cardNumber'] = self.encode_door_code(e['cardNumber'])
-            event_logs[door_name] = door_events
-        return event_logs
+            return door_events
+
+        # Doors we could not reach are left out until they come back
+        return self.run_on_doors(pull_events, "Event pull", door_names).results
 
     def push_event_logs(self, event_logs, reconfig=True):
+        if not event_logs:
+            logging.warning("Gatekeeper: No event logs to push")
+            return
         logging.info("Gatekeeper: Pushing event logs to keymaster...")
         json_data = json.dumps(event_logs)
         response = self.encrypted_connection.send_message(Messages.PUSH_EVENT_LOGS, data=json_data)
         if not response == Messages.SUCCESS_RESPONSE:
-            raise Exception ("push_event_logs: Invalid response (%s)" % response)
+            raise KeymasterError("push_event_logs: Invalid response (%s)" % response)
 
         # Reconfigure the doors to get the latest timestamps
         if reconfig:
             self.configure_doors()
 
+    def send_heartbeat(self, pending_events=0):
+        # Tell the keymaster which codes we have and how many events are waiting, it tells us what to do
+        json_data = json.dumps({'code_version': self.code_version, 'pending_events': pending_events})
+        response = self.encrypted_connection.send_message(Messages.HEARTBEAT, data=json_data)
+        return json.loads(response)
+
     def send_gatekeper_log(self, log_text):
         logging.info("Gatekeeper: Sending gatekeeper log to keymaster...")
         json_data = json.dumps({'log_text':log_text})
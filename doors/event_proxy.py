@@ -1,99 +1,309 @@
 #!/usr/bin/env python
-import threading
-import Queue
-
-import sys
 import json
 import time
-import traceback
+import Queue
+import sqlite3
+import logging
+import itertools
+import threading
+import urlparse
+from datetime import datetime
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from core import DoorEventTypes, KeymasterError
+
+################################################################################
+# Durable Spool
+################################################################################
+
+# Access events jump ahead of everything else
+ACCESS_PRIORITY = 0
+OTHER_PRIORITY = 1
+
+class EventSpool(object):
+    """Holds events on disk until the keymaster has them so they survive keymaster outages and restarts"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, door TEXT, event TEXT, spooled REAL)")
+            # Spools written before events had a priority and a count of failed attempts
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(events)")]
+            if 'priority' not in columns:
+                self.connection.execute("ALTER TABLE events ADD COLUMN priority INTEGER DEFAULT %d" % OTHER_PRIORITY)
+            if 'attempts' not in columns:
+                self.connection.execute("ALTER TABLE events ADD COLUMN attempts INTEGER DEFAULT 0")
+            # Events the keymaster kept turning down are set aside here so they don't hold up the rest
+            self.connection.execute("CREATE TABLE IF NOT EXISTS rejected (id INTEGER PRIMARY KEY, door TEXT, event TEXT, spooled REAL, error TEXT)")
+
+    def add(self, door_name, event, priority=OTHER_PRIORITY):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO events (door, event, spooled, priority) VALUES (?, ?, ?, ?)", (door_name, json.dumps(event), time.time(), priority))
 
-import cherrypy
+    def door_filter(self, skip_doors):
+        if not skip_doors:
+            return ("", ())
+        return ("WHERE door NOT IN (%s)" % ", ".join("?" * len(skip_doors)), tuple(skip_doors))
+
+    def count(self, skip_doors=()):
+        where, params = self.door_filter(skip_doors)
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM events " + where, params).fetchone()[0]
+
+    def oldest(self, skip_doors=()):
+        # When the oldest waiting event was spooled, None when there is nothing waiting
+        where, params = self.door_filter(skip_doors)
+        with self.lock:
+            return self.connection.execute("SELECT MIN(spooled) FROM events " + where, params).fetchone()[0]
+
+    def pending(self, limit, skip_doors=()):
+        # Access events first, otherwise in the order they came in
+        where, params = self.door_filter(skip_doors)
+        with self.lock:
+            rows = self.connection.execute("SELECT id, door, event FROM events " + where + " ORDER BY priority, id LIMIT ?", params + (limit, )).fetchall()
+        return [(event_id, door_name, json.loads(event)) for event_id, door_name, event in rows]
+
+    def remove(self, event_ids):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM events WHERE id = ?", [(i, ) for i in event_ids])
+
+    def failed(self, event_ids, error, max_attempts):
+        # Count another failed attempt and set aside the events which have run out of them.  Returns how many were set aside.
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE events SET attempts = attempts + 1 WHERE id = ?", [(i, ) for i in event_ids])
+            rejected_ids = [row[0] for row in self.connection.execute("SELECT id FROM events WHERE attempts >= ?", (max_attempts, ))]
+            for event_id in rejected_ids:
+                self.connection.execute("INSERT INTO rejected SELECT id, door, event, spooled, ? FROM events WHERE id = ?", (error, event_id))
+                self.connection.execute("DELETE FROM events WHERE id = ?", (event_id, ))
+        return len(rejected_ids)
+
+    def rejected_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM rejected").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
 
-from core import Messages, EncryptedConnection, DoorEventTypes
 
 ################################################################################
-# The Web Application
+# Incoming Notifications
 ################################################################################
+
+class NotificationRefused(Exception):
+    pass
+
+class EventProxyHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.handle_notification(urlparse.urlparse(self.path).query)
+
+    def do_POST(self):
+        self.handle_notification(self.rfile.read(int(self.headers.getheader('Content-Length', 0))))
+
+    def handle_notification(self, query):
+        args = dict((k, v[0]) for k, v in urlparse.parse_qs(query).items())
+        try:
+            self.server.proxy.receive(args, self.client_address[0])
+            self.send_response(200)
+        except NotificationRefused as e:
+            logging.warning("EventProxy: Refused notification from %s (%s)" % (self.client_address[0], e))
+            self.send_response(403)
+        except Exception as e:
+            logging.warning("EventProxy: Bad notification %s (%s)" % (args, e))
+            self.send_response(400)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class EventProxyServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 class EventProxy(threading.Thread):
-    def __init__(self, queue, special_codes, doors, users, connection):
+    """Accepts event notifications from the doors and queues them up for the keymaster"""
+
+    def __init__(self, gatekeeper, queue, port, host='127.0.0.1'):
         threading.Thread.__init__(self)
+        self.gatekeeper = gatekeeper
         self.queue = queue
-        self.special_codes = special_codes
-        self.doors = doors
-        self.users = users
-        self.connection = connection
-
-    @cherrypy.expose
-    def index(self):
-        return "I'm the event proxy!"
-
-    # This is the one that takes the event data from the doors
-    @cherrypy.expose
-    def event_proxy(self, **args):
-        # event = args.get('event', 'unknown')
-        # door = args.get('door', 'unknown')
-        # code = args.get('code', 'unknown')
-        # print("Incoming Event: %s, Door: %s, Code: %s" % (event, door, code))
-        proxy_dict = self.event_for_keymaster_from_hid_args(args)
-
-        proxy_data = json.dumps(proxy_dict)
-        print(proxy_data)
-        response = self.connection.send_message(proxy_data)
-        print("Keymaster Response: %s" % response)
-        return "Here's where I would actually process the stuff"
+        self.sequence = itertools.count()
+        self.server = EventProxyServer((host, port), EventProxyHandler)
+        self.server.proxy = self
+        self.error = None
 
     def run(self):
-        cherrypy.quickstart(self)
+        logging.info("EventProxy: Listening on %s:%d" % self.server.server_address)
+        try:
+            self.server.serve_forever()
+        except Exception as e:
+            logging.error("EventProxy Exception: %s" % e)
+            self.error = e
 
-    def event_for_keymaster_from_hid_args(self, args):
-        #Args that come from the reader: firstname, lastname, cardnumber, doorname, action
-        if args["action"] == "GRANTED":
+    def receive(self, args, client_ip):
+        door_name, event = self.event_from_notification(args)
+
+        # Only the door itself gets to tell us about its events
+        if client_ip != self.gatekeeper.get_door(door_name).get('ip_address'):
+            raise NotificationRefused("%s is not the address of %s" % (client_ip, door_name))
+
+        # If this is one of our magic keys, do some magic!
+        self.gatekeeper.magic_key_test(door_name, args.get('cardnumber'))
+
+        if self.gatekeeper.card_secret and event.get('cardNumber'):
+            event['cardNumber'] = self.gatekeeper.encode_door_code(event['cardNumber'])
+        priority = OTHER_PRIORITY
+        if event['door_event_type'] in (DoorEventTypes.GRANTED, DoorEventTypes.DENIED, DoorEventTypes.UNRECOGNIZED):
+            priority = ACCESS_PRIORITY
+        self.queue.put((priority, next(self.sequence), door_name, event))
+
+    def event_from_notification(self, args):
+        # Args that come from the reader: doorname, action, cardnumber, firstname, lastname and maybe timestamp
+        door_name = args.get('doorname')
+        door = self.gatekeeper.get_door(door_name)
+        action = args.get('action', '').upper()
+        if action == "GRANTED":
             event_type = DoorEventTypes.GRANTED
-        elif args["action"] == "DENIED":
+            description = "Access Granted (%s %s)" % (args.get('firstname'), args.get('lastname'))
+        elif action == "DENIED":
             event_type = DoorEventTypes.DENIED
+            description = "Access Denied"
+        elif action == "UNRECOGNIZED":
+            event_type = DoorEventTypes.UNRECOGNIZED
+            description = "Card Not Found"
+        elif action == "LOCKED":
+            event_type = DoorEventTypes.LOCKED
+            description = "Door Locked"
+        elif action == "UNLOCKED":
+            event_type = DoorEventTypes.UNLOCKED
+            description = "Door Unlocked"
         else:
             event_type = DoorEventTypes.UNKNOWN
-        new_args = {
-            "event_type": event_type,
-            "event_description": str(args),
-        }
-        if "doorname" in args && args["doorname"] in self.doors:
-            new_args["door_id"] = self.doors[args["doorname"]]
-        if "lastname" in args && args["lastname"] in self.users:
-            new_args["user_id"] = self.users[args["lastname"]]
-        if "cardnumber" in args:
-            new_args["code"] = args["cardnumber"]
-        return new_args
+            description = str(args)
+
+        timestamp = args.get('timestamp') or datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        event = {'timestamp': timestamp, 'door_event_type': event_type, 'description': description}
+        code = args.get('cardnumber')
+        if code:
+            event['cardNumber'] = code
+            cardholder = door['controller'].get_cardholder_by_code(code)
+            if cardholder:
+                event['cardHolder'] = cardholder.to_dict()
+        return (door_name, event)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
 
 ################################################################################
-# Main method
+# Delivery to the Keymaster
 ################################################################################
 
-if __name__ == "__main__":
-    # Load our configuration
-    with open('gw_config.json', 'r') as f:
-        config = json.load(f)
-    debug = "-d" in sys.argv
-
-    # Test the connection
-    print("Testing connection: %s" % config['KEYMASTER_URL'])
-    connection = EncryptedConnection(config['ENCRYPTION_KEY'], config['KEYMASTER_URL'])
-    response = connection.send_message(Messages.TEST_QUESTION)
-    if response == Messages.TEST_RESPONSE:
-        print("Keymaster handshake successfull!")
-    else:
-        raise Exception("Could not connect to Keymaster")
-
-    queue = Queue.PriorityQueue()
-
-    doors = {'FrontDoor': 1}
-    users = {'mike': 1}
-    special_codes = ['abc']
-
-    # Create our proxy
-    proxy = EventProxy(queue, special_codes, doors, users, connection)
-    proxy.setDaemon(True)
-    proxy.start()
-
-    while True:
-        time.sleep(.1)
+class EventForwarder(threading.Thread):
+    """Moves queued events to the spool and pushes them to the keymaster in batches"""
+
+    def __init__(self, gatekeeper, queue, spool, batch_size=50, batch_delay_sec=2, max_retry_sec=300, max_attempts=10):
+        threading.Thread.__init__(self)
+        self.gatekeeper = gatekeeper
+        self.queue = queue
+        self.spool = spool
+        self.batch_size = batch_size
+        self.batch_delay_sec = batch_delay_sec
+        self.max_retry_sec = max_retry_sec
+        self.max_attempts = max_attempts
+        self.retry_sec = 0
+        self.retry_ts = 0
+        # Doors whose events the keymaster turned down wait on their own
+        self.door_retry_sec = {}
+        self.door_retry_ts = {}
+        self.error = None
+
+    def run(self):
+        self.running = True
+        logging.info("EventForwarder: Sending batches of %d events at least every %s seconds" % (self.batch_size, self.batch_delay_sec))
+        try:
+            while self.running:
+                self.spool_queued(timeout=0.1)
+                if self.batch_ready():
+                    self.flush()
+        except Exception as e:
+            logging.error("EventForwarder Exception: %s" % e)
+            self.error = e
+
+    def spool_queued(self, timeout=None):
+        # Everything goes to disk before we try sending it anywhere
+        try:
+            item = self.queue.get(timeout=timeout)
+            while True:
+                priority, sequence, door_name, event = item
+                self.spool.add(door_name, event, priority)
+                item = self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def waiting_doors(self):
+        now = time.time()
+        return set(door_name for door_name, retry_ts in self.door_retry_ts.items() if now < retry_ts)
+
+    def batch_ready(self):
+        if time.time() < self.retry_ts:
+            return False
+        skip_doors = self.waiting_doors()
+        oldest = self.spool.oldest(skip_doors)
+        if oldest is None:
+            return False
+        return self.spool.count(skip_doors) >= self.batch_size or time.time() - oldest >= self.batch_delay_sec
+
+    def flush(self):
+        # Send what is in the spool a batch at a time with each door's events pushed on their own, so a door
+        # the keymaster won't take events for can't hold up the others.  Everything stays put while the
+        # keymaster is unreachable.
+        sent = 0
+        skip_doors = self.waiting_doors()
+        while True:
+            pending = self.spool.pending(self.batch_size, skip_doors)
+            if not pending:
+                break
+            door_events = {}
+            for event_id, door_name, event in pending:
+                door_events.setdefault(door_name, []).append((event_id, event))
+            for door_name, id_events in door_events.items():
+                event_ids = [event_id for event_id, event in id_events]
+                # The keymaster expects the newest events first like the doors list them
+                events = sorted([event for event_id, event in id_events], key=lambda e: e.get('timestamp'), reverse=True)
+                try:
+                    self.gatekeeper.push_event_logs({door_name: events}, reconfig=False)
+                except KeymasterError as e:
+                    self.reject(door_name, event_ids, e)
+                    skip_doors.add(door_name)
+                    continue
+                except Exception as e:
+                    self.retry_sec = min(max(self.retry_sec * 2, 1), self.max_retry_sec)
+                    self.retry_ts = time.time() + self.retry_sec
+                    logging.warning("EventForwarder: Keymaster did not take %d events, trying again in %d seconds (%s)" % (len(event_ids), self.retry_sec, e))
+                    return sent
+                self.spool.remove(event_ids)
+                self.retry_sec = 0
+                self.door_retry_sec.pop(door_name, None)
+                self.door_retry_ts.pop(door_name, None)
+                sent += len(event_ids)
+        return sent
+
+    def reject(self, door_name, event_ids, error):
+        # The keymaster answered but turned these down so back off this door alone, and give up on them after max_attempts
+        retry_sec = min(max(self.door_retry_sec.get(door_name, 0) * 2, 1), self.max_retry_sec)
+        self.door_retry_sec[door_name] = retry_sec
+        self.door_retry_ts[door_name] = time.time() + retry_sec
+        set_aside = self.spool.failed(event_ids, str(error), self.max_attempts)
+        logging.warning("EventForwarder: Keymaster turned down %d events for %s, trying again in %d seconds (%s)" % (len(event_ids), door_name, retry_sec, error))
+        if set_aside:
+            logging.error("EventForwarder: Set aside %d events for %s after %d attempts" % (set_aside, door_name, self.max_attempts))
+
+    def stop(self):
+        self.running = False
@@ -2,18 +2,19 @@
 import sys
 import json
 import time
+import Queue
 import logging
 import traceback
 
 from core import Messages, EncryptedConnection, Gatekeeper
 from threads import Heartbeat, EventWatcher
+from event_proxy import EventSpool, EventProxy, EventForwarder
 
 class GatekeeperApp(object):
     def run(self, config):
         try:
             logging.info("Starting up Gatekeeper...")
             gatekeeper = Gatekeeper(config)
-            connection = gatekeeper.get_connection()
 
             # Sync our system clocks
             gatekeeper.set_system_clock()
@@ -22,6 +23,10 @@ class GatekeeperApp(object):
             if gatekeeper.test_keymaster_connection():
                 logging.info("Keymaster encrypted connection successfull!")
 
+            # Throw away the cached cardholders if requested
+            if config['rebuildCache']:
+                gatekeeper.rebuild_cardholder_cache()
+
             # Pull the configuration
             gatekeeper.configure_doors()
             if len(gatekeeper.doors) == 0:
@@ -36,11 +41,26 @@ class GatekeeperApp(object):
             # Clear out all the door codes if requested
             if config['clearCodes']:
                 gatekeeper.clear_all_codes()
-                initialSync = True
+                config['initialSync'] = True
 
             # Pull new data if requested
             if config['initialSync']:
-                gatekeeper.pull_door_codes()
+                gatekeeper.pull_door_codes(full=True)
+
+            # Doors which push their events to our proxy don't need to be polled
+            poll_doors = None
+            event_spool = None
+            event_proxy = None
+            event_forwarder = None
+            if config.get('EVENT_PROXY_PORT'):
+                push_doors = config.get('EVENT_PUSH_DOORS', gatekeeper.doors.keys())
+                poll_doors = [name for name in gatekeeper.doors if name not in push_doors]
+                event_queue = Queue.PriorityQueue()
+                event_spool = EventSpool(config.get('EVENT_SPOOL_FILE', 'event_spool.sqlite'))
+                logging.info("Starting Event Proxy (%d events spooled)..." % event_spool.count())
+                event_proxy = EventProxy(gatekeeper, event_queue, config['EVENT_PROXY_PORT'], config.get('EVENT_PROXY_HOST', '127.0.0.1'))
+                event_proxy.setDaemon(True)
+                event_proxy.start()
 
             try:
                 # Start with a clean bowl
@@ -65,28 +85,41 @@ class GatekeeperApp(object):
                         if not hb_conn_err:
                             logging.info("Starting Heartbeat...")
                             poll_delay = config.get('KEYMASTER_POLL_DELAY_SEC', 5)
-                            heartbeat = Heartbeat(connection, poll_delay)
+                            heartbeat = Heartbeat(gatekeeper, poll_delay, event_spool)
                             heartbeat.setDaemon(True)
                             heartbeat.start()
 
-                    # Keep our event watcher alive
-                    if not event_watcher or not event_watcher.is_alive():
+                    # Keep our event watcher alive for the doors we have to poll
+                    if poll_doors != [] and (not event_watcher or not event_watcher.is_alive()):
                         if event_watcher and event_watcher.error:
                             gatekeeper.send_gatekeper_log("EventWatcher: " + str(event_watcher.error))
                             time.sleep(5)
 
                         logging.info("Starting Event Watcher...")
                         poll_delay = config.get('EVENT_POLL_DELAY_SEC', 10)
-                        event_watcher = EventWatcher(gatekeeper, poll_delay)
+                        event_watcher = EventWatcher(gatekeeper, poll_delay, poll_doors)
                         event_watcher.setDaemon(True)
                         event_watcher.start()
 
+                    # Keep our event forwarder alive when the doors push events to us
+                    if event_proxy and (not event_forwarder or not event_forwarder.is_alive()):
+                        if event_forwarder and event_forwarder.error:
+                            gatekeeper.send_gatekeper_log("EventForwarder: " + str(event_forwarder.error))
+                            time.sleep(5)
+
+                        logging.info("Starting Event Forwarder...")
+                        event_forwarder = EventForwarder(gatekeeper, event_queue, event_spool,
+                            config.get('EVENT_BATCH_SIZE', 50), config.get('EVENT_BATCH_DELAY_SEC', 2),
+                            max_attempts=config.get('EVENT_MAX_ATTEMPTS', 10))
+                        event_forwarder.setDaemon(True)
+                        event_forwarder.start()
+
                     if heartbeat.new_data:
                         gatekeeper.pull_door_codes()
                         heartbeat.all_clear()
 
-                    if event_watcher.new_data:
-                        event_logs = gatekeeper.pull_event_logs()
+                    if event_watcher and event_watcher.new_data:
+                        event_logs = gatekeeper.pull_event_logs(door_names=poll_doors)
                         gatekeeper.push_event_logs(event_logs)
                         event_watcher.all_clear()
 
@@ -101,6 +134,11 @@ class GatekeeperApp(object):
                 if event_watcher and event_watcher.is_alive():
                     event_watcher.stop()
                     #event_watcher.join()
+                if event_proxy:
+                    logging.info("Shutting down Event Proxy...")
+                    event_proxy.stop()
+                if event_forwarder and event_forwarder.is_alive():
+                    event_forwarder.stop()
 
         except Exception as e:
             traceback.print_exc()
@@ -116,6 +154,7 @@ if __name__ == "__main__":
     config['initialSync'] = "--sync" in sys.argv
     config['syncClocks'] = "--set-time" in sys.argv
     config['clearCodes'] = "--clear-all" in sys.argv
+    config['rebuildCache'] = "--rebuild-cache" in sys.argv
     if "--debug" in sys.argv:
             config['DEBUG'] = True
 
@@ -1,6 +1,9 @@
+import errno
 import logging
 import threading
-import ssl, urllib, urllib2, base64
+import socket
+import httplib
+import ssl, urllib, base64
 from datetime import datetime
 from xml.etree import ElementTree
 
@@ -12,30 +15,103 @@ logger = logging.getLogger(__name__)
 # Communication Logic
 ###############################################################################################################
 
+# Controllers only offer old ciphers so every connection shares one context set up for them
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+def vertx_ssl_context():
+    global _ssl_context
+    with _ssl_context_lock:
+        if not _ssl_context:
+            context = ssl._create_unverified_context()
+            context.set_ciphers('RC4-SHA')
+            _ssl_context = context
+    return _ssl_context
+
+
+class VertXConnection(object):
+    """An HTTPS connection to one controller which is kept open between commands"""
+    XML_PATH = "/cgi-bin/vertx_xml.cgi"
+
+    def __init__(self, ip_address, username, password, timeout=30):
+        self.ip_address = ip_address
+        self.timeout = timeout
+        self.auth_header = "Basic %s" % base64.encodestring('%s:%s' % (username, password)).replace('\n', '')
+        self.connection = None
+        self.reused = False
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def send(self, xml_str):
+        body = urllib.urlencode({'XML': xml_str})
+        headers = {"Authorization": self.auth_header, "Content-Type": "application/x-www-form-urlencoded"}
+        with self.lock:
+            while True:
+                if not self.connection:
+                    self.connection = self.connect()
+                    self.reused = False
+                # The controller may have dropped a connection we kept open.  Commands like adding a cardholder
+                # must never run twice so only try again on a fresh one when we know the command never got there.
+                try:
+                    self.connection.request("POST", self.XML_PATH, body, headers)
+                except (httplib.HTTPException, socket.error):
+                    retry = self.reused
+                    self.close()
+                    if not retry:
+                        raise
+                    continue
+                try:
+                    result = self.connection.getresponse()
+                    return_xml = result.read()
+                    break
+                except (httplib.HTTPException, socket.error) as e:
+                    retry = self.reused and dropped_before_response(e)
+                    self.close()
+                    if not retry:
+                        raise
+            self.reused = not result.will_close
+            if result.will_close:
+                self.close()
+            self.round_trips += 1
+        return (result.status, return_xml)
+
+    def connect(self):
+        return httplib.HTTPSConnection(self.ip_address, timeout=self.timeout, context=vertx_ssl_context())
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+def dropped_before_response(e):
+    # How a connection the controller had already closed fails, before it could have seen the command.
+    # A timeout means the controller may still be working on it.
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        return not e.line or e.line.startswith("No status line received")
+    return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+
 class HIDDoorController(DoorController):
+    # Records pulled per round trip when listing cardholders and credentials
+    PAGE_SIZE = 100
+
+    # Commands whose children the controller accepts together under one parent element
+    MERGEABLE_COMMANDS = (('hid:Credentials', 'AD'),)
 
     def __init__(self, name, ip_address, username, password):
-        self.lock = threading.Lock()
         super(HIDDoorController, self).__init__(name, ip_address, username, password)
+        self.connection = VertXConnection(ip_address, username, password)
+
+    @property
+    def round_trips(self):
+        return self.connection.round_trips
 
     def __send_xml_str(self, xml_str):
         logger.debug("Sending: %s" % xml_str)
-
-        xml_data = urllib.urlencode({'XML': xml_str})
-        request = urllib2.Request(self.door_url(), xml_data)
-        base64string = base64.encodestring('%s:%s' % (self.door_user, self.door_pass)).replace('\n', '')
-        request.add_header("Authorization", "Basic %s" % base64string)
-        context = ssl._create_unverified_context()
-        context.set_ciphers('RC4-SHA')
-
-        self.lock.acquire()
-        try:
-            result = urllib2.urlopen(request, context=context)
-            return_code = result.getcode()
-            return_xml = result.read()
-            result.close()
-        finally:
-            self.lock.release()
+        return_code, return_xml = self.connection.send(xml_str)
 
         logger.debug("Response code: %d" % return_code)
         logger.debug("Response: %s" % return_xml)
@@ -51,6 +127,13 @@ class HIDDoorController(DoorController):
         xml_str = ElementTree.tostring(xml, encoding='utf8', method='xml')
         return self.__send_xml_str(xml_str)
 
+    def send_commands(self, commands):
+        # Send the given commands in as few envelopes as the controller allows
+        responses = []
+        for envelope in merge_commands(commands, self.MERGEABLE_COMMANDS):
+            responses.append(self.__send_xml(envelope))
+        return responses
+
     def test_connection(self):
         test_xml = list_doors()
         self.__send_xml(test_xml)
@@ -62,7 +145,7 @@ class HIDDoorController(DoorController):
     def load_cardholders(self):
         self.clear_data()
         offset = 0
-        count = 10
+        count = self.PAGE_SIZE
         moreRecords = True
         while moreRecords:
             #logger.debug("offset: %d, count: %d" % (offset, count))
@@ -89,7 +172,7 @@ class HIDDoorController(DoorController):
         # This method pulls all the credentials and infuses the cardholders with their card numbers.
         self.load_cardholders()
         offset = 0
-        count = 10
+        count = self.PAGE_SIZE
         moreRecords = True
         while moreRecords:
             xml_str = self.__send_xml(list_credentials(offset, count))
@@ -111,12 +194,31 @@ class HIDDoorController(DoorController):
                 offset = offset + count
         logger.debug(self.cardholders_by_id)
 
+    def cardholder_marker(self):
+        # How many cardholders there are and the last one, since the controller lists them in cardholderID order
+        if not self.cardholders_by_id:
+            return "0:"
+        return "%d:%s" % (len(self.cardholders_by_id), max(self.cardholders_by_id.keys(), key=int))
+
+    def marker_is_current(self, marker):
+        # One round trip for the last cardholder we know of and anything after it
+        count, last_id = marker.split(":")
+        count = int(count)
+        xml_str = self.__send_xml(list_cardholders(max(count - 1, 0), 2))
+        xml = ElementTree.fromstring(xml_str)
+        ids = [child.attrib.get('cardholderID') for child in xml[0]]
+        return ids == ([last_id] if count else [])
+
     def clear_door_codes(self):
         self.load_credentials()
         for cardholderID, cardholder in self.cardholders_by_id.items():
             self.delete_cardholder(cardholder)
 
     def add_cardholder(self, cardholder):
+        self.send_commands([create_credential(cardholder.code)])
+        return self.__add_cardholder_with_credential(cardholder)
+
+    def __add_cardholder_with_credential(self, cardholder):
         first = cardholder.first_name
         last = cardholder.last_name
         username = cardholder.username
@@ -125,11 +227,31 @@ class HIDDoorController(DoorController):
         cardholderID = get_attribute(response, 'cardholderID')
         cardholder.id = cardholderID
         logger.debug("New Cardholder: username: %s, cardholderID: %s" % (username, cardholderID))
-        self.__send_xml(create_credential(cardNumber))
         self.__send_xml(assign_credential(cardholderID, cardNumber))
         self.__send_xml(add_roleset(cardholderID))
         return cardholderID
 
+    def add_cardholders(self, cardholders):
+        # All the new credentials go in one envelope, only the cardholders need one at a time
+        self.send_commands([create_credential(c.code) for c in cardholders])
+        for cardholder in cardholders:
+            self.__add_cardholder_with_credential(cardholder)
+            self.save_cardholder(cardholder)
+
+    def process_changes(self, change_list):
+        start_count = self.round_trips
+        deletes = [c for c in change_list if c.action == 'delete']
+        adds = [c for c in change_list if c.action == 'add']
+        # Deletes go first so codes being moved to someone new are free again
+        super(HIDDoorController, self).process_changes(deletes)
+        if adds:
+            for c in adds:
+                logging.debug("DoorController [%s]: Add - %s" % (self.door_name, c.get_full_name()))
+            self.add_cardholders(adds)
+            for c in adds:
+                del c.action
+        logger.info("HIDDoorController[%s]: %d changes in %d round trips" % (self.door_name, len(change_list), self.round_trips - start_count))
+
     def change_cardholder(self, cardholderID, oldCardNumber, newCardNumber):
         if oldCardNumber:
             self.__send_xml(delete_credential(oldCardNumber))
@@ -213,6 +335,21 @@ def get_attribute(xml_str, attribute):
         e_end = xml_str.index('"', e_start)
         return xml_str[e_start:e_end]
 
+# Fold commands into the one before them when both are the same mergeable action,
+# leaving everything else as its own envelope
+def merge_commands(commands, mergeable):
+    envelopes = []
+    last_parent = None
+    for command in commands:
+        parent = command[0]
+        key = (parent.tag, parent.get('action'))
+        if key in mergeable and last_parent is not None and parent.tag == last_parent.tag and parent.attrib == last_parent.attrib:
+            last_parent.extend(list(parent))
+        else:
+            envelopes.append(command)
+            last_parent = parent
+    return envelopes
+
 def send_xml(ip_address, username, password, xml_str):
     controller = DoorController(ip_address, username, password)
     return controller.__send_xml_str(xml_str)
@@ -0,0 +1,26 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from doors.keymaster.models import DoorCodeChange
+
+
+class Command(BaseCommand):
+    help = "Deletes the door code changes older than the retention.  Gatekeepers further behind than that get every code."
+    requires_system_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention', type=int, dest='retention', default=None, help="Days of door code changes to keep (default DOOR_CODE_CHANGE_RETENTION_DAYS)")
+
+    def handle(self, **options):
+        start = time.time()
+        retention = options['retention']
+        if retention is None:
+            retention = getattr(settings, 'DOOR_CODE_CHANGE_RETENTION_DAYS', 90)
+        if retention < 0:
+            raise CommandError("Invalid retention: %d" % retention)
+        deleted = DoorCodeChange.objects.purge(timezone.now() - timedelta(days=retention))
+        print("Deleted %d door code changes in %.2f seconds" % (deleted, time.time() - start))
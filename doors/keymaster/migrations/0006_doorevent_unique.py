@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:17
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def forward(apps, schema_editor):
+    DoorEvent = apps.get_model("keymaster", "DoorEvent")
+
+    # Keep the first copy of any event which was stored more than once
+    duplicates = DoorEvent.objects.values('door', 'timestamp', 'code', 'event_type').annotate(first_id=Min('id'), count=Count('id')).filter(count__gt=1)
+    for d in duplicates:
+        copies = DoorEvent.objects.filter(door=d['door'], timestamp=d['timestamp'], code=d['code'], event_type=d['event_type'])
+        copies.exclude(id=d['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keymaster', '0005_keymaster_is_syncing'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='doorevent',
+            unique_together=set([('door', 'timestamp', 'code', 'event_type')]),
+        ),
+    ]
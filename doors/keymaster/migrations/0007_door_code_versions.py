@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keymaster', '0006_doorevent_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoorCodeChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_ts', models.DateTimeField(auto_now_add=True)),
+                ('code', models.CharField(db_index=True, max_length=16)),
+                ('deleted', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='doorcode',
+            name='version',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
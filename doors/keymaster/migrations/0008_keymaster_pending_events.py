@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keymaster', '0007_door_code_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='keymaster',
+            name='pending_events',
+            field=models.IntegerField(default=0),
+        ),
+    ]
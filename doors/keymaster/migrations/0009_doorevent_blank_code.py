@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:51
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+
+def forward(apps, schema_editor):
+    DoorEvent = apps.get_model("keymaster", "DoorEvent")
+
+    def same_event(**kwargs):
+        return Exists(DoorEvent.objects.filter(door=OuterRef('door'), timestamp=OuterRef('timestamp'), event_type=OuterRef('event_type'), **kwargs))
+
+    # NULL codes never collide so the same event without a code may have been stored more than once, keep the first
+    no_code = DoorEvent.objects.filter(code__isnull=True)
+    no_code.annotate(copy=same_event(code__isnull=True, id__lt=OuterRef('id'))).filter(copy=True).delete()
+
+    # Then make way for the ones without a code which already have a blank code twin
+    no_code.annotate(twin=same_event(code="")).filter(twin=True).delete()
+    no_code.update(code="")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('keymaster', '0008_keymaster_pending_events'),
+    ]
+
+    operations = [
+        migrations.RunPython(forward, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='doorevent',
+            name='code',
+            field=models.CharField(blank=True, default=b'', max_length=16),
+        ),
+    ]
@@ -1,13 +1,15 @@
+import copy
 import json
 import logging
 import requests
+import threading
 
 from datetime import datetime, time, date, timedelta
 
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models.signals import post_delete
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 from django.core import mail
 from django.utils import timezone
@@ -16,17 +18,62 @@ from doors.core import DoorTypes, DoorEventTypes, Messages, EncryptedConnection
 
 logger = logging.getLogger(__name__)
 
+# How often we record that a gatekeeper checked in, rather than on every message
+KEYMASTER_ACCESS_INTERVAL_SEC = getattr(settings, 'KEYMASTER_ACCESS_INTERVAL_SEC', 60)
+
+# How long this process trusts what it knows about the keymasters and the door code version.
+# Changes made in this process are seen right away, ones made by other processes after this long.
+KEYMASTER_STATE_TTL_SEC = getattr(settings, 'KEYMASTER_STATE_TTL_SEC', 30)
+
+# Key for the PostgreSQL advisory lock held while recording a door code change
+CODE_CHANGE_LOCK_KEY = 0x44434348
+
+
+class KeymasterState(object):
+    """In process cache of the keymaster rows and door code version every gatekeeper check in needs"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def get(self, key, load):
+        now = timezone.now()
+        with self.lock:
+            if key in self.values and self.values[key][1] > now:
+                return self.values[key][0]
+        value = load()
+        with self.lock:
+            self.values[key] = (value, now + timedelta(seconds=self.ttl))
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.values.clear()
+            else:
+                self.values.pop(key, None)
+
+keymaster_state = KeymasterState(KEYMASTER_STATE_TTL_SEC)
+
+
+def current_code_version():
+    return keymaster_state.get('code_version', DoorCodeChange.objects.current_version)
+
 
 class KeymasterManager(models.Manager):
 
     # Pull an object from the database linked by the incoming IP address
     def by_ip(self, ip_address):
         try:
-            keymaster = self.get(gatekeeper_ip=ip_address)
-            if not keymaster.is_enabled:
+            # Every message looks this up so keep it around, handing out copies since requests run in threads
+            cached = keymaster_state.get(('keymaster', ip_address), lambda: self.get(gatekeeper_ip=ip_address))
+            # Whether it is enabled always comes from the database so turning a keymaster off takes effect right away
+            if not self.filter(id=cached.id, is_enabled=True).exists():
                 raise Exception("Keymaster for this IP address is disabled")
-            # A save updates the access_ts
-            keymaster.save()
+            keymaster = copy.copy(cached)
+            keymaster.is_enabled = True
+            keymaster.touch()
             return keymaster
         except MultipleObjectsReturned as me:
             logger.error("Multiple Keymasters returned for IP: %s" % ip_address)
@@ -47,10 +94,36 @@ class Keymaster(models.Model):
     sync_ts = models.DateTimeField(null=True, blank=True)
     is_enabled = models.BooleanField(default=False)
     is_syncing = models.BooleanField(default=False)
+    pending_events = models.IntegerField(default=0)
 
     def get_encrypted_connection(self):
         return EncryptedConnection(self.encryption_key)
 
+    def is_due(self, ts):
+        return not ts or timezone.now() - ts >= timedelta(seconds=KEYMASTER_ACCESS_INTERVAL_SEC)
+
+    def record(self, **fields):
+        # Update rather than save so nothing else on this row gets written, then drop our cached copy
+        Keymaster.objects.filter(id=self.id).update(**fields)
+        for name, value in fields.items():
+            setattr(self, name, value)
+        keymaster_state.invalidate(('keymaster', self.gatekeeper_ip))
+
+    def touch(self):
+        # Note that we heard from the gatekeeper, at most once every KEYMASTER_ACCESS_INTERVAL_SEC
+        if self.is_due(self.access_ts):
+            self.record(access_ts=timezone.now())
+
+    def heartbeat(self, code_version, pending_events=0):
+        # One round trip tells the gatekeeper what to do and tells us how it's doing
+        if self.is_due(self.success_ts):
+            self.record(success_ts=timezone.now(), pending_events=pending_events)
+        version = current_code_version()
+        action = Messages.NO_NEW_DATA
+        if not self.sync_ts or code_version != version:
+            action = Messages.NEW_DATA
+        return json.dumps({'action': action, 'version': version})
+
     def pull_config(self):
         doors = []
         for d in Door.objects.filter(keymaster=self):
@@ -67,76 +140,89 @@ class Keymaster(models.Model):
 
     def pull_door_codes(self):
         # Mark that we are syncing so humans know something is going on
-        self.is_syncing = True
-        self.save()
+        self.record(is_syncing=True)
 
         # Pull all the codes and send them back
-        codes = []
-        for c in DoorCode.objects.all().order_by('user__username'):
-            u = c.user
-            code = {'username':u.username, 'first_name': u.first_name, 'last_name':u.last_name, 'code':c.code}
-            codes.append(code)
+        codes = [c.to_dict() for c in DoorCode.objects.select_related('user').order_by('user__username')]
         return json.dumps(codes)
 
+    def pull_code_changes(self, since=None):
+        # Mark that we are syncing so humans know something is going on
+        self.record(is_syncing=True)
+
+        # Send everything when the gatekeeper has no version, one we never handed out or one we have since purged
+        version = DoorCodeChange.objects.current_version()
+        if since is None or since > version or (since < version and not DoorCodeChange.objects.is_known(since)):
+            codes = DoorCode.objects.select_related('user').order_by('user__username')
+            return json.dumps({'version': version, 'full': True, 'codes': [c.to_dict() for c in codes], 'deleted': []})
+
+        # Otherwise only the codes touched since then, with the ones now gone as tombstones
+        changed = set(DoorCodeChange.objects.filter(id__gt=since, id__lte=version).values_list('code', flat=True))
+        codes = DoorCode.objects.filter(code__in=changed).select_related('user').order_by('user__username')
+        code_list = [c.to_dict() for c in codes]
+        deleted = sorted(changed - set(c['code'] for c in code_list))
+        return json.dumps({'version': version, 'full': False, 'codes': code_list, 'deleted': deleted})
+
     def process_event_logs(self, event_logs):
         if not event_logs:
             raise Exception("process_event_logs: No event logs to process!")
         #logger.debug("process_event_logs: %d doors to process" % len(event_logs))
 
+        # Parse everything we have not seen yet before touching users or codes
+        tz = timezone.get_current_timezone()
+        new_events = []
+        doors = dict((d.name, d) for d in Door.objects.filter(name__in=event_logs.keys()))
         for door_name, events_to_process in event_logs.items():
-            door = Door.objects.get(name=door_name)
-            last_ts = door.get_last_event_ts()
-            logger.debug("Processing events for '%s'. Last TS = %s" % (door_name, last_ts))
+            door = doors.get(door_name)
+            if not door:
+                raise Door.DoesNotExist("Door '%s' does not exist" % door_name)
+            logger.debug("Processing %d events for '%s'" % (len(events_to_process), door_name))
+            # Don't stop at the last timestamp we have.  Pushed events can share a second with it or
+            # arrive out of order, and bulk_record already leaves out the ones we have seen.
             for event in events_to_process:
                 #print("New Event: %s" % event)
                 timestamp = event['timestamp']
-                if timestamp == last_ts:
-                    # We have caught up with the logs so we can stop now
-                    break
-                    # TODO - If we dont' reach this point ever we should signal to the
-                    # Gatekeeper that we needed more logs.
 
                 # Convert the timestamp string to a datetime object
                 # Assert the timezone is the local timezone for this timestamp
-                tz = timezone.get_current_timezone()
                 naive_timestamp = datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
                 tz_timestamp = tz.localize(naive_timestamp)
 
                 # TODO - If our timestamp is too far in the future we have a time sync problem.
 
-                description = event.get('description')
-                event_type = event.get('door_event_type')
-                door_code = event.get('cardNumber')
-
-                # Extract the User from a given username or the door code if we have it
-                user = None
                 cardholder = event.get('cardHolder')
-                if cardholder:
-                    username = cardholder.get('username')
-                    if username:
-                        user = User.objects.filter(username=username).first()
-                elif not user and door_code:
-                    c = DoorCode.objects.filter(code=door_code).first()
-                    if c:
-                        user = c.user
-
-                new_event = DoorEvent.objects.create(timestamp=tz_timestamp, door=door, user=user, code=door_code, event_type=event_type, event_description=description)
+                new_event = DoorEvent(timestamp=tz_timestamp, door=door, code=event.get('cardNumber') or "",
+                    event_type=event.get('door_event_type') or DoorEventTypes.UNKNOWN, event_description=event.get('description'))
+                new_events.append((new_event, cardholder))
+
+        # Extract the User from a given username or the door code if we have it
+        usernames = set(c.get('username') for e, c in new_events if c and c.get('username'))
+        codes = set(e.code for e, c in new_events if not c and e.code)
+        users_by_name = dict(User.objects.filter(username__in=usernames).values_list('username', 'id'))
+        users_by_code = dict(DoorCode.objects.filter(code__in=codes).values_list('code', 'user_id'))
+        for new_event, cardholder in new_events:
+            if cardholder:
+                new_event.user_id = users_by_name.get(cardholder.get('username'))
+            elif new_event.code:
+                new_event.user_id = users_by_code.get(new_event.code)
+
+        created = DoorEvent.objects.bulk_record([e for e, c in new_events])
+        sightings = [(e.user_id, e.timestamp) for e in created if e.user_id]
+
+        from nadine.models.usage import Presence
+        Presence.objects.record_many(sightings, Presence.DOOR)
         return Messages.SUCCESS_RESPONSE
 
     def mark_sync(self):
         # A successfull sync is a success
-        self.success_ts = timezone.now()
-        self.sync_ts = timezone.now()
-        self.is_syncing = False
-        self.save()
+        now = timezone.now()
+        self.record(success_ts=now, sync_ts=now, is_syncing=False)
 
     def mark_success(self):
-        self.success_ts = timezone.now()
-        self.save()
+        self.record(success_ts=timezone.now())
 
     def force_sync(self):
-        self.sync_ts = None
-        self.save()
+        self.record(sync_ts=None)
 
     def unresolved_logs(self):
         return self.gatekeeperlog_set.filter(keymaster=self, resolved=False)
@@ -192,6 +278,12 @@ class Keymaster(models.Model):
     def __str__(self):
         return self.description
 
+def keymaster_callback(sender, **kwargs):
+    keymaster = kwargs['instance']
+    keymaster_state.invalidate(('keymaster', keymaster.gatekeeper_ip))
+post_save.connect(keymaster_callback, sender=Keymaster)
+post_delete.connect(keymaster_callback, sender=Keymaster)
+
 
 class Door(models.Model):
     name = models.CharField(max_length=16, unique=True)
@@ -222,13 +314,73 @@ class DoorCode(models.Model):
     modified_ts = models.DateTimeField(auto_now=True)
     user = models.ForeignKey(User)
     code = models.CharField(max_length=16, unique=True)
+    version = models.IntegerField(default=0, db_index=True)
 
     def get_last_event(self):
         return DoorEvent.objects.filter(code=self.code).order_by('timestamp').reverse().first()
 
+    def to_dict(self):
+        u = self.user
+        return {'username':u.username, 'first_name': u.first_name, 'last_name':u.last_name, 'code':self.code}
+
     def __str__(self):
         return '%s: %s' % (self.user, self.code)
 
+
+class DoorCodeChangeManager(models.Manager):
+
+    def current_version(self):
+        return self.aggregate(version=models.Max('id'))['version'] or 0
+
+    def record(self, code, deleted=False):
+        # A version means every change up to that id so they have to commit in id order.  PostgreSQL hands out
+        # ids before the commit, so hold a lock until this transaction is done and the next change waits on it.
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", [CODE_CHANGE_LOCK_KEY])
+            return self.create(code=code, deleted=deleted)
+
+    def is_known(self, version):
+        # False once the change a gatekeeper last synced to has been purged
+        return self.filter(id=version).exists()
+
+    def purge(self, before_ts):
+        """Deletes the changes made before the given time, keeping the newest so the current version stays put."""
+        return self.filter(created_ts__lt=before_ts).exclude(id=self.current_version()).delete()[0]
+
+
+class DoorCodeChange(models.Model):
+    """Every save or delete of a DoorCode, the id of which is the version gatekeepers sync up to"""
+    objects = DoorCodeChangeManager()
+    created_ts = models.DateTimeField(auto_now_add=True)
+    code = models.CharField(max_length=16, db_index=True)
+    deleted = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '%s: %s%s' % (self.id, self.code, " (deleted)" if self.deleted else "")
+
+def door_code_change_callback(sender, **kwargs):
+    door_code = kwargs['instance']
+    change = DoorCodeChange.objects.record(door_code.code, deleted='created' not in kwargs)
+    if 'created' in kwargs:
+        # Update rather than save so we don't end up right back here
+        DoorCode.objects.filter(id=door_code.id).update(version=change.id)
+        door_code.version = change.id
+    keymaster_state.invalidate('code_version')
+post_save.connect(door_code_change_callback, sender=DoorCode)
+
+def door_code_edit_callback(sender, **kwargs):
+    # Changing the code itself leaves a tombstone for the old one
+    door_code = kwargs['instance']
+    if door_code.id:
+        old_code = DoorCode.objects.filter(id=door_code.id).values_list('code', flat=True).first()
+        if old_code and old_code != door_code.code:
+            DoorCodeChange.objects.record(old_code, deleted=True)
+            keymaster_state.invalidate('code_version')
+pre_save.connect(door_code_edit_callback, sender=DoorCode)
+post_delete.connect(door_code_change_callback, sender=DoorCode)
+
 def door_code_callback(sender, **kwargs):
     door_code = kwargs['instance']
     # For now we are just going to force all keymasters to sync whenever a code is deleted
@@ -249,6 +401,42 @@ class DoorEventManager(models.Manager):
         #logger.debug("users_for_day from '%s' to '%s'" % (start, end))
         return DoorEvent.objects.filter(timestamp__range=(start, end))
 
+    def bulk_record(self, events):
+        """Saves the given unsaved DoorEvents in one transaction, skipping any already stored, and returns the new ones."""
+        new_events = []
+        seen = set()
+        with transaction.atomic():
+            for door_id in set(e.door_id for e in events):
+                door_events = [e for e in events if e.door_id == door_id]
+                timestamps = [e.timestamp for e in door_events]
+                existing = self.filter(door_id=door_id, timestamp__range=(min(timestamps), max(timestamps)))
+                seen.update((door_id, ts, code, event_type) for ts, code, event_type in existing.values_list('timestamp', 'code', 'event_type'))
+            for e in events:
+                key = (e.door_id, e.timestamp, e.code, e.event_type)
+                if key not in seen:
+                    seen.add(key)
+                    new_events.append(e)
+            new_events = self.create_new(new_events)
+        return new_events
+
+    def create_new(self, events):
+        """Inserts the given DoorEvents, leaving out any another push stored in the meantime, and returns the ones inserted."""
+        try:
+            with transaction.atomic():
+                self.bulk_create(events)
+            return events
+        except IntegrityError:
+            # Go one at a time so only the events which are already there get left out
+            created = []
+            for e in events:
+                try:
+                    with transaction.atomic():
+                        e.save()
+                    created.append(e)
+                except IntegrityError:
+                    pass
+            return created
+
 
 class DoorEvent(models.Model):
     objects = DoorEventManager()
@@ -256,10 +444,14 @@ class DoorEvent(models.Model):
     timestamp = models.DateTimeField(null=False)
     door = models.ForeignKey(Door, null=False)
     user = models.ForeignKey(User, null=True, db_index=True)
-    code = models.CharField(max_length=16, null=True)
+    # Blank rather than NULL when there is no code so the unique constraint still applies
+    code = models.CharField(max_length=16, blank=True, default="")
     event_type = models.CharField(max_length=1, choices=DoorEventTypes.CHOICES, default=DoorEventTypes.UNKNOWN, null=False)
     event_description = models.CharField(max_length=256)
 
+    class Meta:
+        unique_together = (("door", "timestamp", "code", "event_type"),)
+
     def __str__(self):
         return '%s: %s' % (self.door, self.event_description)
 
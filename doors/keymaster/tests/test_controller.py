@@ -1,7 +1,12 @@
+import errno
+import socket
+import httplib
+
 from django.test import SimpleTestCase
 from django.utils import timezone
 
 #from doors.hid_control import DoorController
+from doors.hid_control import HIDDoorController, VertXConnection, merge_commands, create_credential, delete_credential
 from doors.keymaster.models import Keymaster
 from doors.core import Messages, EncryptedConnection, CardHolder, Gatekeeper, TestDoorController
 
@@ -72,3 +77,154 @@ class DoorControllerTestCase(SimpleTestCase):
                 self.assertEqual(c.action, 'add')
             else:
                 self.fail("Weird data found")
+
+    def test_process_code_changes(self):
+        c1 = CardHolder("1", "Jacob", "Sayles", "jacobsayles", "123456")
+        c2 = CardHolder("2", "Susan", "Dorsch", "susandorsch", "111111")
+        c3 = CardHolder("3", "Bob", "Smith", "bobsmith", "666666")
+
+        self.controller.clear_data()
+        self.controller.save_cardholder(c1)  # Untouched
+        self.controller.save_cardholder(c2)  # Given to someone else
+        self.controller.save_cardholder(c3)  # Deleted
+
+        new_codes = [
+            {'username':'fredjones', 'first_name':'Fred', 'last_name':'Jones', 'code':'111111'},  # Change
+            {'username':'amyjones', 'first_name':'Amy', 'last_name':'Jones', 'code':'7777777'},  # Add
+        ]
+        changes = self.controller.process_code_changes(new_codes, ['666666', '999999'])
+        self.assertEqual([(c.username, c.action) for c in changes], [
+            ('bobsmith', 'delete'), ('susandorsch', 'delete'), ('fredjones', 'add'), ('amyjones', 'add')])
+
+        # Applying them keeps what we know about the door current
+        self.controller.process_changes(changes)
+        self.assertEqual(self.controller.get_cardholder_by_code('123456'), c1)
+        self.assertEqual(self.controller.get_cardholder_by_code('111111').username, 'fredjones')
+        self.assertEqual(self.controller.get_cardholder_by_code('666666'), None)
+        self.assertEqual(self.controller.get_cardholder_by_code('7777777').username, 'amyjones')
+
+
+class FakeVertXConnection(object):
+    # Answers like a controller would without going over the network
+    def __init__(self):
+        self.sent = []
+        self.round_trips = 0
+
+    def send(self, xml_str):
+        self.sent.append(xml_str)
+        self.round_trips += 1
+        if 'hid:Cardholders action="AD"' in xml_str:
+            return (200, '<VertXMessage><hid:Cardholders action="RS"><hid:Cardholder cardholderID="%d" /></hid:Cardholders></VertXMessage>' % (100 + self.round_trips))
+        if 'action="LR"' in xml_str:
+            return (200, '<VertXMessage xmlns:hid="http://www.hidcorp.com/VertX"><hid:Cardholders action="RL" recordCount="0" /></VertXMessage>')
+        return (200, '<VertXMessage />')
+
+
+class FakeHTTPSConnection(object):
+    # Fails the way it is told to the first time it is used
+    def __init__(self, request_error=None, response_error=None):
+        self.request_error = request_error
+        self.response_error = response_error
+        self.requests = 0
+
+    def request(self, method, url, body, headers):
+        self.requests += 1
+        if self.request_error:
+            raise self.request_error
+
+    def getresponse(self):
+        if self.response_error:
+            raise self.response_error
+        return FakeHTTPResponse()
+
+    def close(self):
+        pass
+
+
+class FakeHTTPResponse(object):
+    status = 200
+    will_close = False
+
+    def read(self):
+        return '<VertXMessage />'
+
+
+class ScriptedVertXConnection(VertXConnection):
+    def __init__(self, connections):
+        super(ScriptedVertXConnection, self).__init__("127.0.0.1", "username", "password")
+        self.connections = connections
+
+    def connect(self):
+        return self.connections.pop(0)
+
+
+class HIDDoorControllerTestCase(SimpleTestCase):
+
+    def test_retry(self):
+        def kept_open(failure):
+            connection = ScriptedVertXConnection([failure, FakeHTTPSConnection()])
+            connection.connection = connection.connections.pop(0)
+            connection.reused = True
+            return connection
+
+        # A connection the controller closed while we weren't using it is replaced
+        for failure in [FakeHTTPSConnection(request_error=socket.error(errno.EPIPE, "Broken pipe")),
+                FakeHTTPSConnection(response_error=httplib.BadStatusLine("No status line received - the server has closed the connection")),
+                FakeHTTPSConnection(response_error=socket.error(errno.ECONNRESET, "Connection reset by peer"))]:
+            connection = kept_open(failure)
+            self.assertEqual(connection.send("<VertXMessage />"), (200, '<VertXMessage />'))
+            self.assertEqual(connection.round_trips, 1)
+
+        # But a command the controller may have run is never sent again
+        for failure in [FakeHTTPSConnection(response_error=socket.timeout("timed out")),
+                FakeHTTPSConnection(response_error=httplib.BadStatusLine("garbage"))]:
+            connection = kept_open(failure)
+            with self.assertRaises(Exception):
+                connection.send("<VertXMessage />")
+            self.assertEqual(len(connection.connections), 1)
+
+        # Nor is anything retried on a new connection
+        connection = ScriptedVertXConnection([FakeHTTPSConnection(request_error=socket.error(errno.ECONNREFUSED, "Connection refused")), FakeHTTPSConnection()])
+        with self.assertRaises(socket.error):
+            connection.send("<VertXMessage />")
+
+    def test_merge_commands(self):
+        commands = [create_credential("111111"), create_credential("222222"), delete_credential("333333"), delete_credential("444444"), create_credential("555555")]
+        envelopes = merge_commands(commands, HIDDoorController.MERGEABLE_COMMANDS)
+        self.assertEqual(len(envelopes), 4)
+        self.assertEqual([c.get('cardNumber') for c in envelopes[0][0]], ["111111", "222222"])
+        self.assertEqual([e[0].get('action') for e in envelopes], ['AD', 'DD', 'DD', 'AD'])
+
+    def test_process_changes(self):
+        controller = HIDDoorController("front", "127.0.0.1", "username", "password")
+        controller.connection = FakeVertXConnection()
+        old = CardHolder("1", "Bob", "Smith", "bobsmith", "666666")
+        controller.save_cardholder(old)
+        old.action = 'delete'
+        changes = [old]
+        for i in range(3):
+            c = CardHolder(None, "New", "Member %d" % i, "member%d" % i, "12345%d" % i)
+            c.action = 'add'
+            changes.append(c)
+
+        # Two to delete and one for all the credentials, then three for each cardholder
+        controller.process_changes(changes)
+        self.assertEqual(controller.round_trips, 12)
+        self.assertEqual(controller.connection.sent[2].count("<hid:Credential "), 3)
+        self.assertEqual(controller.get_cardholder_by_code("666666"), None)
+        self.assertEqual(controller.get_cardholder_by_code("123452").id, "110")
+        self.assertEqual(controller.cardholder_count(), 3)
+
+    def test_marker(self):
+        controller = HIDDoorController("front", "127.0.0.1", "username", "password")
+        controller.connection = FakeVertXConnection()
+        self.assertEqual(controller.cardholder_marker(), "0:")
+        controller.save_cardholder(CardHolder("9", "Jacob", "Sayles", "jacobsayles", "123456"))
+        controller.save_cardholder(CardHolder("10", "Susan", "Dorsch", "susandorsch", "111111"))
+        self.assertEqual(controller.cardholder_marker(), "2:10")
+
+        # The door has nothing where we expect the last cardholder to be
+        self.assertFalse(controller.marker_is_current("2:10"))
+        self.assertTrue('recordOffset="1"' in controller.connection.sent[0])
+        self.assertTrue(controller.marker_is_current("0:"))
+
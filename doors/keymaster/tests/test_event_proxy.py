@@ -0,0 +1,162 @@
+import os
+import time
+import Queue
+import tempfile
+import requests
+
+from django.test import SimpleTestCase
+
+from doors.core import DoorEventTypes, CardHolder, TestDoorController, KeymasterError
+from doors.event_proxy import EventSpool, EventProxy, EventForwarder, ACCESS_PRIORITY, OTHER_PRIORITY
+
+
+class StubGatekeeper(object):
+    card_secret = None
+
+    def __init__(self):
+        self.controller = TestDoorController("front", "127.0.0.2", "admin", "secret")
+        self.controller.save_cardholder(CardHolder("1", "Jacob", "Sayles", "jacobsayles", "123456"))
+        self.magic_tests = []
+        self.pushed = []
+        self.fail_pushes = 0
+        self.unknown_doors = set()
+
+    def get_door(self, door_name):
+        if door_name == "front":
+            return {'name': door_name, 'ip_address': "127.0.0.1", 'controller': self.controller}
+        if door_name == "side":
+            return {'name': door_name, 'ip_address': "10.0.0.5", 'controller': self.controller}
+        raise Exception("Door not found")
+
+    def magic_key_test(self, door_name, code):
+        self.magic_tests.append((door_name, code))
+
+    def push_event_logs(self, event_logs, reconfig=True):
+        if self.fail_pushes:
+            self.fail_pushes -= 1
+            raise Exception("Keymaster unreachable")
+        if self.unknown_doors.intersection(event_logs):
+            raise KeymasterError("Door does not exist")
+        self.pushed.append(event_logs)
+
+
+class EventProxyTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.spool_file = os.path.join(tempfile.mkdtemp(), "event_spool.sqlite")
+
+    def test_spool(self):
+        spool = EventSpool(self.spool_file)
+        self.assertEqual(spool.oldest(), None)
+        for i in range(3):
+            spool.add("front", {'timestamp': "2017-01-02T09:0%d:00" % i})
+        spool.close()
+
+        # Whatever was waiting is still there after a restart
+        spool = EventSpool(self.spool_file)
+        self.assertEqual(spool.count(), 3)
+        pending = spool.pending(2)
+        self.assertEqual([e['timestamp'] for i, d, e in pending], ["2017-01-02T09:00:00", "2017-01-02T09:01:00"])
+        spool.remove([i for i, d, e in pending])
+        self.assertEqual(spool.count(), 1)
+
+        # Access events are sent ahead of the rest
+        spool.add("back", {'timestamp': "2017-01-02T09:03:00"}, ACCESS_PRIORITY)
+        self.assertEqual([(d, e['timestamp']) for i, d, e in spool.pending(2)], [("back", "2017-01-02T09:03:00"), ("front", "2017-01-02T09:02:00")])
+        self.assertEqual(spool.count(skip_doors=["back"]), 1)
+        self.assertEqual([d for i, d, e in spool.pending(2, skip_doors=["back"])], ["front"])
+
+    def test_proxy(self):
+        gatekeeper = StubGatekeeper()
+        queue = Queue.PriorityQueue()
+        proxy = EventProxy(gatekeeper, queue, 0, host='127.0.0.1')
+        proxy.setDaemon(True)
+        proxy.start()
+        try:
+            url = "http://127.0.0.1:%d/" % proxy.server.server_address[1]
+            self.assertEqual(requests.get(url, params={'doorname': "front", 'action': "unlocked"}).status_code, 200)
+            self.assertEqual(requests.post(url, data={'doorname': "front", 'action': "GRANTED", 'cardnumber': "123456", 'firstname': "Jacob", 'lastname': "Sayles"}).status_code, 200)
+            self.assertEqual(requests.get(url, params={'doorname': "back", 'action': "GRANTED"}).status_code, 400)
+            # Nobody else gets to speak for a door
+            self.assertEqual(requests.post(url, data={'doorname': "side", 'action': "UNLOCKED"}).status_code, 403)
+        finally:
+            proxy.stop()
+
+        self.assertEqual(gatekeeper.magic_tests, [("front", None), ("front", "123456")])
+        # Access events come out first
+        priority, sequence, door_name, event = queue.get_nowait()
+        self.assertEqual((priority, door_name, event['door_event_type']), (ACCESS_PRIORITY, "front", DoorEventTypes.GRANTED))
+        self.assertEqual(event['cardHolder']['username'], "jacobsayles")
+        priority, sequence, door_name, event = queue.get_nowait()
+        self.assertEqual((priority, event['door_event_type']), (OTHER_PRIORITY, DoorEventTypes.UNLOCKED))
+        self.assertTrue(queue.empty())
+
+    def test_forwarder(self):
+        gatekeeper = StubGatekeeper()
+        queue = Queue.PriorityQueue()
+        spool = EventSpool(self.spool_file)
+        forwarder = EventForwarder(gatekeeper, queue, spool, batch_size=3, batch_delay_sec=60)
+        for i in range(2):
+            queue.put((ACCESS_PRIORITY, i, "front", {'timestamp': "2017-01-02T09:0%d:00" % i}))
+        forwarder.spool_queued(timeout=0.1)
+        self.assertTrue(queue.empty())
+        self.assertEqual(spool.count(), 2)
+        self.assertFalse(forwarder.batch_ready())
+
+        # A full batch goes right away
+        queue.put((OTHER_PRIORITY, 2, "back", {'timestamp': "2017-01-02T09:02:00"}))
+        forwarder.spool_queued(timeout=0.1)
+        self.assertTrue(forwarder.batch_ready())
+
+        # Nothing is lost while the keymaster is down
+        gatekeeper.fail_pushes = 1
+        self.assertEqual(forwarder.flush(), 0)
+        self.assertEqual(spool.count(), 3)
+        self.assertEqual(forwarder.retry_sec, 1)
+        self.assertFalse(forwarder.batch_ready())
+
+        forwarder.retry_ts = 0
+        self.assertEqual(forwarder.flush(), 3)
+        self.assertEqual(spool.count(), 0)
+        # Each door's events go on their own
+        self.assertEqual(sorted(gatekeeper.pushed), sorted([
+            {'front': [{'timestamp': "2017-01-02T09:01:00"}, {'timestamp': "2017-01-02T09:00:00"}]},
+            {'back': [{'timestamp': "2017-01-02T09:02:00"}]},
+        ]))
+
+        # Otherwise events wait no longer than the batch delay
+        forwarder.batch_delay_sec = 0.1
+        spool.add("front", {'timestamp': "2017-01-02T09:03:00"})
+        self.assertFalse(forwarder.batch_ready())
+        time.sleep(0.2)
+        self.assertTrue(forwarder.batch_ready())
+
+    def test_rejected(self):
+        gatekeeper = StubGatekeeper()
+        gatekeeper.unknown_doors.add("gone")
+        spool = EventSpool(self.spool_file)
+        forwarder = EventForwarder(gatekeeper, Queue.PriorityQueue(), spool, batch_size=2, batch_delay_sec=0, max_attempts=2)
+        for i in range(3):
+            spool.add("gone", {'timestamp': "2017-01-02T09:0%d:00" % i})
+        spool.add("front", {'timestamp': "2017-01-02T09:03:00"})
+
+        # A door the keymaster won't take events for doesn't hold up the others
+        self.assertEqual(forwarder.flush(), 1)
+        self.assertEqual(gatekeeper.pushed, [{'front': [{'timestamp': "2017-01-02T09:03:00"}]}])
+        self.assertEqual(forwarder.retry_sec, 0)
+        self.assertEqual(forwarder.door_retry_sec, {'gone': 1})
+        self.assertEqual(spool.count(), 3)
+        self.assertFalse(forwarder.batch_ready())
+
+        # And its events are set aside once they have run out of attempts
+        forwarder.door_retry_ts['gone'] = 0
+        self.assertTrue(forwarder.batch_ready())
+        self.assertEqual(forwarder.flush(), 0)
+        self.assertEqual(spool.count(), 1)
+        self.assertEqual(spool.rejected_count(), 2)
+        forwarder.door_retry_ts['gone'] = 0
+        forwarder.flush()
+        forwarder.door_retry_ts['gone'] = 0
+        forwarder.flush()
+        self.assertEqual(spool.count(), 0)
+        self.assertEqual(spool.rejected_count(), 3)
@@ -1,11 +1,19 @@
+import os
+import json
+import time
+import tempfile
 import traceback
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta, date
 
 from django.test import TestCase
+from django.core.urlresolvers import reverse
 from django.utils import timezone
+from django.contrib.auth.models import User
 
-from doors.keymaster.models import Keymaster, GatekeeperLog
-from doors.core import Messages, EncryptedConnection, Gatekeeper
+from doors.keymaster.models import Keymaster, GatekeeperLog, Door, DoorCode, DoorCodeChange, DoorEvent, current_code_version
+from doors.core import Messages, EncryptedConnection, Gatekeeper, DoorTypes, DoorEventTypes, TestDoorController, CardHolder
+from doors.transport_benchmark import StubKeymaster
 
 from cryptography.fernet import Fernet
 
@@ -20,6 +28,45 @@ class EncryptedConnectionTestCase(TestCase):
         self.assertNotEqual(message, encrypted_message)
         self.assertEqual(message, decrypted_message)
 
+    def test_compression(self):
+        connection = EncryptedConnection(Fernet.generate_key())
+        small = "x" * 10
+        large = json.dumps([{'username': "member%d" % i, 'code': "%06d" % i} for i in range(100)])
+        encrypted, encoding = connection.encode_payload(small)
+        self.assertEqual(encoding, None)
+        self.assertEqual(connection.decode_payload(encrypted, encoding), small)
+        encrypted, encoding = connection.encode_payload(large)
+        self.assertEqual(encoding, EncryptedConnection.ZLIB)
+        self.assertTrue(len(encrypted) < len(large))
+        self.assertEqual(connection.decode_payload(encrypted, encoding), large)
+
+        # Responses are only compressed for gatekeepers which asked
+        self.assertFalse('encoding' in connection.response_package(large))
+        connection.accepts_zlib = True
+        self.assertEqual(connection.response_package(large)['encoding'], EncryptedConnection.ZLIB)
+
+    def test_transport(self):
+        key = Fernet.generate_key()
+        keymaster = StubKeymaster(key, latency=0.1, door_code_count=100)
+        keymaster.start()
+        connection = EncryptedConnection(key, keymaster.url(), pool_size=4)
+        try:
+            codes = json.loads(connection.send_message(Messages.PULL_DOOR_CODES))
+            self.assertEqual(len(codes), 100)
+            self.assertEqual(connection.send_message(Messages.PUSH_EVENT_LOGS, data=json.dumps(codes)), Messages.SUCCESS_RESPONSE)
+
+            # Messages are no longer sent one at a time
+            pool = ThreadPool(4)
+            start = time.time()
+            responses = pool.map(lambda i: connection.send_message(Messages.TEST_QUESTION), range(4))
+            pool.close()
+            self.assertEqual(responses, [Messages.TEST_RESPONSE] * 4)
+            self.assertTrue(time.time() - start < 0.3)
+        finally:
+            connection.transport.close()
+            keymaster.shutdown()
+            keymaster.server_close()
+
 
 class KeymasterTestCase(TestCase):
 
@@ -63,6 +110,149 @@ class KeymasterTestCase(TestCase):
         self.assertEqual(new_log.message, msg)
 
 
+    def test_process_event_logs(self):
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        door = Door.objects.create(name="front", door_type=DoorTypes.HID, keymaster=keymaster, username="admin", password="secret", ip_address="127.0.0.2")
+        user1 = User.objects.create(username="member_one")
+        user2 = User.objects.create(username="member_two")
+        DoorCode.objects.create(created_by=user1, user=user2, code="1234")
+
+        def event(timestamp, code, username=None):
+            e = {'timestamp': timestamp, 'cardNumber': code, 'door_event_type': DoorEventTypes.GRANTED, 'description': "Access Granted"}
+            if username:
+                e['cardHolder'] = {'username': username}
+            return e
+        events = [
+            event("2017-01-02T09:30:00", "5678", "member_one"),
+            event("2017-01-02T09:00:00", "1234"),
+            event("2017-01-02T09:00:00", "1234"),
+            event("2017-01-02T08:00:00", "9999"),
+        ]
+        self.assertEqual(keymaster.process_event_logs({'front': events}), Messages.SUCCESS_RESPONSE)
+        self.assertEqual(DoorEvent.objects.filter(door=door).count(), 3)
+        self.assertEqual(DoorEvent.objects.get(code="5678").user, user1)
+        self.assertEqual(DoorEvent.objects.get(code="1234").user, user2)
+        self.assertEqual(DoorEvent.objects.get(code="9999").user, None)
+
+        # Events we already have are skipped
+        older = event("2017-01-01T18:00:00", "1234")
+        keymaster.process_event_logs({'front': [events[1], older]})
+        self.assertEqual(DoorEvent.objects.filter(door=door).count(), 4)
+
+        # Including the ones without a code
+        unlocked = {'timestamp': "2017-01-01T17:00:00", 'door_event_type': DoorEventTypes.UNLOCKED, 'description': "Door Unlocked"}
+        keymaster.process_event_logs({'front': [unlocked]})
+        keymaster.process_event_logs({'front': [unlocked]})
+        self.assertEqual(DoorEvent.objects.filter(door=door, code="").count(), 1)
+
+        # And the ones another push stored while we were looking
+        stored = DoorEvent.objects.get(code="9999")
+        fresh = DoorEvent(door=door, timestamp=stored.timestamp, code="8888", event_type=DoorEventTypes.DENIED)
+        again = DoorEvent(door=door, timestamp=stored.timestamp, code=stored.code, event_type=stored.event_type)
+        self.assertEqual(DoorEvent.objects.create_new([again, fresh]), [fresh])
+        self.assertEqual(DoorEvent.objects.filter(door=door).count(), 6)
+
+        # Pushed events sharing a second with the last one we have are not dropped
+        keymaster.process_event_logs({'front': [event("2017-01-02T09:30:00", "1234"), event("2017-01-02T09:15:00", "1234")]})
+        self.assertEqual(DoorEvent.objects.filter(door=door).count(), 8)
+
+
+    def test_pull_code_changes(self):
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        user1 = User.objects.create(username="member_one", first_name="Member", last_name="One")
+        user2 = User.objects.create(username="member_two", first_name="Member", last_name="Two")
+        code1 = DoorCode.objects.create(created_by=user1, user=user1, code="1111")
+        code2 = DoorCode.objects.create(created_by=user1, user=user2, code="2222")
+        self.assertTrue(code1.version < code2.version)
+
+        # Without a version we get everything
+        changes = json.loads(keymaster.pull_code_changes())
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['version'], code2.version)
+        self.assertEqual([c['code'] for c in changes['codes']], ["1111", "2222"])
+
+        # Then just what changed, with deletes as tombstones
+        version = changes['version']
+        self.assertEqual(json.loads(keymaster.pull_code_changes(version))['codes'], [])
+        code1.delete()
+        code2.code = "3333"
+        code2.save()
+        changes = json.loads(keymaster.pull_code_changes(version))
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['version'], DoorCode.objects.get(id=code2.id).version)
+        self.assertEqual(changes['codes'], [{'username': "member_two", 'first_name': "Member", 'last_name': "Two", 'code': "3333"}])
+        self.assertEqual(changes['deleted'], ["1111", "2222"])
+
+        # A version we never handed out means the gatekeeper needs everything
+        self.assertTrue(json.loads(keymaster.pull_code_changes(changes['version'] + 10))['full'])
+
+        # As does one we have since purged, though the current version is always kept
+        newest = changes['version']
+        DoorCode.objects.create(created_by=user1, user=user1, code="4444")
+        change_count = DoorCodeChange.objects.count()
+        self.assertEqual(DoorCodeChange.objects.purge(timezone.now() + timedelta(seconds=1)), change_count - 1)
+        self.assertTrue(json.loads(keymaster.pull_code_changes(newest))['full'])
+        current = DoorCodeChange.objects.current_version()
+        self.assertFalse(json.loads(keymaster.pull_code_changes(current))['full'])
+        self.assertEqual(current_code_version(), current)
+
+
+    def test_heartbeat(self):
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        user = User.objects.create(username="member_one")
+        DoorCode.objects.create(created_by=user, user=user, code="1111")
+        version = current_code_version()
+
+        # Nothing has ever been synced
+        self.assertEqual(json.loads(keymaster.heartbeat(version)), {'action': Messages.NEW_DATA, 'version': version})
+        keymaster.mark_sync()
+        self.assertEqual(json.loads(keymaster.heartbeat(version))['action'], Messages.NO_NEW_DATA)
+        self.assertEqual(json.loads(keymaster.heartbeat(None))['action'], Messages.NEW_DATA)
+        DoorCode.objects.create(created_by=user, user=user, code="2222")
+        self.assertEqual(json.loads(keymaster.heartbeat(version))['action'], Messages.NEW_DATA)
+
+        # Check ins only touch the database once in a while, past making sure the keymaster is still enabled
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        with self.assertNumQueries(1):
+            Keymaster.objects.by_ip(self.ip_address).heartbeat(current_code_version(), 7)
+        self.assertEqual(Keymaster.objects.get(id=keymaster.id).pending_events, 0)
+        Keymaster.objects.filter(id=keymaster.id).update(success_ts=timezone.now() - timedelta(minutes=5))
+        keymaster.success_ts = None
+        keymaster.heartbeat(current_code_version(), 7)
+        self.assertEqual(Keymaster.objects.get(id=keymaster.id).pending_events, 7)
+
+        # A forced sync is picked up right away
+        keymaster.force_sync()
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        self.assertEqual(json.loads(keymaster.heartbeat(current_code_version()))['action'], Messages.NEW_DATA)
+
+    def test_disabled(self):
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        Keymaster.objects.filter(id=keymaster.id).update(is_enabled=False, description="Retired")
+
+        # Turning a keymaster off takes effect right away even though we still have it cached
+        with self.assertRaises(Exception):
+            Keymaster.objects.by_ip(self.ip_address)
+
+        # And a stale copy marking a sync doesn't write back anything else
+        keymaster.mark_sync()
+        keymaster.pull_code_changes()
+        keymaster.force_sync()
+        stored = Keymaster.objects.get(id=keymaster.id)
+        self.assertEqual((stored.is_enabled, stored.description), (False, "Retired"))
+        self.assertTrue(stored.is_syncing)
+        self.assertEqual(stored.sync_ts, None)
+
+    def test_heartbeat_message(self):
+        keymaster = Keymaster.objects.by_ip(self.ip_address)
+        keymaster.mark_sync()
+        connection = keymaster.get_encrypted_connection()
+        data = json.dumps({'code_version': current_code_version(), 'pending_events': 3})
+        response = self.client.post(reverse('doors:keymaster'), {'message': connection.encrypt_message(Messages.HEARTBEAT), 'data': connection.encrypt_message(data)})
+        message = json.loads(connection.decrypt_message(response.json()['message']))
+        self.assertEqual(message['action'], Messages.NO_NEW_DATA)
+
+
 class GatekeeperTestCase(TestCase):
     def get_config(self):
         return { "CARD_SECRET": Fernet.generate_key(),
@@ -91,3 +281,139 @@ class GatekeeperTestCase(TestCase):
         d = gatekeeper.decode_door_code(e)
         self.assertFalse(d == e)
         self.assertTrue(d == o)
+
+    def test_pull_door_codes(self):
+        class StubConnection(object):
+            def __init__(self, responses):
+                self.responses = responses
+                self.sent = []
+            def send_message(self, message, data=None, encrypt=True):
+                self.sent.append((message, json.loads(data) if data else None))
+                return json.dumps(self.responses.pop(0))
+
+        config = self.get_config()
+        config['CODE_VERSION_FILE'] = os.path.join(tempfile.mkdtemp(), "code_version.json")
+        config['CARDHOLDER_CACHE_FILE'] = ""
+        gatekeeper = Gatekeeper(config)
+        self.assertEqual(gatekeeper.code_version, None)
+
+        front = {'name': "front", 'door_type': DoorTypes.TEST, 'ip_address': "127.0.0.2", 'username': "admin", 'password': "secret"}
+        back = {'name': "back", 'door_type': DoorTypes.TEST, 'ip_address': "127.0.0.3", 'username': "admin", 'password': "secret"}
+        full = {'version': 2, 'full': True, 'deleted': [], 'codes': [
+            {'username': 'one', 'first_name': 'Member', 'last_name': 'One', 'code': gatekeeper.encode_door_code("1111")},
+            {'username': 'two', 'first_name': 'Member', 'last_name': 'Two', 'code': gatekeeper.encode_door_code("2222")},
+        ]}
+        delta = {'version': 3, 'full': False, 'codes': [], 'deleted': [gatekeeper.encode_door_code("1111")]}
+        full_again = {'version': 3, 'full': True, 'deleted': [], 'codes': full['codes'][1:]}
+        gatekeeper.encrypted_connection = StubConnection([[front], full, delta, [front, back], full_again])
+        gatekeeper.configure_doors()
+        controller = gatekeeper.get_door("front")['controller']
+
+        gatekeeper.pull_door_codes()
+        self.assertEqual(controller.get_cardholder_by_code("1111").username, 'one')
+        self.assertEqual(Gatekeeper(config).code_versions, {'front': 2})
+
+        gatekeeper.pull_door_codes()
+        self.assertEqual(gatekeeper.encrypted_connection.sent[1:], [(Messages.PULL_CODE_CHANGES, {'since': None}), (Messages.PULL_CODE_CHANGES, {'since': 2})])
+        self.assertEqual(controller.get_cardholder_by_code("1111"), None)
+        self.assertEqual(controller.get_cardholder_by_code("2222").username, 'two')
+        self.assertEqual(Gatekeeper(config).code_versions, {'front': 3})
+        self.assertEqual(gatekeeper.code_version, 3)
+
+        # A door we pick up later gets every code, not just what changed since the others were synced
+        gatekeeper.configure_doors()
+        self.assertEqual(gatekeeper.code_version, None)
+        gatekeeper.pull_door_codes()
+        self.assertEqual(gatekeeper.encrypted_connection.sent[-1], (Messages.PULL_CODE_CHANGES, {'since': None}))
+        self.assertEqual(gatekeeper.get_door("back")['controller'].get_cardholder_by_code("2222").username, 'two')
+        self.assertEqual(Gatekeeper(config).code_versions, {'front': 3, 'back': 3})
+
+        # And a rebuild starts every door over
+        gatekeeper.rebuild_cardholder_cache()
+        self.assertEqual(Gatekeeper(config).code_versions, {})
+
+    def test_run_on_doors(self):
+        class StubConnection(object):
+            sent = []
+            def send_message(self, message, data=None, encrypt=True):
+                self.sent.append(json.loads(data)['log_text'])
+                return Messages.SUCCESS_RESPONSE
+
+        def task(door_name, door):
+            if door_name == "broken":
+                raise Exception("unreachable")
+            if door_name == "slow":
+                time.sleep(1)
+            return door_name.upper()
+
+        config = self.get_config()
+        config['DOOR_TIMEOUT_SEC'] = 0.2
+        gatekeeper = Gatekeeper(config)
+        gatekeeper.encrypted_connection = StubConnection()
+        gatekeeper.doors = {'front': {}, 'broken': {}, 'slow': {}}
+
+        report = gatekeeper.run_on_doors(task, "Test")
+        self.assertEqual(report.results, {'front': "FRONT"})
+        self.assertEqual(report.errors, {'broken': "unreachable", 'slow': "timed out after 0.2 seconds"})
+        self.assertEqual(list(report.timings.keys()), ['front'])
+        self.assertEqual(len(gatekeeper.encrypted_connection.sent), 1)
+        self.assertTrue(gatekeeper.encrypted_connection.sent[0].startswith("Test (broken: unreachable, front: "))
+
+        # The same failures aren't reported twice, and a door still working on the last task is left alone
+        report = gatekeeper.run_on_doors(task, "Test")
+        self.assertEqual(report.busy, ['slow'])
+        self.assertFalse('slow' in report.results or 'slow' in report.errors)
+        self.assertEqual(len(gatekeeper.encrypted_connection.sent), 1)
+        del gatekeeper.doors['broken']
+        gatekeeper.run_on_doors(task, "Test")
+        self.assertEqual(len(gatekeeper.encrypted_connection.sent), 1)
+
+        # But a recovery is
+        gatekeeper.door_tasks['slow'].wait()
+        gatekeeper.door_timeout = 2
+        report = gatekeeper.run_on_doors(task, "Test")
+        self.assertEqual(report.errors, {})
+        self.assertEqual(len(gatekeeper.encrypted_connection.sent), 2)
+
+    def test_cardholder_cache(self):
+        class CachingDoorController(TestDoorController):
+            loads = 0
+            current = True
+            def load_credentials(self):
+                self.loads += 1
+                self.clear_data()
+                self.save_cardholder(CardHolder("1", "Member", "One", "one", "1111"))
+            def cardholder_marker(self):
+                return "%d:1" % self.cardholder_count()
+            def marker_is_current(self, marker):
+                return self.current and marker == "1:1"
+
+        config = self.get_config()
+        config['CARDHOLDER_CACHE_FILE'] = os.path.join(tempfile.mkdtemp(), "cardholders.sqlite")
+        gatekeeper = Gatekeeper(config)
+        controller = CachingDoorController("front", "127.0.0.2", "admin", "secret")
+        door_info = {'name': "front", 'ip_address': "127.0.0.2", 'controller': controller}
+
+        # The first time we have to ask the door
+        gatekeeper.load_cardholders(door_info)
+        self.assertEqual(controller.loads, 1)
+
+        # After that the cache is used as long as the door agrees with it
+        controller.clear_data()
+        gatekeeper.load_cardholders(door_info)
+        self.assertEqual(controller.loads, 1)
+        cardholder = controller.get_cardholder_by_code("1111")
+        self.assertEqual((cardholder.id, cardholder.username), ("1", "one"))
+        controller.current = False
+        gatekeeper.load_cardholders(door_info)
+        self.assertEqual(controller.loads, 2)
+
+        # A door at a new address or a rebuild starts over
+        controller.current = True
+        door_info['ip_address'] = "127.0.0.3"
+        gatekeeper.load_cardholders(door_info)
+        self.assertEqual(controller.loads, 3)
+        gatekeeper.rebuild_cardholder_cache()
+        gatekeeper.load_cardholders(door_info)
+        self.assertEqual(controller.loads, 4)
+
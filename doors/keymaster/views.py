@@ -180,10 +180,16 @@ def keymaster(request):
             return JsonResponse({'text_message':time.strftime("%c")})
         elif incoming_message == Messages.PULL_CONFIGURATION:
             outgoing_message = keymaster.pull_config()
+        elif incoming_message == Messages.HEARTBEAT:
+            incoming_data = connection.data or {}
+            outgoing_message = keymaster.heartbeat(incoming_data.get('code_version'), incoming_data.get('pending_events', 0))
         elif incoming_message == Messages.CHECK_IN:
             outgoing_message = keymaster.check_door_codes()
         elif incoming_message == Messages.PULL_DOOR_CODES:
             outgoing_message = keymaster.pull_door_codes()
+        elif incoming_message == Messages.PULL_CODE_CHANGES:
+            since = connection.data.get('since') if connection.data else None
+            outgoing_message = keymaster.pull_code_changes(since)
         elif incoming_message == Messages.PUSH_EVENT_LOGS:
             incoming_data = connection.data
             #logger.debug("Incoming Data: '%s' " % incoming_data)
@@ -204,9 +210,9 @@ def keymaster(request):
         logger.debug("Outgoing Message: '%s' " % outgoing_message)
 
         # Encrypt our response
-        encrypted_response = connection.encrypt_message(outgoing_message)
+        response_package = connection.response_package(outgoing_message)
     except Exception as e:
         logger.error(e)
         return JsonResponse({'error': str(e)})
 
-    return JsonResponse({'message':encrypted_response})
+    return JsonResponse(response_package)
@@ -7,10 +7,13 @@ from core import Messages
 
 class Heartbeat(threading.Thread):
 
-    def __init__(self, connection, poll_delay_sec):
+    def __init__(self, gatekeeper, poll_delay_sec, event_spool=None):
         threading.Thread.__init__(self)
-        self.connection = connection
+        self.gatekeeper = gatekeeper
+        self.connection = gatekeeper.get_connection()
         self.poll_delay_sec = poll_delay_sec
+        # Events waiting to go to the keymaster when the doors push them to us
+        self.event_spool = event_spool
         self.new_data = False
         self.error = None
         self.debug = False
@@ -25,17 +28,16 @@ class Heartbeat(threading.Thread):
 
                 if not self.new_data:
                     logging.debug("Heartbeat: Contacting the Keymaster...")
-                    response = self.connection.send_message(Messages.CHECK_IN)
-                    if response == Messages.NEW_DATA:
-                        logging.info("Heartbeat: There is new data to be processed")
+                    pending_events = self.event_spool.count() if self.event_spool else 0
+                    response = self.gatekeeper.send_heartbeat(pending_events)
+                    action = response.get('action')
+                    if action == Messages.NEW_DATA:
+                        logging.info("Heartbeat: There is new data to be processed (version %s)" % response.get('version'))
                         self.new_data = True
-                    else:
+                    elif action == Messages.NO_NEW_DATA:
                         logging.debug("Heartbeat: No new door codes")
-
-                    # Mark this connection successfull
-                    response = self.connection.send_message(Messages.MARK_SUCCESS)
-                    if not response == Messages.SUCCESS_RESPONSE:
-                        raise Exception("Heartbeat: Did not receive proper success response!")
+                    else:
+                        raise Exception("Heartbeat: Unexpected action (%s)" % action)
         except Exception as e:
             logging.error("Heartbeat Exception: %s" % e)
             self.error = e
@@ -53,10 +55,12 @@ class Heartbeat(threading.Thread):
 
 class EventWatcher(threading.Thread):
 
-    def __init__(self, gatekeeper, poll_delay_sec):
+    def __init__(self, gatekeeper, poll_delay_sec, door_names=None):
         threading.Thread.__init__(self)
         self.gatekeeper = gatekeeper
         self.poll_delay_sec = poll_delay_sec
+        # Only these doors are polled when the others push their events to us
+        self.door_names = door_names
         self.new_data = False
         self.error = None
 
@@ -70,7 +74,7 @@ class EventWatcher(threading.Thread):
 
                 if not self.new_data:
                     logging.debug("EventWatcher: Polling the doors for events...")
-                    event_logs = self.gatekeeper.pull_event_logs(1)
+                    event_logs = self.gatekeeper.pull_event_logs(1, self.door_names)
                     for door_name, logs in event_logs.items():
                         if logs and len(logs) == 1 and 'timestamp' in logs[0]:
                             door = self.gatekeeper.get_door(door_name)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import json
+import time
+import timeit
+import argparse
+import threading
+import urlparse
+import requests
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
+
+from cryptography.fernet import Fernet
+
+from core import Messages, EncryptedConnection
+
+################################################################################
+# A stand in for the keymaster so the transport can be measured locally
+################################################################################
+
+class StubRequest(object):
+    # Just enough of a django request for EncryptedConnection.receive_message
+    def __init__(self, body):
+        self.method = 'POST'
+        self.POST = dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+
+
+class StubKeymasterHandler(BaseHTTPRequestHandler):
+    # Keep connections open between requests like a real web server would
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.server.bytes_received += len(body)
+        connection = EncryptedConnection(self.server.encryption_key)
+        try:
+            message = connection.receive_message(StubRequest(body))
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if message == Messages.TEST_QUESTION:
+                outgoing_message = Messages.TEST_RESPONSE
+            elif message == Messages.PULL_DOOR_CODES:
+                outgoing_message = json.dumps(self.server.door_codes)
+            else:
+                outgoing_message = Messages.SUCCESS_RESPONSE
+            response = json.dumps(connection.response_package(outgoing_message))
+        except Exception as e:
+            response = json.dumps({'error': str(e)})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubKeymaster(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, encryption_key, latency=0, door_code_count=500, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StubKeymasterHandler)
+        self.encryption_key = encryption_key
+        self.latency = latency
+        self.bytes_received = 0
+        self.door_codes = []
+        for i in range(door_code_count):
+            self.door_codes.append({'username': "member%d" % i, 'first_name': "Member", 'last_name': "Number %d" % i, 'code': "%08X" % (i * 7919)})
+
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+
+################################################################################
+# The benchmark
+################################################################################
+
+class LegacyConnection(EncryptedConnection):
+    # How messages used to be sent: a new connection each time, one at a time, nothing compressed
+    lock = threading.Lock()
+
+    def send_message(self, message, data=None, encrypt=True):
+        request_package = {'message': self.encrypt_message(message)}
+        if data:
+            request_package['data'] = self.encrypt_message(data)
+        with self.lock:
+            response = requests.post(self.keymaster_url, data=request_package)
+        return self.decrypt_message(response.json()['message'])
+
+
+def run(connection, message, data, count, concurrency):
+    pool = ThreadPool(concurrency)
+    try:
+        latencies = pool.map(lambda i: timed_send(connection, message, data), range(count))
+    finally:
+        pool.close()
+        pool.join()
+    return latencies
+
+
+def timed_send(connection, message, data):
+    start = timeit.default_timer()
+    connection.send_message(message, data=data)
+    return timeit.default_timer() - start
+
+
+def report(name, latencies, elapsed):
+    latencies = sorted(latencies)
+    median = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95)]
+    print("%-10s %4d messages in %6.2fs  median %6.1fms  p95 %6.1fms" % (name, len(latencies), elapsed, median * 1000, p95 * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure keymaster message latency against a local stub keymaster")
+    parser.add_argument('--messages', type=int, default=200, help="Messages to send per run")
+    parser.add_argument('--concurrency', type=int, default=4, help="Messages in flight at once")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds the stub keymaster takes to answer")
+    parser.add_argument('--codes', type=int, default=500, help="Door codes the stub keymaster sends back")
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    keymaster = StubKeymaster(key, args.latency, args.codes)
+    keymaster.start()
+    print("Stub keymaster listening on %s" % keymaster.url())
+
+    for name, connection in (("legacy", LegacyConnection(key, keymaster.url())), ("pooled", EncryptedConnection(key, keymaster.url(), pool_size=args.concurrency))):
+        start = timeit.default_timer()
+        latencies = run(connection, Messages.CHECK_IN, None, args.messages, args.concurrency)
+        report(name, latencies, timeit.default_timer() - start)
+
+        # A door code pull and an event push are where the size of the payload matters
+        keymaster.bytes_received = 0
+        start = timeit.default_timer()
+        codes = connection.send_message(Messages.PULL_DOOR_CODES)
+        connection.send_message(Messages.PUSH_EVENT_LOGS, data=codes)
+        print("%-10s door codes round trip in %6.1fms, %d bytes sent" % (name, (timeit.default_timer() - start) * 1000, keymaster.bytes_received))
+        if connection.transport:
+            connection.transport.close()
+    keymaster.shutdown()
+    keymaster.server_close()
@@ -63,7 +63,7 @@ admin.site.register(Bill, BillAdmin)
 
 
 class BillingLogAdmin(StyledAdmin):
-    list_display = ('started', 'ended', 'note', 'successful')
+    list_display = ('started', 'ended', 'bill_date', 'note', 'successful')
 admin.site.register(BillingLog, BillingLogAdmin)
 
 class CoworkingDayAdmin(StyledAdmin):
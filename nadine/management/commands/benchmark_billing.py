@@ -0,0 +1,91 @@
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+
+from nadine.models.membership import Membership
+from nadine.models.usage import CoworkingDay
+from staff.billing import Day, Run, RunData
+
+
+class ListRun(Run):
+
+    """A Run which keeps its Days in a plain list and finds them with a linear scan, as Run used to."""
+
+    def populate_days(self):
+        self.days = []
+        for i in range((self.end_date - self.start_date).days + 1):
+            self.days.append(Day(self.start_date + timedelta(days=i)))
+
+    def populate_memberships(self):
+        for membership in self.data.memberships:
+            if membership.end_date and membership.end_date < self.start_date:
+                continue
+            if membership.start_date > self.end_date:
+                continue
+            for i in range(0, len(self.days)):
+                if self.days[i].date >= membership.start_date:
+                    if membership.end_date == None or self.days[i].date <= membership.end_date:
+                        self.days[i].membership = membership
+
+    def add_daily_log(self, log):
+        for i in range(0, len(self.days)):
+            if log.visit_date == self.days[i].date:
+                if self.days[i].membership and self.days[i].membership.paid_by_id:
+                    break
+                self.days[i].daily_log = log
+                break
+
+    def add_guest_log(self, log):
+        for i in range(0, len(self.days)):
+            if log.visit_date == self.days[i].date:
+                self.days[i].guest_daily_logs.append(log)
+                break
+
+
+class Command(BaseCommand):
+    help = "Times the construction of a billing Run for a user with a multi-year history."
+    requires_system_checks = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('--years', type=int, dest='years', default=5)
+        parser.add_argument('--repeat', type=int, dest='repeat', default=5)
+
+    def handle(self, **options):
+        years = options['years']
+        repeat = options['repeat']
+        user = User(id=1, username='benchmark')
+        end_date = date(2017, 1, 1)
+        start_date = end_date - timedelta(days=365 * years)
+
+        # A new membership every six months and a drop-in on most weekdays, none of it saved
+        memberships = []
+        membership_start = start_date
+        while membership_start <= end_date:
+            membership_end = membership_start + timedelta(days=181)
+            memberships.append(Membership(user_id=user.id, start_date=membership_start, end_date=membership_end, monthly_rate=100, dropin_allowance=5, daily_rate=20))
+            membership_start = membership_end + timedelta(days=1)
+        daily_logs = []
+        guest_daily_logs = []
+        day = start_date
+        while day <= end_date:
+            if day.weekday() < 5:
+                daily_logs.append(CoworkingDay(user_id=user.id, visit_date=day, payment='Bill'))
+            if day.weekday() == 2:
+                guest_daily_logs.append(CoworkingDay(user_id=2, visit_date=day, payment='Bill', paid_by_id=user.id))
+            day = day + timedelta(days=1)
+        data = RunData(memberships, daily_logs, guest_daily_logs)
+        print("%d days, %d memberships, %d daily logs, %d guest logs" % ((end_date - start_date).days + 1, len(memberships), len(daily_logs), len(guest_daily_logs)))
+
+        for label, run_class in [("List", ListRun), ("Calendar", Run)]:
+            best = None
+            for i in range(repeat):
+                started = time.time()
+                run_class(user, start_date, end_date, data=data)
+                elapsed = time.time() - started
+                if best is None or elapsed < best:
+                    best = elapsed
+            print("%-10s best of %d: %.4f seconds" % (label, repeat, best))
+
+# Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
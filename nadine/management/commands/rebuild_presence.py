@@ -0,0 +1,39 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from nadine.models.usage import Presence
+
+
+class Command(BaseCommand):
+    help = "Recalculates who was here each day from the ARP logs, coworking days and door events."
+    requires_system_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', dest='start', default=None, help="First day to rebuild (YYYY-MM-DD), defaults to today")
+        parser.add_argument('--end', dest='end', default=None, help="Last day to rebuild (YYYY-MM-DD), defaults to today")
+
+    def parse_date(self, value):
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date()
+        except ValueError:
+            raise CommandError("Invalid date: %s" % value)
+
+    def handle(self, **options):
+        today = timezone.localtime(timezone.now()).date()
+        start_date = end_date = today
+        if options['start']:
+            start_date = self.parse_date(options['start'])
+        if options['end']:
+            end_date = self.parse_date(options['end'])
+        start = time.time()
+        count = 0
+        day = start_date
+        while day <= end_date:
+            count += Presence.objects.rebuild(day)
+            day = day + timedelta(days=1)
+        print("Rebuilt %d presence records in %.2f seconds" % (count, time.time() - start))
+
+# Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -1,6 +1,7 @@
 import os
 import time
 import csv
+import json
 import ConfigParser
 
 from django.template.defaultfilters import slugify
@@ -15,7 +16,58 @@ class Command(BaseCommand):
 
     requires_system_checks = True
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=None, help="Number of bills written per database transaction")
+        parser.add_argument('--shards', type=int, dest='shards', default=1, help="Number of worker processes to split the users between")
+        parser.add_argument('--resume', action='store_true', dest='resume', default=False, help="Resume the last unsuccessful run, skipping users already billed")
+        parser.add_argument('--incremental', action='store_true', dest='incremental', default=False, help="Only bill users with changes since the last incremental run or a bill due")
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help="Print the bills which would be created as JSON lines without saving anything")
+        parser.add_argument('--diff', dest='diff', default=None, help="With --dry-run, also report differences from the output of an earlier dry run")
+        parser.add_argument('--output', dest='output', default=None, help="With --dry-run, write the report to this file instead of stdout")
+
     def handle(self, **options):
-        billing.run_billing()
+        if options['dry_run']:
+            self.dry_run(options['diff'], options['output'])
+            return
+        if options['diff'] or options['output']:
+            raise CommandError('--diff and --output can only be used with --dry-run')
+        billing.run_billing(chunk_size=options['chunk_size'], shards=options['shards'], resume=options['resume'], incremental=options['incremental'])
+
+    def write_line(self, out, line_type, values):
+        line = dict(values)
+        line['type'] = line_type
+        out.write(json.dumps(line, sort_keys=True) + "\n")
+
+    def read_snapshot(self, snapshot_file):
+        previous = []
+        with open(snapshot_file) as f:
+            for line in f:
+                if not line.startswith('{'):
+                    continue
+                values = json.loads(line)
+                if values.pop('type', None) == 'bill':
+                    previous.append(values)
+        return previous
+
+    def dry_run(self, snapshot_file, output_file):
+        # Read the snapshot first in case we are about to overwrite it
+        previous = None
+        if snapshot_file:
+            previous = self.read_snapshot(snapshot_file)
+        bills = billing.dry_run()
+        out = self.stdout
+        if output_file:
+            out = open(output_file, 'w')
+        try:
+            for bill in bills:
+                self.write_line(out, 'bill', bill)
+            for total in billing.plan_totals(bills):
+                self.write_line(out, 'total', total)
+            if previous is not None:
+                for change, bill in billing.diff_bills(previous, bills):
+                    self.write_line(out, change, bill)
+        finally:
+            if output_file:
+                out.close()
 
 # Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,31 @@
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nadine.models.membership import MembershipDailySnapshot
+
+
+class Command(BaseCommand):
+    help = "Fills in the daily membership snapshots used by the stats graphs."
+    requires_system_checks = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', dest='rebuild', default=False, help="Delete and recalculate every snapshot")
+        parser.add_argument('--end', dest='end', default=None, help="Last day to snapshot (YYYY-MM-DD), defaults to today")
+
+    def handle(self, **options):
+        end_date = None
+        if options['end']:
+            try:
+                end_date = datetime.strptime(options['end'], "%Y-%m-%d").date()
+            except ValueError:
+                raise CommandError("Invalid end date: %s" % options['end'])
+        start = time.time()
+        if options['rebuild']:
+            count = MembershipDailySnapshot.objects.rebuild(end_date)
+        else:
+            count = MembershipDailySnapshot.objects.fill(end_date)
+        print("Created %d snapshots in %.2f seconds" % (count, time.time() - start))
+
+# Copyright 2017 Office Nomads LLC (http://officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nadine', '0026_bill_in_progress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.IntegerField(default=0)),
+                ('completed_ts', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='billinglog',
+            name='bill_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='billinglog',
+            name='shard_timing',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='billingcheckpoint',
+            name='billing_log',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='nadine.BillingLog'),
+        ),
+        migrations.AddField(
+            model_name='billingcheckpoint',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='billingcheckpoint',
+            unique_together=set([('billing_log', 'user')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nadine', '0028_billingdirty'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MembershipDailySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('member_count', models.IntegerField(default=0)),
+                ('desk_count', models.IntegerField(default=0)),
+                ('monthly_revenue', models.IntegerField(default=0)),
+                ('plan', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='nadine.MembershipPlan')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='membershipdailysnapshot',
+            unique_together=set([('date', 'plan')]),
+        ),
+    ]
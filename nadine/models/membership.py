@@ -11,13 +11,13 @@ from random import random
 from datetime import datetime, time, date, timedelta
 from dateutil.relativedelta import relativedelta
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Q, F, Max, Min, Sum
 from django.contrib import admin
 from django.core import urlresolvers
 from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.conf import settings
 from django.utils.encoding import smart_str
 from django_localflavor_us.models import USStateField, PhoneNumberField
@@ -26,6 +26,11 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 
 
@@ -126,6 +131,49 @@ class MembershipManager(models.Manager):
         today = timezone.now().date()
         return self.filter(start_date__gte=today)
 
+    def active_counts_between(self, start_date, end_date, group_by=('plan',)):
+        """Returns a list of (date, counts) for every day from start_date through end_date, where counts maps
+        a tuple of the group_by values to the number of memberships active that day."""
+        num_days = (end_date - start_date).days + 1
+        if num_days <= 0:
+            return []
+        fields = [GROUP_BY_FIELDS.get(g, g) for g in group_by]
+        memberships = self.filter(start_date__lte=end_date).filter(Q(end_date__isnull=True) | Q(end_date__gte=start_date))
+
+        # Sweep the range recording +1 where each membership starts and -1 the day after it ends
+        changes = {}
+        for row in memberships.values_list('start_date', 'end_date', *fields):
+            m_start, m_end, key = row[0], row[1], tuple(row[2:])
+            if m_end and m_end < m_start:
+                continue
+            if key not in changes:
+                changes[key] = [0] * (num_days + 1)
+            changes[key][max(0, (m_start - start_date).days)] += 1
+            if m_end:
+                changes[key][min(num_days, (m_end - start_date).days + 1)] -= 1
+
+        totals = dict((key, running_total(c)) for key, c in changes.items())
+        series = []
+        for i in range(num_days):
+            counts = dict((key, t[i]) for key, t in totals.items())
+            series.append((start_date + timedelta(days=i), counts))
+        return series
+
+
+# Names accepted by active_counts_between's group_by which differ from the Membership field
+GROUP_BY_FIELDS = {'plan': 'membership_plan'}
+
+
+def running_total(changes):
+    if numpy:
+        return [int(t) for t in numpy.cumsum(changes)]
+    totals = []
+    total = 0
+    for c in changes:
+        total += c
+        totals.append(total)
+    return totals
+
 
 class Membership(models.Model):
 
@@ -216,6 +264,176 @@ class Membership(models.Model):
         ordering = ['start_date']
 
 
+class MembershipDailySnapshotManager(models.Manager):
+
+    def calculate(self, start_date, end_date, plan_ids=None):
+        """Returns unsaved snapshots for every plan with active memberships on each day from start_date through end_date."""
+        memberships = Membership.objects.filter(start_date__lte=end_date).filter(Q(end_date__isnull=True) | Q(end_date__gte=start_date))
+        if plan_ids is not None:
+            memberships = memberships.filter(plan_filter(plan_ids))
+        snapshots = {}
+        for m_start, m_end, plan_id, has_desk, monthly_rate in memberships.values_list('start_date', 'end_date', 'membership_plan', 'has_desk', 'monthly_rate'):
+            day = max(start_date, m_start)
+            last_day = end_date
+            if m_end and m_end < last_day:
+                last_day = m_end
+            while day <= last_day:
+                snapshot = snapshots.get((day, plan_id))
+                if not snapshot:
+                    snapshot = MembershipDailySnapshot(date=day, plan_id=plan_id)
+                    snapshots[(day, plan_id)] = snapshot
+                snapshot.member_count += 1
+                if has_desk:
+                    snapshot.desk_count += 1
+                snapshot.monthly_revenue += monthly_rate
+                day = day + timedelta(days=1)
+        return [snapshots[k] for k in sorted(snapshots.keys())]
+
+    def update_range(self, start_date, end_date, plan_ids=None):
+        """Replaces the snapshots from start_date through end_date, optionally for just the given plans."""
+        snapshots = self.calculate(start_date, end_date, plan_ids)
+        with transaction.atomic():
+            existing = self.filter(date__gte=start_date, date__lte=end_date)
+            if plan_ids is not None:
+                existing = existing.filter(plan_filter(plan_ids, 'plan'))
+            existing.delete()
+            self.bulk_create(snapshots)
+        return len(snapshots)
+
+    def adjust(self, start_date, end_date, plan_id, member_count, desk_count, monthly_revenue):
+        """Adds the given amounts to a plan's snapshots from start_date through end_date, dropping days left without members like calculate() does."""
+        with transaction.atomic():
+            snapshots = self.filter(date__gte=start_date, date__lte=end_date).filter(plan_filter([plan_id], 'plan'))
+            if member_count > 0:
+                existing = set(snapshots.values_list('date', flat=True))
+                days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+                self.bulk_create([MembershipDailySnapshot(date=d, plan_id=plan_id) for d in days if d not in existing])
+            snapshots.update(member_count=F('member_count') + member_count, desk_count=F('desk_count') + desk_count,
+                monthly_revenue=F('monthly_revenue') + monthly_revenue)
+            if member_count < 0:
+                snapshots.filter(member_count__lte=0).delete()
+
+    def fill(self, end_date=None):
+        """Adds snapshots for the days after the latest snapshot through end_date (default today)."""
+        if not end_date:
+            end_date = timezone.now().date()
+        latest = self.aggregate(Max('date'))['date__max']
+        if latest:
+            start_date = latest + timedelta(days=1)
+        else:
+            start_date = Membership.objects.aggregate(Min('start_date'))['start_date__min']
+        if not start_date or start_date > end_date:
+            return 0
+        return self.update_range(start_date, end_date)
+
+    def rebuild(self, end_date=None):
+        self.all().delete()
+        return self.fill(end_date)
+
+    def snapshotted_through(self):
+        """The last day the snapshots have been filled in through, None if they never have been.
+        Every day before it is covered, those without a row had no members."""
+        return self.aggregate(Max('date'))['date__max']
+
+    def daily_totals(self, start_date, end_date):
+        """Returns a dictionary of date to the member_count, desk_count, and monthly_revenue across all plans.
+        Only reads what is there, the snapshot_memberships command fills in the days as they come."""
+        totals = self.filter(date__gte=start_date, date__lte=end_date).values('date').annotate(member_count=Sum('member_count'), desk_count=Sum('desk_count'), monthly_revenue=Sum('monthly_revenue'))
+        return dict((t['date'], t) for t in totals)
+
+    def plan_counts(self, start_date, end_date):
+        """Returns a dictionary of (date, plan_id) to member_count for the days snapshotted so far."""
+        counts = self.filter(date__gte=start_date, date__lte=end_date).values_list('date', 'plan', 'member_count')
+        return dict(((d, plan_id), count) for d, plan_id, count in counts)
+
+
+def plan_filter(plan_ids, field='membership_plan'):
+    q = Q(**{field + '__in': [p for p in plan_ids if p is not None]})
+    if None in plan_ids:
+        q = q | Q(**{field + '__isnull': True})
+    return q
+
+
+class MembershipDailySnapshot(models.Model):
+
+    """The active memberships for a plan on a given day, kept up to date for the stats graphs"""
+    objects = MembershipDailySnapshotManager()
+    date = models.DateField(db_index=True)
+    plan = models.ForeignKey(MembershipPlan, null=True, blank=True, on_delete=models.CASCADE)
+    member_count = models.IntegerField(default=0)
+    desk_count = models.IntegerField(default=0)
+    monthly_revenue = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'nadine'
+        unique_together = (('date', 'plan'), )
+
+    def __str__(self):
+        return '%s - %s: %s' % (self.date, self.plan_id, self.member_count)
+
+
+# The Membership fields the snapshots are calculated from
+SNAPSHOT_FIELDS = ('start_date', 'end_date', 'membership_plan', 'has_desk', 'monthly_rate')
+
+
+def snapshot_values(membership):
+    # Values set from a form or a plan may not have been through the database yet
+    return (membership.start_date, membership.end_date, membership.membership_plan_id, bool(membership.has_desk), int(membership.monthly_rate or 0))
+
+
+def snapshot_changes(removed, added, last_day):
+    """Returns (start_date, end_date, plan_id, member_count, desk_count, monthly_revenue) for each stretch of days
+    through last_day where swapping the removed snapshot values for the added ones changes a plan's counts."""
+    spans = []
+    for values, sign in [(removed, -1), (added, 1)]:
+        if values:
+            start_date, end_date, plan_id, has_desk, monthly_rate = values
+            end_date = min(end_date or last_day, last_day)
+            if start_date <= end_date:
+                spans.append((start_date, end_date, plan_id, sign, sign if has_desk else 0, sign * monthly_rate))
+    bounds = sorted(set([s[0] for s in spans] + [s[1] + timedelta(days=1) for s in spans]))
+    changes = []
+    for start_date, next_date in zip(bounds, bounds[1:]):
+        totals = {}
+        for span in spans:
+            if span[0] <= start_date <= span[1]:
+                total = totals.get(span[2], (0, 0, 0))
+                totals[span[2]] = (total[0] + span[3], total[1] + span[4], total[2] + span[5])
+        for plan_id, total in totals.items():
+            if total != (0, 0, 0):
+                changes.append((start_date, next_date - timedelta(days=1), plan_id) + total)
+    return changes
+
+
+def membership_snapshot_pre_save(sender, **kwargs):
+    membership = kwargs['instance']
+    membership._snapshot_original = None
+    if membership.pk:
+        membership._snapshot_original = Membership.objects.filter(pk=membership.pk).values_list(*SNAPSHOT_FIELDS).first()
+pre_save.connect(membership_snapshot_pre_save, sender=Membership)
+
+
+def membership_snapshot_callback(sender, **kwargs):
+    """Adjusts the snapshots for the days this membership counts differently on than before it was saved or deleted.
+    Days after the latest snapshot are left for MembershipDailySnapshot.objects.fill(), which covers every day before it."""
+    membership = kwargs['instance']
+    if 'created' in kwargs:
+        removed = getattr(membership, '_snapshot_original', None)
+        added = snapshot_values(membership)
+    else:
+        removed = snapshot_values(membership)
+        added = None
+    if removed == added:
+        return
+    latest = MembershipDailySnapshot.objects.aggregate(Max('date'))['date__max']
+    if not latest:
+        return
+    for change in snapshot_changes(removed, added, latest):
+        MembershipDailySnapshot.objects.adjust(*change)
+post_save.connect(membership_snapshot_callback, sender=Membership)
+post_delete.connect(membership_snapshot_callback, sender=Membership)
+
+
 class SecurityDeposit(models.Model):
     user = models.ForeignKey(User)
     received_date = models.DateField()
@@ -10,10 +10,13 @@ from django.contrib import admin
 from django.core import urlresolvers
 from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.utils import timezone
 
+from nadine.models.membership import Membership
+from nadine.models.usage import CoworkingDay
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,6 +27,8 @@ class BillingLog(models.Model):
     ended = models.DateTimeField(blank=True, null=True)
     successful = models.BooleanField(default=False)
     note = models.TextField(blank=True, null=True)
+    bill_date = models.DateField(blank=True, null=True)
+    shard_timing = models.TextField(blank=True, null=True)
 
     class Meta:
         app_label = 'nadine'
@@ -39,6 +44,43 @@ class BillingLog(models.Model):
         return datetime.date(self.ended)
 
 
+class BillingCheckpoint(models.Model):
+
+    """A record that a user has been completely billed as part of a BillingLog run"""
+    billing_log = models.ForeignKey(BillingLog, related_name='checkpoints')
+    user = models.ForeignKey(User)
+    shard = models.IntegerField(default=0)
+    completed_ts = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'nadine'
+        unique_together = (('billing_log', 'user'), )
+
+    def __str__(self):
+        return 'BillingCheckpoint %s: %s' % (self.billing_log_id, self.user)
+
+
+class BillingDirtyManager(models.Manager):
+
+    def mark(self, *user_ids):
+        self.bulk_create([BillingDirty(user_id=user_id) for user_id in set(user_ids) if user_id])
+
+
+class BillingDirty(models.Model):
+
+    """A journal of users whose billing inputs changed since the last incremental billing run"""
+    objects = BillingDirtyManager()
+    # No constraint so rows can be journaled while a user is being deleted
+    user = models.ForeignKey(User, db_constraint=False, on_delete=models.DO_NOTHING, related_name='+')
+    created_ts = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = 'nadine'
+
+    def __str__(self):
+        return 'BillingDirty %s: %s' % (self.created_ts, self.user_id)
+
+
 class Bill(models.Model):
 
     """A record of what fees a Member owes."""
@@ -91,3 +133,14 @@ class Transaction(models.Model):
 
     def get_admin_url(self):
         return urlresolvers.reverse('admin:nadine_transaction_change', args=[self.id])
+
+
+def billing_dirty_callback(sender, **kwargs):
+    instance = kwargs['instance']
+    BillingDirty.objects.mark(instance.user_id, instance.paid_by_id)
+post_save.connect(billing_dirty_callback, sender=CoworkingDay)
+post_delete.connect(billing_dirty_callback, sender=CoworkingDay)
+post_save.connect(billing_dirty_callback, sender=Membership)
+post_delete.connect(billing_dirty_callback, sender=Membership)
+# Writing bills is what billing does so only a bill taken away means the user needs another look
+post_delete.connect(billing_dirty_callback, sender=Bill)
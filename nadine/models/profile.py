@@ -41,13 +41,11 @@ from nadine.utils.payment_api import PaymentAPI
 from nadine.utils.slack_api import SlackAPI
 from nadine.models.core import GENDER_CHOICES, HowHeard, Industry, Neighborhood, Website, URLType
 from nadine.models.membership import Membership, MembershipPlan, SecurityDeposit
-from nadine.models.usage import CoworkingDay
+from nadine.models.usage import CoworkingDay, Presence
 from nadine.models.payment import Bill
 from nadine.models.organization import Organization
 from nadine import email
 
-from doors.keymaster.models import DoorEvent
-
 logger = logging.getLogger(__name__)
 
 
@@ -80,19 +78,11 @@ class UserQueryHelper():
         if not day:
             day = datetime.now(pytz.timezone(TIME_ZONE)).date()
 
-        # The members who are on the network
-        from arpwatch.arp import users_for_day_query
-        arp_members_query = users_for_day_query(day=day)
-
-        # The members who have signed in
-        daily_members_query = User.objects.filter(id__in=CoworkingDay.objects.filter(visit_date=day).values('user__id'))
-
-        # The members that have access a door
-        door_query = DoorEvent.objects.users_for_day(day)
-        door_members_query = User.helper.active_members().filter(id__in=door_query.values('user'))
-
-        combined_query = arp_members_query | daily_members_query | door_members_query
-        return combined_query.distinct()
+        # Members seen on the network or signed in, plus active members who only accessed a door
+        present = Presence.objects.filter(date=day)
+        seen = Q(id__in=present.exclude(sources=Presence.DOOR).values('user'))
+        door_only = Q(id__in=present.filter(sources=Presence.DOOR).values('user')) & Q(id__in=Membership.objects.active_memberships().values('user'))
+        return User.objects.filter(seen | door_only).distinct()
 
     def not_signed_in(self, day=None):
         if not day:
@@ -1,16 +1,19 @@
 from __future__ import unicode_literals
 
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
 
 from django.core import urlresolvers
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 
 # from nadine.models.resource import Resource
 
 import logging
+from datetime import datetime, time, timedelta
+
+import django.dispatch
 
 logger = logging.getLogger(__name__)
 
@@ -54,6 +57,133 @@ def sign_in_callback(sender, **kwargs):
 post_save.connect(sign_in_callback, sender=CoworkingDay)
 
 
+# Sent when someone is added to or removed from a day's presence, or how we know they are here changes
+presence_changed = django.dispatch.Signal(providing_args=["user_id", "date"])
+
+
+class PresenceManager(models.Manager):
+
+    def record(self, user_id, day, source, first_seen=None, last_seen=None):
+        """Marks the user as present on the given day from the given source, widening first_seen/last_seen to include the given times."""
+        if not last_seen:
+            last_seen = first_seen
+        with transaction.atomic():
+            presence, created = self.select_for_update().get_or_create(user_id=user_id, date=day)
+            changed = created or not (presence.sources & source)
+            presence.sources |= source
+            if first_seen and (not presence.first_seen or first_seen < presence.first_seen):
+                presence.first_seen = first_seen
+            if last_seen and (not presence.last_seen or last_seen > presence.last_seen):
+                presence.last_seen = last_seen
+            presence.save()
+        if changed:
+            presence_changed.send(sender=Presence, user_id=user_id, date=day)
+        return presence
+
+    def record_many(self, sightings, source):
+        """Records a list of (user_id, timestamp) sightings, touching each user's row once per day."""
+        seen = {}
+        for user_id, timestamp in sightings:
+            key = (user_id, timezone.localtime(timestamp).date())
+            if key in seen:
+                first, last = seen[key]
+                seen[key] = (min(first, timestamp), max(last, timestamp))
+            else:
+                seen[key] = (timestamp, timestamp)
+        for (user_id, day), (first, last) in seen.items():
+            self.record(user_id, day, source, first, last)
+        return len(seen)
+
+    def remove_source(self, user_id, day, source):
+        with transaction.atomic():
+            presence = self.select_for_update().filter(user_id=user_id, date=day).first()
+            if presence:
+                presence.sources &= ~source
+                if presence.sources:
+                    presence.save()
+                else:
+                    presence.delete()
+        if presence:
+            presence_changed.send(sender=Presence, user_id=user_id, date=day)
+
+    def rebuild(self, day):
+        """Recalculates the presence for a day from the device sessions (or ARP logs), coworking days and door events."""
+        from arpwatch.models import ArpLog, DeviceSession
+        from doors.keymaster.models import DoorEvent
+        start = timezone.make_aware(datetime.combine(day, time.min), timezone.get_current_timezone())
+        end = start + timedelta(days=1)
+        self.filter(date=day).delete()
+        presence_changed.send(sender=Presence, user_id=None, date=day)
+        # The raw ARP logs are purged once they are rolled up so use the sessions for any day which has them
+        sessions = DeviceSession.objects.filter(date=day, device__ignore=False, device__user__isnull=False)
+        if sessions.exists():
+            sightings = []
+            for user_id, first_seen, last_seen in sessions.values_list('device__user', 'first_seen', 'last_seen'):
+                sightings.extend([(user_id, first_seen), (user_id, last_seen)])
+        else:
+            arp_logs = ArpLog.objects.filter(runtime__gte=start, runtime__lt=end, device__ignore=False, device__user__isnull=False)
+            sightings = arp_logs.values_list('device__user', 'runtime')
+        self.record_many(sightings, Presence.ARP)
+        for user_id, created_ts in CoworkingDay.objects.filter(visit_date=day).values_list('user', 'created_ts'):
+            self.record(user_id, day, Presence.COWORKING, coworking_timestamp(day, created_ts))
+        door_events = DoorEvent.objects.filter(timestamp__gte=start, timestamp__lt=end, user__isnull=False)
+        self.record_many(door_events.values_list('user', 'timestamp'), Presence.DOOR)
+        return self.filter(date=day).count()
+
+
+class Presence(models.Model):
+
+    """Who was in the space on a given day and how we know it"""
+    ARP = 1
+    COWORKING = 2
+    DOOR = 4
+
+    objects = PresenceManager()
+    user = models.ForeignKey(User, related_name="+")
+    date = models.DateField(db_index=True)
+    first_seen = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField(null=True, blank=True)
+    sources = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        app_label = 'nadine'
+        unique_together = (('date', 'user'), )
+
+    def __str__(self):
+        return '%s - %s' % (self.date, self.user)
+
+
+def coworking_timestamp(day, created_ts):
+    # Only a sign in made on the day itself tells us when they were here
+    if created_ts and timezone.localtime(created_ts).date() == day:
+        return created_ts
+    return None
+
+
+def presence_sign_in_pre_save(sender, **kwargs):
+    # Remember who and when this was in case the save moves it
+    log = kwargs['instance']
+    log._presence_original = None
+    if log.pk:
+        log._presence_original = CoworkingDay.objects.filter(pk=log.pk).values_list('user', 'visit_date').first()
+pre_save.connect(presence_sign_in_pre_save, sender=CoworkingDay)
+
+
+def presence_sign_in_callback(sender, **kwargs):
+    log = kwargs['instance']
+    original = getattr(log, '_presence_original', None)
+    if original and original != (log.user_id, log.visit_date):
+        Presence.objects.remove_source(original[0], original[1], Presence.COWORKING)
+    Presence.objects.record(log.user_id, log.visit_date, Presence.COWORKING, coworking_timestamp(log.visit_date, log.created_ts))
+post_save.connect(presence_sign_in_callback, sender=CoworkingDay)
+
+
+def presence_sign_in_delete_callback(sender, **kwargs):
+    log = kwargs['instance']
+    Presence.objects.remove_source(log.user_id, log.visit_date, Presence.COWORKING)
+post_delete.connect(presence_sign_in_delete_callback, sender=CoworkingDay)
+
+
 class Event(models.Model):
     user = models.ForeignKey(User)
     room = models.ForeignKey('Room', null=True)
@@ -64,8 +64,22 @@ DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760
 # Arp Watch data directory (This must be in the MEDIA_ROOT)
 ARP_ROOT = 'arp_import/'
 ARP_IMPORT_LOG = ARP_ROOT + 'import.log'
-ARP_IMPORT_LOCK = ARP_ROOT + 'importing.lock'
 ARP_IP_PFX = '172.16.5.'
+# Number of arp files imported at the same time
+ARP_IMPORT_WORKERS = 4
+# Minutes a device can go unseen before a new session is started
+ARP_SESSION_GAP = 15
+# Days of raw arp logs kept once they are rolled up into sessions
+ARP_RETENTION_DAYS = 90
+# Seconds to wait for each SNMP agent and the number of rows asked for per GETBULK
+ARPWATCH_SNMP_TIMEOUT = 2
+ARPWATCH_SNMP_MAX_REPETITIONS = 50
+
+# Seconds between recording gatekeeper check ins and how long keymaster state is cached in each process
+KEYMASTER_ACCESS_INTERVAL_SEC = 60
+KEYMASTER_STATE_TTL_SEC = 30
+# Days of door code changes kept for gatekeepers to sync from, any further behind get every code
+DOOR_CODE_CHANGE_RETENTION_DAYS = 90
 
 # URL that handles login
 LOGIN_URL = '/login/'
@@ -199,6 +213,10 @@ COMLINK_STRIP_EMAILS = False
 # MAILCHIMP_NEWSLETTER_KEY="YourNewsletter"
 #MAILCHIMP_WEBHOOK_KEY = "nadine"
 
+# Billing Settings
+# Number of bills written per database transaction by run_billing
+BILLING_CHUNK_SIZE = 500
+
 
 # Crontabs - Scheduled Tasks
 # https://github.com/kraiz/django-crontab
@@ -220,10 +238,15 @@ CRONJOBS = [
     # Backup Tasks at 1:00 AM
     ('0 1 * * *', 'django.core.management.call_command', ['backup_members']),
     ('0 1 * * *', 'django.core.management.call_command', ['backup_create']),
+    # Roll up yesterday's arp logs and trim the old ones
+    ('30 1 * * *', 'django.core.management.call_command', ['rollup_arp']),
+    # Trim the door code changes no gatekeeper should still need
+    ('45 1 * * *', 'django.core.management.call_command', ['purge_code_changes']),
     # Billing Tasks at 4:00 AM
     ('0 4 * * *', 'django.core.management.call_command', ['run_billing']),
     # Other Tasks
     ('30 8 * * *', 'django.core.management.call_command', ['announce_special_days']),
+    ('5 0 * * *', 'django.core.management.call_command', ['snapshot_memberships']),
 ]
 CRONTAB_LOCK_JOBS = True
 CRONTAB_COMMAND_PREFIX = ""
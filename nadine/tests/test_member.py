@@ -83,4 +83,39 @@ class MemberTestCase(TestCase):
         self.assertFalse(self.user1.profile in UserProfile.objects.filter(tags__name__in=["knitting"]))
         self.assertFalse(self.user3.profile in UserProfile.objects.filter(tags__name__in=["books"]))
 
+    def test_here_today(self):
+        from arpwatch.models import UserDevice, ArpLog, DeviceSession
+        now = timezone.localtime(timezone.now())
+        today = now.date()
+        self.assertEqual(list(User.helper.here_today(today)), [])
+
+        # Signing in, a claimed device, and door access all count
+        day = CoworkingDay.objects.create(user=self.user3, visit_date=today, payment='Bill')
+        device = UserDevice.objects.create(mac_address="00:11:22:33:44:55")
+        ArpLog.objects.create(runtime=now, ip_address="172.16.5.10", device=device)
+        device.user = self.user5
+        device.save()
+        Presence.objects.record(self.user2.id, today, Presence.DOOR, now)
+        Presence.objects.record(self.user4.id, today, Presence.DOOR, now)
+        here_today = set(User.helper.here_today(today))
+        # Member 4 is not an active member so a door event alone does not count
+        self.assertEqual(here_today, set([self.user2, self.user3, self.user5]))
+        presence = Presence.objects.get(user=self.user5, date=today)
+        self.assertEqual(presence.sources, Presence.ARP)
+        self.assertEqual(presence.first_seen, now)
+
+        # Rebuilding from the ARP logs and coworking days drops the unsupported door records
+        Presence.objects.rebuild(today)
+        self.assertEqual(set(User.helper.here_today(today)), set([self.user3, self.user5]))
+        day.delete()
+        self.assertEqual(set(User.helper.here_today(today)), set([self.user5]))
+
+        # Including once the ARP logs are rolled up into sessions and purged
+        DeviceSession.objects.rollup(today)
+        ArpLog.objects.all().delete()
+        Presence.objects.rebuild(today)
+        self.assertEqual(set(User.helper.here_today(today)), set([self.user5]))
+        self.assertEqual(Presence.objects.get(user=self.user5, date=today).first_seen, now)
+
+
 # Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -2,6 +2,8 @@ import traceback
 from datetime import datetime, timedelta, date
 
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.core import management
 from django.contrib.auth.models import User
 from django.conf import settings
@@ -73,4 +75,80 @@ class MembershipTestCase(TestCase):
         self.assertEqual(m5.prev_billing_date(test_date), date(2012, 2, 29))
 
 
+    def test_daily_snapshot(self):
+        basicPlan = MembershipPlan.objects.create(name="Basic", monthly_rate=50, dropin_allowance=3, daily_rate=20, has_desk=False)
+        Membership.objects.create_with_plan(user=self.user1, start_date=date(2013, 1, 1), end_date=date(2013, 1, 20), membership_plan=self.residentPlan)
+        Membership.objects.create_with_plan(user=self.user2, start_date=date(2013, 1, 10), end_date=None, membership_plan=self.residentPlan)
+        Membership.objects.create_with_plan(user=self.user3, start_date=date(2013, 1, 15), end_date=None, membership_plan=basicPlan)
+
+        # Reading never fills in the snapshots, that is left to the snapshot_memberships command
+        self.assertEqual(MembershipDailySnapshot.objects.daily_totals(date(2013, 1, 1), date(2013, 1, 31)), {})
+        self.assertEqual(MembershipDailySnapshot.objects.fill(date(2013, 1, 31)), 31 + 17)
+        totals = MembershipDailySnapshot.objects.daily_totals(date(2013, 1, 1), date(2013, 1, 31))
+        for day in [date(2013, 1, 5), date(2013, 1, 12), date(2013, 1, 18), date(2013, 1, 25)]:
+            active = Membership.objects.active_memberships(day)
+            self.assertEqual(totals[day]['member_count'], active.count())
+            self.assertEqual(totals[day]['desk_count'], active.filter(has_desk=True).count())
+            self.assertEqual(totals[day]['monthly_revenue'], sum(m.monthly_rate for m in active))
+
+        # Changing a membership updates the days already snapshotted
+        m2 = Membership.objects.get(user=self.user2)
+        m2.start_date = date(2013, 1, 21)
+        m2.save()
+        counts = MembershipDailySnapshot.objects.plan_counts(date(2013, 1, 1), date(2013, 1, 31))
+        self.assertEqual(counts.get((date(2013, 1, 12), self.residentPlan.id)), 1)
+        self.assertEqual(counts.get((date(2013, 1, 21), self.residentPlan.id)), 1)
+        self.assertEqual(counts.get((date(2013, 1, 16), basicPlan.id)), 1)
+        Membership.objects.get(user=self.user1).delete()
+        counts = MembershipDailySnapshot.objects.plan_counts(date(2013, 1, 1), date(2013, 1, 31))
+        self.assertEqual(counts.get((date(2013, 1, 5), self.residentPlan.id)), None)
+        self.assertEqual(counts.get((date(2013, 1, 25), self.residentPlan.id)), 1)
+
+        # Edits the snapshots don't depend on leave them alone
+        m3 = Membership.objects.get(user=self.user3)
+        m3.has_key = True
+        with CaptureQueriesContext(connection) as queries:
+            m3.save()
+        self.assertFalse([q for q in queries if 'membershipdailysnapshot' in q['sql']])
+
+        # And the rest only change the days which count differently, ending up where a full recalculation would
+        def stored():
+            return sorted((s.date, s.plan_id, s.member_count, s.desk_count, s.monthly_revenue) for s in MembershipDailySnapshot.objects.all())
+        def calculated():
+            return sorted((s.date, s.plan_id, s.member_count, s.desk_count, s.monthly_revenue) for s in MembershipDailySnapshot.objects.calculate(date(2012, 12, 1), date(2013, 1, 31)))
+        m3.monthly_rate = 60
+        m3.save()
+        self.assertEqual(stored(), calculated())
+        m3.membership_plan = self.residentPlan
+        m3.has_desk = True
+        m3.start_date = date(2013, 1, 12)
+        m3.save()
+        self.assertEqual(stored(), calculated())
+        Membership.objects.create_with_plan(user=self.user4, start_date=date(2012, 12, 1), end_date=None, membership_plan=basicPlan)
+        self.assertEqual(stored(), calculated())
+        textPlan = MembershipPlan.objects.create(name="Text", monthly_rate="75", dropin_allowance=5, daily_rate=20, has_desk=False)
+        Membership.objects.create_with_plan(user=self.user5, start_date=date(2013, 1, 3), end_date=None, membership_plan=textPlan)
+        self.assertEqual(stored(), calculated())
+
+    def test_active_counts_between(self):
+        basicPlan = MembershipPlan.objects.create(name="Basic", monthly_rate=50, dropin_allowance=3, daily_rate=20, has_desk=False)
+        Membership.objects.create_with_plan(user=self.user1, start_date=date(2012, 12, 1), end_date=date(2013, 1, 20), membership_plan=self.residentPlan)
+        Membership.objects.create_with_plan(user=self.user2, start_date=date(2013, 1, 10), end_date=None, membership_plan=self.residentPlan)
+        Membership.objects.create_with_plan(user=self.user3, start_date=date(2013, 1, 15), end_date=date(2013, 1, 15), membership_plan=basicPlan)
+        Membership.objects.create_with_plan(user=self.user4, start_date=date(2013, 2, 15), end_date=None, membership_plan=basicPlan)
+
+        series = Membership.objects.active_counts_between(date(2013, 1, 1), date(2013, 1, 31))
+        self.assertEqual(len(series), 31)
+        for day, counts in series:
+            active = Membership.objects.active_memberships(day)
+            for plan in [self.residentPlan, basicPlan]:
+                self.assertEqual(counts.get((plan.id, ), 0), active.filter(membership_plan=plan).count())
+        self.assertEqual(series[14][1][(basicPlan.id, )], 1)
+        self.assertEqual(series[15][1][(basicPlan.id, )], 0)
+
+        series = Membership.objects.active_counts_between(date(2013, 1, 1), date(2013, 1, 31), group_by=())
+        self.assertEqual([counts[()] for day, counts in series[8:11]], [1, 2, 2])
+        self.assertEqual(Membership.objects.active_counts_between(date(2013, 1, 2), date(2013, 1, 1)), [])
+
+
 # Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
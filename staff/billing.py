@@ -1,24 +1,27 @@
 import time
 import logging
+import multiprocessing
 import traceback
 from datetime import datetime, timedelta, date
 
 from django.conf import settings
-from django.db.models import Count, Q
+from django.db import connection, connections, transaction
+from django.db.models import Count, F, Max, Q
 from django.core.exceptions import ObjectDoesNotExist
 from django.utils import timezone
 from django.contrib.auth.models import User
 
-from nadine.models.membership import Membership
-from nadine.models.payment import Bill, BillingLog, Transaction
+from nadine.models.membership import Membership, MembershipPlan
+from nadine.models.payment import Bill, BillingCheckpoint, BillingDirty, BillingLog, Transaction
 from nadine.models.usage import CoworkingDay
 
 logger = logging.getLogger(__name__)
 
 
-class Day:
+class Day(object):
 
     """All of the daily_logs, memberships, and (optionally) a bill associated with this day of a Run."""
+    __slots__ = ('date', 'membership', 'daily_log', 'guest_daily_logs', 'bill')
 
     def __init__(self, date):
         self.date = date
@@ -35,16 +38,97 @@ class Day:
         return 'Day %s' % self.date
 
 
+class Calendar(object):
+
+    """The Days from start_date through end_date, stored in a list indexed by their offset from start_date
+    so a date can be found in constant time and a date range is a slice."""
+    __slots__ = ('start_date', 'end_date', 'days')
+
+    def __init__(self, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.days = [Day(start_date + timedelta(days=i)) for i in range((end_date - start_date).days + 1)]
+
+    def offset(self, day):
+        return (day - self.start_date).days
+
+    def get(self, day):
+        """Returns the Day for this date or None if it is outside the calendar."""
+        i = self.offset(day)
+        if i < 0 or i >= len(self.days):
+            return None
+        return self.days[i]
+
+    def between(self, start_date, end_date=None):
+        """Returns the list of Days from start_date through end_date (or the end of the calendar), clipped to the calendar."""
+        first = max(0, self.offset(start_date))
+        last = len(self.days) - 1
+        if end_date:
+            last = min(last, self.offset(end_date))
+        if last < first:
+            return []
+        return self.days[first:last + 1]
+
+    def __getitem__(self, i):
+        return self.days[i]
+
+    def __iter__(self):
+        return iter(self.days)
+
+    def __len__(self):
+        return len(self.days)
+
+
+class RunData:
+
+    """The memberships and daily_logs a Run is built from, either queried for one user or handed out by a BillingEngine."""
+
+    def __init__(self, memberships=None, daily_logs=None, guest_daily_logs=None):
+        self.memberships = memberships or []
+        self.daily_logs = daily_logs or []
+        self.guest_daily_logs = guest_daily_logs or []
+
+    @staticmethod
+    def load(user, start_date, end_date, filter_closed_logs=True):
+        data = RunData()
+        data.memberships = list(Membership.objects.filter(user=user).order_by('start_date'))
+
+        # Grab all the daily_logs from this user
+        daily_logs = CoworkingDay.objects.filter(user=user, payment="Bill", paid_by=None).filter(visit_date__gte=start_date).filter(visit_date__lte=end_date)
+        if filter_closed_logs:
+            daily_logs = daily_logs.annotate(bill_count=Count('bills')).filter(bill_count=0)
+        data.daily_logs = list(daily_logs.order_by('visit_date'))
+
+        # Grab all the daily_logs marked as a guest of this user
+        daily_logs = CoworkingDay.objects.filter(paid_by=user, payment="Bill").filter(visit_date__gte=start_date).filter(visit_date__lte=end_date)
+        if filter_closed_logs:
+            daily_logs = daily_logs.annotate(bill_count=Count('bills')).filter(bill_count=0)
+        data.guest_daily_logs = list(daily_logs.order_by('visit_date'))
+
+        # Grab all the daily_logs attached to memberships marked as guests of this user
+        for membership in Membership.objects.filter(paid_by=user).order_by('start_date'):
+            if membership.end_date and membership.end_date < start_date:
+                continue
+            if membership.start_date > end_date:
+                continue
+            for log in CoworkingDay.objects.filter(user=membership.user, payment="Bill", paid_by=None).filter(visit_date__gte=start_date).filter(visit_date__lte=end_date):
+                data.guest_daily_logs.append(log)
+        return data
+
+
 class Run:
 
     """The information which is gathered for a time period in order to calculate billing."""
 
-    def __init__(self, user, start_date, end_date, filter_closed_logs=True):
+    def __init__(self, user, start_date, end_date, filter_closed_logs=True, data=None):
         self.user = user
         self.start_date = start_date
         self.end_date = end_date
-        self.days = []
+        self.days = None
         self.filter_closed_logs = filter_closed_logs
+        if data is None:
+            data = RunData.load(user, start_date, end_date, filter_closed_logs)
+        self.data = data
 
         self.populate_days()
         self.populate_memberships()
@@ -75,60 +159,37 @@ class Run:
         return False
 
     def populate_days(self):
-        for i in range((self.end_date - self.start_date).days + 1):
-            self.days.append(Day(self.start_date + timedelta(days=i)))
+        self.days = Calendar(self.start_date, self.end_date)
 
     def populate_memberships(self):
-        for membership in Membership.objects.filter(user=self.user).order_by('start_date'):
+        for membership in self.data.memberships:
             if membership.end_date and membership.end_date < self.start_date:
                 continue
             if membership.start_date > self.end_date:
                 continue
-            for i in range(0, len(self.days)):
-                if self.days[i].date >= membership.start_date:
-                    if membership.end_date == None or self.days[i].date <= membership.end_date:
-                        if self.days[i].membership:
-                            print('Duplicate membership! %s' % membership)
-                        self.days[i].membership = membership
+            for day in self.days.between(membership.start_date, membership.end_date):
+                if day.membership:
+                    print('Duplicate membership! %s' % membership)
+                day.membership = membership
 
     def populate_daily_logs(self):
-        # Grab all the daily_logs from this user
-        daily_logs = CoworkingDay.objects.filter(user=self.user, payment="Bill", paid_by=None).filter(visit_date__gte=self.start_date).filter(visit_date__lte=self.end_date)
-        if self.filter_closed_logs:
-            daily_logs = daily_logs.annotate(bill_count=Count('bills')).filter(bill_count=0)
-        for log in daily_logs.order_by('visit_date'):
+        for log in self.data.daily_logs:
             self.add_daily_log(log)
-
-        # Grab all the daily_logs marked as a guest of this user
-        daily_logs = CoworkingDay.objects.filter(paid_by=self.user, payment="Bill").filter(visit_date__gte=self.start_date).filter(visit_date__lte=self.end_date)
-        if self.filter_closed_logs:
-            daily_logs = daily_logs.annotate(bill_count=Count('bills')).filter(bill_count=0)
-        for log in daily_logs.order_by('visit_date'):
+        for log in self.data.guest_daily_logs:
             self.add_guest_log(log)
 
-        # Grab all the daily_logs attached to memberships marked as guests of this user
-        for membership in Membership.objects.filter(paid_by=self.user).order_by('start_date'):
-            if membership.end_date and membership.end_date < self.start_date:
-                continue
-            if membership.start_date > self.end_date:
-                continue
-            for log in CoworkingDay.objects.filter(user=membership.user, payment="Bill", paid_by=None).filter(visit_date__gte=self.start_date).filter(visit_date__lte=self.end_date):
-                self.add_guest_log(log)
-
     def add_daily_log(self, log):
-        for i in range(0, len(self.days)):
-            if log.visit_date == self.days[i].date:
-                if self.days[i].membership and self.days[i].membership.paid_by:
-                    # Skip guest activity.  It will get picked up by the host's bill.
-                    break
-                self.days[i].daily_log = log
-                break
+        day = self.days.get(log.visit_date)
+        if day:
+            if day.membership and day.membership.paid_by_id:
+                # Skip guest activity.  It will get picked up by the host's bill.
+                return
+            day.daily_log = log
 
     def add_guest_log(self, log):
-        for i in range(0, len(self.days)):
-            if log.visit_date == self.days[i].date:
-                self.days[i].guest_daily_logs.append(log)
-                break
+        day = self.days.get(log.visit_date)
+        if day:
+            day.guest_daily_logs.append(log)
 
     def print_info(self):
         for day in self.days:
@@ -148,7 +209,337 @@ class Run:
         return 'Run for %s (%s / %s)' % (self.user, self.days[0].date, self.days[len(self.days) - 1].date)
 
 
-def run_billing(bill_time=None):
+class BillingEngine:
+
+    """Loads the memberships, daily_logs, and last bill dates for every user in a fixed number of queries
+    and partitions them in memory so each user's Run is built without touching the database.
+    Given the user ids from the BillingDirty journal, only those users (and their hosts) and users
+    who are scheduled for a bill get a Run."""
+
+    def __init__(self, bill_date, users=None, dirty_ids=None):
+        self.bill_date = bill_date
+        if users is None:
+            users = User.objects.all()
+        self.user_query = users
+        self.dirty_ids = dirty_ids
+        self.default_start_date = bill_date - timedelta(days=62)
+        if self.default_start_date < settings.BILLING_START_DATE:
+            self.default_start_date = settings.BILLING_START_DATE
+        self.load()
+
+    def start_date_for(self, user_id):
+        last_bill_date = self.last_bill_dates.get(user_id)
+        if last_bill_date:
+            return last_bill_date + timedelta(days=1)
+        return self.default_start_date
+
+    def load(self):
+        self.users = list(self.user_query.order_by('id'))
+        self.last_bill_dates = dict(Bill.objects.order_by().values_list('user').annotate(Max('bill_date')))
+        self.window_start = self.default_start_date
+        for user in self.users:
+            self.window_start = min(self.window_start, self.start_date_for(user.id))
+
+        self.memberships = {}
+        self.guest_memberships = {}
+        memberships = Membership.objects.filter(start_date__lte=self.bill_date).filter(Q(end_date__isnull=True) | Q(end_date__gte=self.window_start))
+        for membership in memberships.order_by('start_date'):
+            self.memberships.setdefault(membership.user_id, []).append(membership)
+            if membership.paid_by_id:
+                self.guest_memberships.setdefault(membership.paid_by_id, []).append(membership)
+
+        # Only open daily_logs are billed, except for those of guest memberships which are always passed to the host
+        self.daily_logs = {}
+        self.guest_daily_logs = {}
+        guest_member_ids = Membership.objects.filter(paid_by__isnull=False).values('user')
+        daily_logs = CoworkingDay.objects.filter(payment="Bill", visit_date__gte=self.window_start, visit_date__lte=self.bill_date)
+        daily_logs = daily_logs.annotate(bill_count=Count('bills')).filter(Q(bill_count=0) | Q(paid_by=None, user__in=guest_member_ids))
+        for log in daily_logs.order_by('visit_date'):
+            if log.paid_by_id:
+                self.guest_daily_logs.setdefault(log.paid_by_id, []).append(log)
+            else:
+                self.daily_logs.setdefault(log.user_id, []).append(log)
+
+    def data_for(self, user_id, start_date):
+        data = RunData()
+        data.memberships = self.memberships.get(user_id, [])
+        data.daily_logs = [l for l in self.daily_logs.get(user_id, []) if l.visit_date >= start_date and l.bill_count == 0]
+        data.guest_daily_logs = [l for l in self.guest_daily_logs.get(user_id, []) if l.visit_date >= start_date and l.bill_count == 0]
+        for membership in self.guest_memberships.get(user_id, []):
+            if membership.end_date and membership.end_date < start_date:
+                continue
+            for log in self.daily_logs.get(membership.user_id, []):
+                if log.visit_date >= start_date:
+                    data.guest_daily_logs.append(log)
+        return data
+
+    def is_scheduled(self, start_date, data):
+        """True if a membership has an anniversary or end date between start_date and the bill date,
+        or there are open daily_logs and no membership on the bill date to cover them."""
+        covered = False
+        for membership in data.memberships:
+            first_day = max(start_date, membership.start_date)
+            last_day = self.bill_date
+            if membership.end_date and membership.end_date < last_day:
+                last_day = membership.end_date
+            if first_day > last_day:
+                continue
+            if membership.end_date == last_day:
+                return True
+            if (last_day - first_day).days >= 31:
+                return True  # every month has an anniversary day
+            day = first_day
+            while day <= last_day:
+                if membership.is_anniversary_day(day):
+                    return True
+                day = day + timedelta(days=1)
+            if last_day == self.bill_date:
+                covered = True
+        return not covered and (len(data.daily_logs) > 0 or len(data.guest_daily_logs) > 0)
+
+    def dirty_hosts(self):
+        """The dirty users along with anyone paying for their memberships."""
+        user_ids = set(self.dirty_ids)
+        for user_id in self.dirty_ids:
+            for membership in self.memberships.get(user_id, []):
+                if membership.paid_by_id:
+                    user_ids.add(membership.paid_by_id)
+        return user_ids
+
+    def runs(self):
+        """Yields a Run for every user who has a membership or daily_logs to bill."""
+        dirty_ids = None
+        if self.dirty_ids is not None:
+            dirty_ids = self.dirty_hosts()
+        for user in self.users:
+            start_date = self.start_date_for(user.id)
+            data = self.data_for(user.id, start_date)
+            if not data.memberships and not data.daily_logs and not data.guest_daily_logs:
+                continue
+            if dirty_ids is not None and user.id not in dirty_ids and not self.is_scheduled(start_date, data):
+                continue
+            yield Run(user, start_date, self.bill_date, data=data)
+
+
+def generate_bills(run, bill_date):
+    """Calculates the Bills due for a Run and returns them unsaved as (bill, dropins, guest_dropins) tuples."""
+    bills = []
+    for day_index in range(0, len(run.days)):  # look for days on which we should bill for a membership
+        day = run.days[day_index]
+        if day.is_membership_anniversary() or day.is_membership_end_date():
+            bill_dropins = []
+            bill_guest_dropins = []
+            recent_days = run.days[0:day_index + 1]
+            recent_days.reverse()
+            for recent_day in recent_days:  # gather the daily logs for this user and guests under this membership
+                if recent_day.bill:
+                    break
+                if recent_day.daily_log:
+                    bill_dropins.append(recent_day.daily_log)
+                for guest_daily_log in recent_day.guest_daily_logs:
+                    bill_guest_dropins.append(guest_daily_log)
+            # now calculate the bill amount
+            bill_amount = 0
+            monthly_fee = day.membership.monthly_rate
+            if day.is_membership_end_date():
+                monthly_fee = 0
+            billable_dropin_count = max(0, len(bill_dropins) + len(bill_guest_dropins) - day.membership.dropin_allowance)
+            bill_amount = monthly_fee + (billable_dropin_count * day.membership.daily_rate)
+            day.bill = Bill(bill_date=day.date, amount=bill_amount, user=run.user, paid_by_id=day.membership.paid_by_id, membership=day.membership)
+            bills.append((day.bill, bill_dropins, bill_guest_dropins))
+
+    # Now calculate a bill for non-member drop-ins if they exist.
+    bill_dropins, guest_bill_dropins = run.non_member_daily_logs()
+    if len(bill_dropins) > 0 or len(guest_bill_dropins) > 0:
+        time_to_bill_guests = len(guest_bill_dropins) > 0 and (bill_date - guest_bill_dropins[0].visit_date) >= timedelta(days=1)
+        time_to_bill_dropins = len(bill_dropins) > 0 and (bill_date - bill_dropins[0].visit_date) >= timedelta(days=1)
+        if time_to_bill_guests or time_to_bill_dropins:
+            bill_amount = (len(bill_dropins) + len(guest_bill_dropins)) * settings.NON_MEMBER_DROPIN_FEE
+            last_day = run.days[len(run.days) - 1]
+            last_day.bill = Bill(bill_date=last_day.date, amount=bill_amount, user=run.user)
+            bills.append((last_day.bill, bill_dropins, guest_bill_dropins))
+    return bills
+
+
+class BillWriter:
+
+    """Buffers the Bills from a billing run and writes them, their drop-ins, and any closing Transactions
+    with bulk inserts, one database transaction per chunk.  When given a BillingLog, each user is checkpointed
+    in the same transaction as their bills and chunks are only cut between users."""
+
+    def __init__(self, chunk_size=None, billing_log=None, shard=0):
+        self.chunk_size = chunk_size or settings.BILLING_CHUNK_SIZE
+        self.billing_log = billing_log
+        self.shard = shard
+        self.pending = []
+        self.checkpoints = []
+        self.bill_count = 0
+        self.row_count = 0
+        self.elapsed = 0.0
+
+    def add(self, bill, dropins, guest_dropins):
+        self.pending.append((bill, dropins, guest_dropins))
+        if not self.billing_log and len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def checkpoint(self, user):
+        """Marks every bill for this user as added.  They will be written along with the checkpoint."""
+        if self.billing_log:
+            self.checkpoints.append(BillingCheckpoint(billing_log=self.billing_log, user_id=user.id, shard=self.shard))
+        if max(len(self.pending), len(self.checkpoints)) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending and not self.checkpoints:
+            return
+        started = time.time()
+        with transaction.atomic():
+            bills = [bill for bill, dropins, guest_dropins in self.pending]
+            self.insert(Bill, bills)
+
+            dropin_links = []
+            guest_dropin_links = []
+            for bill, dropins, guest_dropins in self.pending:
+                for dropin in dropins:
+                    dropin_links.append(Bill.dropins.through(bill_id=bill.id, coworkingday_id=dropin.id))
+                for dropin in guest_dropins:
+                    guest_dropin_links.append(Bill.guest_dropins.through(bill_id=bill.id, coworkingday_id=dropin.id))
+            Bill.dropins.through.objects.bulk_create(dropin_links)
+            Bill.guest_dropins.through.objects.bulk_create(guest_dropin_links)
+
+            # Close out the transaction if no money is due
+            closed_bills = [bill for bill in bills if bill.membership_id and bill.amount == 0]
+            transactions = [Transaction(user_id=bill.user_id, amount=0, status='closed') for bill in closed_bills]
+            self.insert(Transaction, transactions)
+            transaction_links = [Transaction.bills.through(transaction_id=t.id, bill_id=b.id) for t, b in zip(transactions, closed_bills)]
+            Transaction.bills.through.objects.bulk_create(transaction_links)
+            BillingCheckpoint.objects.bulk_create(self.checkpoints)
+        self.elapsed += time.time() - started
+        self.bill_count += len(bills)
+        self.row_count += len(bills) + len(dropin_links) + len(guest_dropin_links) + len(transactions) + len(transaction_links)
+        self.pending = []
+        self.checkpoints = []
+
+    def insert(self, model, objects):
+        # Only some backends (PostgreSQL) hand back primary keys from a bulk insert
+        if connection.features.can_return_ids_from_bulk_insert:
+            model.objects.bulk_create(objects, batch_size=self.chunk_size)
+        else:
+            for obj in objects:
+                obj.save()
+
+    def summary(self):
+        return write_summary(self.bill_count, self.row_count, self.elapsed)
+
+
+def write_summary(bill_count, row_count, elapsed):
+    rows_per_second = 0
+    if elapsed > 0:
+        rows_per_second = row_count / elapsed
+    return "Wrote %d bills (%d rows) in %.2f seconds, %d rows/sec" % (bill_count, row_count, elapsed, rows_per_second)
+
+
+class ShardResult:
+
+    """The counts and timing from billing one shard of users, small enough to hand back from a worker process."""
+
+    def __init__(self, shard, user_count, writer, elapsed):
+        self.shard = shard
+        self.user_count = user_count
+        self.bill_count = writer.bill_count
+        self.row_count = writer.row_count
+        self.write_elapsed = writer.elapsed
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return "Shard %d: %d users, %d bills (%d rows) in %.2f seconds" % (self.shard, self.user_count, self.bill_count, self.row_count, self.elapsed)
+
+
+def shard_users(billing_log, shard=0, shard_count=1):
+    """Returns the users in this shard which have not yet been checkpointed for this BillingLog."""
+    users = User.objects.exclude(id__in=billing_log.checkpoints.values('user'))
+    if shard_count > 1:
+        users = users.annotate(billing_shard=F('id') % shard_count).filter(billing_shard=shard)
+    return users
+
+
+def bill_users(billing_log, bill_date, users, shard=0, chunk_size=None, dirty_ids=None):
+    """Generates and writes the bills for the given users, checkpointing each one against the BillingLog."""
+    started = time.time()
+    writer = BillWriter(chunk_size, billing_log=billing_log, shard=shard)
+    engine = BillingEngine(bill_date, users=users, dirty_ids=dirty_ids)
+    for run in engine.runs():
+        for bill, dropins, guest_dropins in generate_bills(run, bill_date):
+            writer.add(bill, dropins, guest_dropins)
+        writer.checkpoint(run.user)
+    writer.flush()
+    return ShardResult(shard, len(engine.users), writer, time.time() - started)
+
+
+def bill_shard(args):
+    """Entry point for billing worker processes."""
+    billing_log_id, bill_date, shard, shard_count, chunk_size, dirty_ids = args
+    billing_log = BillingLog.objects.get(pk=billing_log_id)
+    return bill_users(billing_log, bill_date, shard_users(billing_log, shard, shard_count), shard, chunk_size, dirty_ids)
+
+
+def dry_run(bill_time=None):
+    """Calculates every bill run_billing would create without writing anything.
+    Returns a list of dictionaries describing each bill, suitable for JSON."""
+    if not bill_time:
+        bill_time = timezone.localtime(timezone.now())
+    bill_date = datetime.date(bill_time)
+    plan_names = dict(MembershipPlan.objects.values_list('id', 'name'))
+    bills = []
+    for run in BillingEngine(bill_date).runs():
+        for bill, dropins, guest_dropins in generate_bills(run, bill_date):
+            plan = None
+            if bill.membership:
+                plan = plan_names.get(bill.membership.membership_plan_id)
+            bills.append({
+                'user_id': run.user.id,
+                'username': run.user.username,
+                'bill_date': bill.bill_date.isoformat(),
+                'amount': float(bill.amount),
+                'membership_id': bill.membership_id,
+                'plan': plan,
+                'paid_by_id': bill.paid_by_id,
+                'dropins': [d.id for d in dropins],
+                'guest_dropins': [d.id for d in guest_dropins],
+            })
+    return bills
+
+
+def plan_totals(bills):
+    """Returns a list of dictionaries with the bill count and amount for each plan, sorted by plan name."""
+    totals = {}
+    for bill in bills:
+        total = totals.setdefault(bill['plan'], {'plan': bill['plan'], 'bills': 0, 'amount': 0})
+        total['bills'] += 1
+        total['amount'] += bill['amount']
+    return [totals[plan] for plan in sorted(totals.keys())]
+
+
+def diff_bills(previous, current):
+    """Compares two lists of dry run bills and returns a list of (change, bill) tuples,
+    where change is one of 'added', 'removed', or 'changed'."""
+    key = lambda b: (b['user_id'], b['bill_date'], b['membership_id'])
+    previous_bills = dict((key(b), b) for b in previous)
+    current_bills = dict((key(b), b) for b in current)
+    changes = []
+    for k in sorted(current_bills.keys()):
+        bill = current_bills[k]
+        if k not in previous_bills:
+            changes.append(('added', bill))
+        elif previous_bills[k] != bill:
+            changes.append(('changed', bill))
+    for k in sorted(previous_bills.keys()):
+        if k not in current_bills:
+            changes.append(('removed', previous_bills[k]))
+    return changes
+
+
+def run_billing(bill_time=None, chunk_size=None, shards=1, resume=False, incremental=False):
     if not bill_time:
         bill_time = timezone.localtime(timezone.now())
     """Generate billing records for every user who deserves it."""
@@ -158,80 +549,60 @@ def run_billing(bill_time=None):
         latest_billing_log = BillingLog.objects.latest()
     except ObjectDoesNotExist:
         latest_billing_log = None
-    if latest_billing_log and not latest_billing_log.ended:
+    if resume and latest_billing_log and not latest_billing_log.successful:
+        # Pick up where the last run left off, skipping every user it checkpointed.  Clearing ended claims
+        # the log so only one run can resume it, and never while the run that started it is still going.
+        if not BillingLog.objects.filter(pk=latest_billing_log.pk, ended__isnull=False).update(ended=None):
+            logger.warning("run_billing: The last billing log (%s) is still in progress.  Not resuming." % latest_billing_log)
+            return
+        billing_log = latest_billing_log
+        billing_log.ended = None
+        if billing_log.bill_date:
+            bill_date = billing_log.bill_date
+        logger.info("run_billing: Resuming %s for bill_date=%s" % (billing_log, bill_date))
+    elif latest_billing_log and not latest_billing_log.ended:
         logger.warning("run_billing:The last billing log (%s) claims to be in progress.	Aborting billing." % latest_billing_log)
         return
+    else:
+        billing_log = BillingLog.objects.create(bill_date=bill_date)
 
-    billing_log = BillingLog.objects.create()
     billing_success = False
-    bill_count = 0
+    results = []
     try:
-        # This should be changed to "all users w/ activity"
-        for user in User.objects.all():
-            last_bill = user.profile.last_bill()
-            if last_bill:
-                start_date = last_bill.bill_date + timedelta(days=1)
-            else:
-                start_date = bill_date - timedelta(days=62)
-                if start_date < settings.BILLING_START_DATE:
-                    start_date = settings.BILLING_START_DATE
-            run = Run(user, start_date, bill_date)
-            for day_index in range(0, len(run.days)):  # look for days on which we should bill for a membership
-                day = run.days[day_index]
-                if day.is_membership_anniversary() or day.is_membership_end_date():
-                    bill_dropins = []
-                    bill_guest_dropins = []
-                    recent_days = run.days[0:day_index + 1]
-                    recent_days.reverse()
-                    for recent_day in recent_days:  # gather the daily logs for this user and guests under this membership
-                        if recent_day.bill:
-                            break
-                        if recent_day.daily_log:
-                            bill_dropins.append(recent_day.daily_log)
-                        for guest_daily_log in recent_day.guest_daily_logs:
-                            bill_guest_dropins.append(guest_daily_log)
-                    # now calculate the bill amount
-                    bill_amount = 0
-                    monthly_fee = day.membership.monthly_rate
-                    if day.is_membership_end_date():
-                        monthly_fee = 0
-                    billable_dropin_count = max(0, len(bill_dropins) + len(bill_guest_dropins) - day.membership.dropin_allowance)
-                    bill_amount = monthly_fee + (billable_dropin_count * day.membership.daily_rate)
-                    day.bill = Bill(bill_date=day.date, amount=bill_amount, user=user, paid_by=day.membership.paid_by, membership=day.membership)
-                    #logger.debug('saving bill: %s - %s - %s' % (day.bill, day, billable_dropin_count))
-                    day.bill.save()
-                    bill_count += 1
-                    day.bill.dropins = [dropin.id for dropin in bill_dropins]
-                    day.bill.guest_dropins = [dropin.id for dropin in bill_guest_dropins]
-                    day.bill.save()
-
-                    # Close out the transaction if no money is due
-                    if bill_amount == 0:
-                        transaction = Transaction(user=user, amount=0, status='closed')
-                        transaction.save()
-                        transaction.bills = [day.bill]
-                        transaction.save()
-
-            # Now calculate a bill for non-member drop-ins if they exist.
-            bill_dropins, guest_bill_dropins = run.non_member_daily_logs()
-            if len(bill_dropins) > 0 or len(guest_bill_dropins) > 0:
-                time_to_bill_guests = len(guest_bill_dropins) > 0 and (bill_date - guest_bill_dropins[0].visit_date) >= timedelta(days=1)
-                time_to_bill_dropins = len(bill_dropins) > 0 and (bill_date - bill_dropins[0].visit_date) >= timedelta(days=1)
-                if time_to_bill_guests or time_to_bill_dropins:
-                    bill_amount = (len(bill_dropins) + len(guest_bill_dropins)) * settings.NON_MEMBER_DROPIN_FEE
-                    last_day = run.days[len(run.days) - 1]
-                    last_day.bill = Bill(bill_date=last_day.date, amount=bill_amount, user=user)
-                    last_day.bill.save()
-                    bill_count += 1
-                    last_day.bill.dropins = [dropin.id for dropin in bill_dropins]
-                    last_day.bill.guest_dropins = [dropin.id for dropin in guest_bill_dropins]
-                    last_day.bill.save()
-
+        # Only the journal entries which exist now are consumed by this run
+        dirty_ids = None
+        last_dirty_id = None
+        if incremental:
+            last_dirty_id = BillingDirty.objects.aggregate(Max('id'))['id__max'] or 0
+            dirty_ids = set(BillingDirty.objects.filter(id__lte=last_dirty_id).values_list('user', flat=True))
+
+        if shards > 1:
+            # Each worker process needs its own database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(shards)
+            try:
+                for result in pool.imap_unordered(bill_shard, [(billing_log.id, bill_date, shard, shards, chunk_size, dirty_ids) for shard in range(shards)]):
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results.append(bill_users(billing_log, bill_date, shard_users(billing_log), 0, chunk_size, dirty_ids))
+
+        with transaction.atomic():
+            if incremental:
+                BillingDirty.objects.filter(id__lte=last_dirty_id).delete()
+            billing_log.checkpoints.all().delete()
         billing_success = True
-        logger.info("run_billing: Successfully created %s bills" % bill_count)
+        billing_log.note = write_summary(sum(r.bill_count for r in results), sum(r.row_count for r in results), sum(r.write_elapsed for r in results))
+        logger.info("run_billing: Successfully created %s bills" % sum(r.bill_count for r in results))
     except:
         billing_log.note = traceback.format_exc()
     finally:
+        timing = "\n".join([str(r) for r in sorted(results, key=lambda r: r.shard)])
+        if billing_log.shard_timing:
+            timing = "%s\n%s" % (billing_log.shard_timing, timing)
+        billing_log.shard_timing = timing
         billing_log.ended = timezone.localtime(timezone.now())
         billing_log.successful = billing_success
         billing_log.save()
@@ -205,4 +205,143 @@ class BillingTestCase(TestCase):
         self.assertEqual(date(2010, 6, 20), june_20_basic.bill_date)
         self.assertEqual(0, june_20_basic.dropins.count())
 
+    def test_engine_matches_user_runs(self):
+        bill_date = date(2010, 6, 20)
+        engine = billing.BillingEngine(bill_date)
+        runs = dict((run.user, run) for run in engine.runs())
+        for user in [self.user3, self.user4, self.user5, self.user6, self.user7]:
+            engine_run = runs[user]
+            user_run = billing.Run(user, engine_run.start_date, bill_date)
+            self.assertEqual(len(engine_run.days), len(user_run.days))
+            for engine_day, user_day in zip(engine_run.days, user_run.days):
+                self.assertEqual(engine_day.membership, user_day.membership)
+                self.assertEqual(engine_day.daily_log, user_day.daily_log)
+                self.assertEqual(sorted(l.id for l in engine_day.guest_daily_logs), sorted(l.id for l in user_day.guest_daily_logs))
+
+    def test_engine_query_count(self):
+        for i in range(10):
+            user = User.objects.create(username='member_extra_%d' % i)
+            Membership.objects.create_with_plan(user=user, start_date=date(2010, 1, 1), end_date=None, membership_plan=self.basicPlan)
+            CoworkingDay.objects.create(user=user, visit_date=date(2010, 6, 1), payment='Bill')
+        with self.assertNumQueries(4):
+            runs = list(billing.BillingEngine(date(2010, 6, 20)).runs())
+        self.assertEqual(len(runs), 15)
+
+    def test_bill_writer(self):
+        billing.run_billing(datetime(2010, 6, 26), chunk_size=2)
+        billing_log = BillingLog.objects.latest()
+        self.assertTrue(billing_log.successful)
+        self.assertIn("rows/sec", billing_log.note)
+
+        # User 6 picks up the 15 guest drop-ins from User 7
+        host_bill = self.user6.profile.last_bill()
+        self.assertEqual(host_bill.guest_dropins.count(), 15)
+        self.assertEqual(host_bill.amount, 275)
+
+        # User 7's bill is covered by User 6 so it is closed out with a transaction
+        guest_bill = self.user7.profile.last_bill()
+        self.assertEqual(guest_bill.amount, 0)
+        self.assertEqual(guest_bill.transactions.count(), 1)
+        self.assertEqual(guest_bill.transactions.first().status, 'closed')
+
+    def test_sharded_billing(self):
+        bill_date = date(2010, 6, 26)
+        billing_log = BillingLog.objects.create(bill_date=bill_date)
+        results = [billing.bill_shard((billing_log.id, bill_date, shard, 3, None, None)) for shard in range(3)]
+        self.assertEqual(sum(r.user_count for r in results), User.objects.count())
+        checkpointed = BillingCheckpoint.objects.filter(billing_log=billing_log)
+        self.assertEqual(checkpointed.count(), 5)
+        self.assertEqual(checkpointed.values('user').distinct().count(), 5)
+        self.assertEqual(self.user6.profile.last_bill().guest_dropins.count(), 15)
+        self.assertEqual(self.user6.profile.last_bill().amount, 275)
+
+    def test_resume_billing(self):
+        # An interrupted run which had already billed User 7
+        billing_log = BillingLog.objects.create(bill_date=date(2010, 6, 26))
+        BillingCheckpoint.objects.create(billing_log=billing_log, user=self.user7)
+
+        # Nothing is resumed while that run is still going
+        billing.run_billing(datetime(2010, 6, 27), resume=True)
+        self.assertEqual(BillingLog.objects.get(pk=billing_log.pk).ended, None)
+        self.assertEqual(self.user6.profile.last_bill(), None)
+
+        BillingLog.objects.filter(pk=billing_log.pk).update(ended=timezone.now())
+        billing.run_billing(datetime(2010, 6, 27), resume=True)
+        billing_log = BillingLog.objects.get(pk=billing_log.pk)
+        self.assertTrue(billing_log.successful)
+        self.assertEqual(BillingLog.objects.count(), 1)
+        self.assertEqual(billing_log.checkpoints.count(), 0)
+        self.assertIn("Shard 0", billing_log.shard_timing)
+        self.assertEqual(self.user6.profile.last_bill().bill_date, date(2010, 6, 26))
+        self.assertEqual(self.user7.profile.last_bill(), None)
+
+    def test_billing_dirty_journal(self):
+        dirty_ids = set(BillingDirty.objects.values_list('user', flat=True))
+        self.assertEqual(dirty_ids, set([self.user3.id, self.user4.id, self.user5.id, self.user6.id, self.user7.id]))
+
+        # A drop-in for a guest also marks their host
+        BillingDirty.objects.all().delete()
+        user8 = User.objects.create(username='member_eight')
+        CoworkingDay.objects.create(user=user8, visit_date=date(2010, 6, 1), payment='Bill', paid_by=self.user6)
+        self.assertEqual(set(BillingDirty.objects.values_list('user', flat=True)), set([user8.id, self.user6.id]))
+
+        # The bills billing writes mark no one, however they are written, but deleting one does
+        BillingDirty.objects.all().delete()
+        billing.run_billing(datetime(2010, 6, 19))
+        self.assertFalse(BillingDirty.objects.exists())
+        self.user3.profile.last_bill().delete()
+        self.assertEqual(list(BillingDirty.objects.values_list('user', flat=True)), [self.user3.id])
+
+    def test_incremental_billing(self):
+        billing.run_billing(datetime(2010, 6, 19))
+
+        # User 3 is the only one with a bill due on 6/20
+        engine = billing.BillingEngine(date(2010, 6, 20), dirty_ids=set())
+        self.assertEqual([run.user for run in engine.runs()], [self.user3])
+
+        # User 7 is a guest of User 6 so a change to User 7 means both are billed
+        engine = billing.BillingEngine(date(2010, 6, 20), dirty_ids=set([self.user7.id]))
+        self.assertEqual([run.user for run in engine.runs()], [self.user3, self.user6, self.user7])
+
+        last_dirty_id = BillingDirty.objects.latest('id').id
+        billing.run_billing(datetime(2010, 6, 20), incremental=True)
+        self.assertTrue(BillingLog.objects.latest().successful)
+        self.assertEqual(self.user3.profile.last_bill().bill_date, date(2010, 6, 20))
+        self.assertFalse(BillingDirty.objects.filter(id__lte=last_dirty_id).exists())
+
+    def test_calendar(self):
+        calendar = billing.Calendar(date(2010, 6, 1), date(2010, 6, 30))
+        self.assertEqual(len(calendar), 30)
+        self.assertEqual(calendar.get(date(2010, 6, 15)).date, date(2010, 6, 15))
+        self.assertEqual(calendar.get(date(2010, 5, 31)), None)
+        self.assertEqual(calendar.get(date(2010, 7, 1)), None)
+        self.assertEqual([d.date for d in calendar.between(date(2010, 6, 28))], [date(2010, 6, 28), date(2010, 6, 29), date(2010, 6, 30)])
+        self.assertEqual(len(calendar.between(date(2010, 5, 1), date(2010, 6, 2))), 2)
+        self.assertEqual(calendar.between(date(2010, 5, 1), date(2010, 5, 2)), [])
+
+    def test_dry_run(self):
+        bills = billing.dry_run(datetime(2010, 6, 26))
+        self.assertEqual(Bill.objects.count(), 0)
+        self.assertEqual(BillingLog.objects.count(), 0)
+
+        billing.run_billing(datetime(2010, 6, 26))
+        self.assertEqual(len(bills), Bill.objects.count())
+        host_bill = [b for b in bills if b['user_id'] == self.user6.id and b['bill_date'] == '2010-06-26'][0]
+        self.assertEqual(host_bill['amount'], 275)
+        self.assertEqual(host_bill['plan'], 'PT5')
+        self.assertEqual(len(host_bill['guest_dropins']), 15)
+
+        totals = dict((t['plan'], t) for t in billing.plan_totals(bills))
+        self.assertEqual(totals['PT5']['bills'], len([b for b in bills if b['plan'] == 'PT5']))
+
+    def test_dry_run_diff(self):
+        previous = billing.dry_run(datetime(2010, 6, 19))
+        current = billing.dry_run(datetime(2010, 6, 20))
+        changes = billing.diff_bills(previous, current)
+        added = [bill for change, bill in changes if change == 'added']
+        self.assertTrue(len(added) > 0)
+        self.assertTrue(all(bill['bill_date'] == '2010-06-20' for bill in added))
+        self.assertEqual(billing.diff_bills(current, current), [])
+        self.assertEqual([change for change, bill in billing.diff_bills(current, [])], ['removed'] * len(current))
+
 # Copyright 2017 Office Nomads LLC (http://www.officenomads.com/) Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with the License. You may obtain a copy of the License at http://www.apache.org/licenses/LICENSE-2.0 Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the specific language governing permissions and limitations under the License.
@@ -8,7 +8,7 @@ from django.conf import settings
 from django.utils import timezone
 import staff.billing as billing
 from interlink.models import MailingList, unsubscribe_recent_dropouts
-from staff.views.stats import beginning_of_next_month, first_days_in_months
+from staff.views.stats import beginning_of_next_month, first_days_in_months, graph_members
 from nadine.models import *
 
 
@@ -55,6 +55,19 @@ class MailingListTest(TestCase):
 
 class UtilsTest(TestCase):
 
+    def test_graph_members(self):
+        plan = MembershipPlan.objects.create(name="Resident", monthly_rate=475, dropin_allowance=5, daily_rate=20, has_desk=True)
+        user = User.objects.create(username='member_one', first_name='Member', last_name='One')
+        Membership.objects.create_with_plan(user=user, start_date=date(2013, 1, 3), end_date=None, membership_plan=plan)
+        days = [{'date': date(2013, 1, 1) + timedelta(days=i)} for i in range(6)]
+
+        # Nothing snapshotted yet is not the same as nobody here
+        self.assertEqual([d['value'] for d in graph_members(days)[3]], [None] * 6)
+        MembershipDailySnapshot.objects.fill(date(2013, 1, 4))
+        min_v, max_v, avg_v, days = graph_members(days)
+        self.assertEqual([d['value'] for d in days], [0, 0, 1, 1, None, None])
+        self.assertEqual(max_v, 1)
+
     def test_monthly_ranges(self):
         self.assertEqual(beginning_of_next_month(date(2010, 1, 1)), date(2010, 2, 1))
         self.assertEqual(beginning_of_next_month(date(2010, 6, 30)), date(2010, 7, 1))
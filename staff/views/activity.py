@@ -12,6 +12,7 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.contrib import messages
 from django.conf import settings
+from django.db.models import Count
 
 
 from doors.keymaster.models import DoorEvent
@@ -51,12 +52,14 @@ def graph(request):
     end_date = date(year=endeo.tm_year, month=endeo.tm_mon, day=endeo.tm_mday)
     days = [{'date': start_date + timedelta(days=i)} for i in range((end_date - start_date).days)]
     days.reverse()
+    membership_counts = dict(Membership.objects.active_counts_between(start_date, end_date, group_by=('has_desk',)))
+    daily_log_counts = dict(CoworkingDay.objects.filter(visit_date__range=(start_date, end_date)).values_list('visit_date').annotate(Count('id')))
     for day in days:
-        memberships = Membership.objects.active_memberships(day['date'])
-        day['daily_logs'] = CoworkingDay.objects.filter(visit_date=day['date']).count()
-        day['has_desk'] = memberships.filter(has_desk=True).count()
+        counts = membership_counts.get(day['date'], {})
+        day['daily_logs'] = daily_log_counts.get(day['date'], 0)
+        day['has_desk'] = counts.get((True, ), 0)
         day['occupancy'] = day['daily_logs'] + day['has_desk']
-        day['membership'] = memberships.count()
+        day['membership'] = sum(counts.values())
 
     max_membership = 0
     max_has_desk = 0
@@ -15,7 +15,7 @@ from django.contrib import messages
 from django.conf import settings
 
 from nadine.models.core import Neighborhood
-from nadine.models.membership import Membership, MembershipPlan
+from nadine.models.membership import Membership, MembershipPlan, MembershipDailySnapshot
 from nadine.models.usage import CoworkingDay
 from nadine.forms import DateRangeForm
 
@@ -64,12 +64,23 @@ def calculate_dropins(start_date, end_date):
     return (all_logs.filter(payment='Visit').distinct().count(), all_logs.filter(payment='Trial').distinct().count(), all_logs.filter(payment='Waive').distinct().count(), all_logs.filter(payment='Bill').distinct().count())
 
 
-def calculate_monthly_low_high(plan_id, dates):
+def plan_counts_between(start_date, end_date):
+    """Returns a dictionary of (date, plan_id) to the number of active memberships"""
+    plan_counts = {}
+    for day, counts in Membership.objects.active_counts_between(start_date, end_date, group_by=('plan',)):
+        for (plan_id, ), count in counts.items():
+            plan_counts[(day, plan_id)] = count
+    return plan_counts
+
+
+def calculate_monthly_low_high(plan_id, dates, plan_counts=None):
     """returns a tuple of (min, max) for number of memberships in the date range of dates"""
+    if plan_counts is None:
+        plan_counts = plan_counts_between(min(dates), max(dates))
     high = 0
     low = 100000000
     for working_date in dates:
-        num_residents = Membership.objects.active_memberships(working_date).filter(membership_plan=plan_id).count()
+        num_residents = plan_counts.get((working_date, plan_id), 0)
         high = max(high, num_residents)
         low = min(low, num_residents)
         avg = int(round((low + high) / 2))
@@ -125,11 +136,13 @@ def memberships(request):
         month_histories.append(month_history)
         working_month = working_month + timedelta(days=month_history.days_in_month)
 
+    plans = MembershipPlan.objects.filter(enabled=True)
+    plan_counts = plan_counts_between(month_histories[0].start_date, month_histories[-1].end_date)
     for month in month_histories:
         dates = [date(month.year, month.month, i) for i in range(1, month.days_in_month + 1)]
 
-        for plan in MembershipPlan.objects.filter(enabled=True):
-            data = calculate_monthly_low_high(plan.id, dates)
+        for plan in plans:
+            data = calculate_monthly_low_high(plan.id, dates, plan_counts)
             if average_only:
                 month.data[plan.name] = data[2]
             else:
@@ -296,24 +309,45 @@ def graph(request):
     elif graph == "churn":
         title = "Membership Churn"
 
+    missing_days = [day['date'] for day in days if day.get('missing')]
     context = {'title':title, 'graph':graph,
         'days': days, 'date_range_form': date_range_form, 'start': start, 'end': end,
-        'min': min_v, 'max': max_v, 'avg': avg_v}
+        'min': min_v, 'max': max_v, 'avg': avg_v,
+        'missing_from': missing_days[0] if missing_days else None,
+        'snapshotted_through': MembershipDailySnapshot.objects.snapshotted_through()}
     return render(request, 'staff/stats/graph.html', context)
 
 
+def daily_totals(days):
+    # Days after the snapshots are filled in through are marked missing rather than charted as no members
+    if len(days) == 0:
+        return {}
+    through = MembershipDailySnapshot.objects.snapshotted_through()
+    for day in days:
+        day['missing'] = through is None or day['date'] > through
+    return MembershipDailySnapshot.objects.daily_totals(days[0]['date'], days[-1]['date'])
+
+
 def graph_members(days):
     member_min = 0
     member_max = 0
     member_total = 0
+    member_days = 0
+    totals = daily_totals(days)
     for day in days:
-        day['value'] = Membership.objects.active_memberships(day['date']).count()
+        day['value'] = None
+        if day['missing']:
+            continue
+        day['value'] = 0
+        if day['date'] in totals:
+            day['value'] = totals[day['date']]['member_count']
         member_total = member_total + day['value']
+        member_days = member_days + 1
         if day['value'] > member_max:
             member_max = day['value']
         if member_min == 0 or day['value'] < member_min:
             member_min = day['value']
-    member_avg = member_total / len(days)
+    member_avg = member_total / max(member_days, 1)
     return (member_min, member_max, member_avg, days)
 
 
@@ -321,20 +355,27 @@ def graph_income(days):
     income_min = 0
     income_max = 0
     income_total = 0
+    income_days = 0
+    totals = daily_totals(days)
     for day in days:
+        day['membership'] = None
+        day['value'] = None
+        if day['missing']:
+            continue
         membership_count = 0
         membership_income = 0
-        for membership in Membership.objects.active_memberships(day['date']):
-            membership_count = membership_count + 1
-            membership_income = membership_income + membership.monthly_rate
+        if day['date'] in totals:
+            membership_count = totals[day['date']]['member_count']
+            membership_income = totals[day['date']]['monthly_revenue']
         income_total = income_total + membership_income
+        income_days = income_days + 1
         if membership_income > income_max:
             income_max = membership_income
         if income_min == 0 or membership_income < income_min:
             income_min = membership_income
         day['membership'] = membership_count
         day['value'] = membership_income
-    income_avg = income_total / len(days)
+    income_avg = income_total / max(income_days, 1)
     return (income_min, income_max, income_avg, days)
 
 
@@ -343,14 +384,22 @@ def graph_amv(days):
     member_min = 0
     member_max = 0
     member_total = 0
+    member_days = 0
+    totals = daily_totals(days)
     for day in days:
-        day['value'] = Membership.objects.active_memberships(day['date']).count()
+        day['value'] = None
+        if day['missing']:
+            continue
+        day['value'] = 0
+        if day['date'] in totals:
+            day['value'] = totals[day['date']]['member_count']
         member_total = member_total + day['value']
+        member_days = member_days + 1
         if day['value'] > member_max:
             member_max = day['value']
         if member_min == 0 or day['value'] < member_min:
             member_min = day['value']
-    member_avg = member_total / len(days)
+    member_avg = member_total / max(member_days, 1)
     return (min_v, max_v, avg_v, days)
 
 